@@ -0,0 +1,416 @@
+#! /usr/bin/env python
+
+####
+# Benchmarks for nab.
+#
+# Usage:
+#
+#   # Time every core step and a set of realistic pipelines.
+#   python benchmarks/bench.py run [--lines N] [--repeat R] [-o PATH]
+#
+#   # Compare two runs, flagging regressions beyond a threshold.
+#   python benchmarks/bench.py compare OLD NEW [--threshold 0.1]
+#
+# The inputs are synthetic corpora generated on first use and kept in a data
+# directory: ls-style output, web server access logs, JSON lines, and columns
+# of numbers. The same seed always yields the same corpus.
+#
+# Each step is timed on its own -- or, where it needs prepared input, after
+# the steps that prepare it (for example, split before index). The steps and
+# pipelines run in-process via nab.cli.main(), with output sent to os.devnull.
+# The pipelines also run end to end, via the nab command, which includes the
+# startup time. Timings are the best of several repeats, in seconds.
+####
+
+from __future__ import absolute_import, unicode_literals, print_function
+
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import random
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+
+from nab.cli import main, StepRegistry
+from nab.version import __version__
+
+####
+# Entry point.
+####
+
+def cli_main(args = None):
+    ap = argparse.ArgumentParser(prog = 'bench.py')
+    sub = ap.add_subparsers(dest = 'command')
+    sub.required = True
+
+    ap_run = sub.add_parser('run', help = 'Run the benchmarks')
+    ap_run.add_argument('--lines', type = int, default = 200000,
+                        help = 'Lines per corpus')
+    ap_run.add_argument('--repeat', type = int, default = 3,
+                        help = 'Runs per benchmark; the best is kept')
+    ap_run.add_argument('--only', metavar = 'TEXT',
+                        help = 'Run only benchmarks whose name contains TEXT')
+    ap_run.add_argument('--nab-opts', default = '', metavar = 'OPTS',
+                        help = 'Global nab options, like "--no-fuse"')
+    ap_run.add_argument('--no-e2e', action = 'store_true',
+                        help = 'Skip the end-to-end runs')
+    ap_run.add_argument('--data-dir', default = DATA_DIR, metavar = 'DIR',
+                        help = 'Where to keep the generated corpora')
+    ap_run.add_argument('-o', '--output', metavar = 'PATH',
+                        help = 'Write the results as JSON')
+
+    ap_cmp = sub.add_parser('compare', help = 'Compare two runs')
+    ap_cmp.add_argument('old', help = 'JSON from the baseline run')
+    ap_cmp.add_argument('new', help = 'JSON from the new run')
+    ap_cmp.add_argument('--threshold', type = float, default = 0.10,
+                        help = 'Flag changes beyond this fraction')
+
+    opts = ap.parse_args(args)
+    if opts.command == 'run':
+        run_benchmarks(opts)
+    else:
+        n = compare_results(opts.old, opts.new, opts.threshold)
+        sys.exit(1 if n else 0)
+
+####
+# Running benchmarks.
+####
+
+def run_benchmarks(opts):
+    nab_opts = shlex.split(opts.nab_opts)
+    paths = {
+        name : get_corpus(opts.data_dir, name, opts.lines)
+        for name in CORPORA
+    }
+    blocklist = get_blocklist(opts.data_dir)
+
+    # Assemble the benchmarks: (NAME, FUNC) tuples.
+    benches = []
+    for sname, corpus, xs in STEP_BENCHMARKS:
+        args = nab_opts + shlex.split(xs) + ['--', paths[corpus]]
+        benches.append(('step:' + sname, in_process(args)))
+    for pname, corpus, xs in PIPELINES:
+        xs = xs.format(blocklist = blocklist)
+        args = nab_opts + shlex.split(xs) + ['--', paths[corpus]]
+        benches.append(('pipeline:' + pname, in_process(args)))
+        if not opts.no_e2e:
+            benches.append(('e2e:' + pname, end_to_end(args)))
+    if opts.only:
+        benches = [(name, f) for name, f in benches if opts.only in name]
+
+    # Run them.
+    warn_unbenchmarked()
+    results = {}
+    for name, f in benches:
+        secs = min(timed(f) for _ in range(opts.repeat))
+        results[name] = secs
+        print('{:<36} {:>9.4f}'.format(name, secs))
+
+    # Write the JSON.
+    if opts.output:
+        d = dict(
+            meta = dict(
+                nab_version = __version__,
+                python = platform.python_version(),
+                platform = platform.platform(),
+                lines = opts.lines,
+                repeat = opts.repeat,
+                nab_opts = opts.nab_opts,
+                time = datetime.datetime.now().isoformat(),
+            ),
+            results = results,
+        )
+        with open(opts.output, 'w') as fh:
+            json.dump(d, fh, indent = 4, sort_keys = True)
+
+def in_process(args):
+    # Returns a function that runs nab in-process, discarding its output.
+    def f():
+        with open(os.devnull, 'w') as null:
+            with contextlib.redirect_stdout(null):
+                main(list(args))
+    return f
+
+def end_to_end(args):
+    # Returns a function that runs the nab command, discarding its output.
+    def f():
+        with open(os.devnull, 'w') as null:
+            subprocess.check_call(['nab'] + list(args), stdout = null)
+    return f
+
+def timed(f):
+    t = time.perf_counter()
+    f()
+    return time.perf_counter() - t
+
+def warn_unbenchmarked():
+    names = set(StepRegistry([]).core) - set(x[0] for x in STEP_BENCHMARKS)
+    if names:
+        msg = 'Core steps without a benchmark: {}\n'
+        sys.stderr.write(msg.format(', '.join(sorted(names))))
+
+####
+# Comparing results.
+####
+
+def compare_results(old_path, new_path, threshold):
+    # Prints a table comparing two runs. Returns the number of regressions.
+    with open(old_path) as fh:
+        old = json.load(fh)['results']
+    with open(new_path) as fh:
+        new = json.load(fh)['results']
+    n = 0
+    fmt = '{:<36} {:>9} {:>9} {:>8}  {}'
+    print(fmt.format('benchmark', 'old', 'new', 'ratio', ''))
+    for name in sorted(set(old) | set(new)):
+        secs = [
+            '-' if d.get(name) is None else '{:.4f}'.format(d[name])
+            for d in (old, new)
+        ]
+        if name not in old or name not in new:
+            status = 'only in ' + ('new' if name in new else 'old')
+            print(fmt.format(name, secs[0], secs[1], '-', status))
+            continue
+        ratio = new[name] / old[name] if old[name] else float('inf')
+        if ratio > 1 + threshold:
+            status = 'REGRESSION'
+            n += 1
+        elif ratio < 1 - threshold:
+            status = 'faster'
+        else:
+            status = ''
+        print(fmt.format(name, secs[0], secs[1], '{:.2f}'.format(ratio), status))
+    msg = '\n{} regression(s) beyond {:.0%}'
+    print(msg.format(n, threshold))
+    return n
+
+####
+# Synthetic corpora.
+####
+
+def get_corpus(data_dir, name, n):
+    # Returns the path to a corpus with n lines, generating it if needed.
+    path = os.path.join(data_dir, '{}-{}.txt'.format(name, n))
+    if not os.path.isfile(path):
+        if not os.path.isdir(data_dir):
+            os.makedirs(data_dir)
+        rnd = random.Random(SEED)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as fh:
+            for i in range(n):
+                fh.write(CORPORA[name](rnd, i))
+        os.rename(tmp, path)
+    return path
+
+def get_blocklist(data_dir):
+    # Returns the path to a patterns file of IP addresses, some of which
+    # occur in the access corpus (see grep -f).
+    n = BLOCKLIST_SIZE
+    path = os.path.join(data_dir, 'blocklist-{}.txt'.format(n))
+    if not os.path.isfile(path):
+        rnd = random.Random(SEED)
+        with open(path, 'w') as fh:
+            for _ in range(n):
+                fh.write('10.{}.{}.{} \n'.format(
+                    rnd.randint(0, 9),
+                    rnd.randint(0, 255),
+                    rnd.randint(1, 254),
+                ))
+    return path
+
+def gen_ls(rnd, i):
+    return '{}  1 {:<8} staff {:>9} {} {:>2} {:02}:{:02} {}{}.{}\n'.format(
+        rnd.choice(('-rw-r--r--', '-rwxr-xr-x', 'drwxr-xr-x')),
+        rnd.choice(USERS),
+        rnd.randint(0, 10 ** 7),
+        rnd.choice(MONTHS),
+        rnd.randint(1, 28),
+        rnd.randint(0, 23),
+        rnd.randint(0, 59),
+        rnd.choice(WORDS),
+        i,
+        rnd.choice(('txt', 'py', 'json', 'log', 'gz')),
+    )
+
+def gen_access(rnd, i):
+    fmt = '{} - {} [{:02}/{}/2020:{:02}:{:02}:{:02} -0700] "{} {} HTTP/1.1" {} {}\n'
+    return fmt.format(
+        '10.{}.{}.{}'.format(rnd.randint(0, 9), rnd.randint(0, 255), rnd.randint(1, 254)),
+        rnd.choice(USERS + ('-',) * 4),
+        rnd.randint(1, 28),
+        rnd.choice(MONTHS),
+        rnd.randint(0, 23),
+        rnd.randint(0, 59),
+        rnd.randint(0, 59),
+        rnd.choice(('GET',) * 8 + ('POST', 'PUT', 'DELETE')),
+        '/' + '/'.join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 4))),
+        rnd.choice((200,) * 12 + (301, 304, 404, 404, 500)),
+        rnd.randint(0, 50000),
+    )
+
+def gen_jsonl(rnd, i):
+    d = dict(
+        id = i,
+        user = rnd.choice(USERS),
+        level = rnd.choice(('debug', 'info', 'info', 'info', 'warn', 'error')),
+        msg = ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(3, 10))),
+        elapsed = round(rnd.expovariate(10), 4),
+        tags = rnd.sample(WORDS, rnd.randint(0, 3)),
+    )
+    return json.dumps(d, sort_keys = True) + '\n'
+
+def gen_numeric(rnd, i):
+    return '{} {:.3f} {} {:.6f}\n'.format(
+        rnd.randint(-1000, 1000),
+        rnd.uniform(0, 100),
+        rnd.randint(0, 10 ** 9),
+        rnd.gauss(0, 1),
+    )
+
+def gen_csv(rnd, i):
+    # Twelve columns; one in ten lines has a quoted field.
+    msg = ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 4)))
+    if rnd.random() < 0.1:
+        msg = '"{}, {}"'.format(msg, rnd.choice(WORDS))
+    return '{},{},{},{},{},{},{},{},{},{},{},{}\n'.format(
+        i,
+        rnd.choice(USERS),
+        rnd.choice(MONTHS),
+        rnd.randint(1, 28),
+        msg,
+        rnd.randint(0, 10 ** 6),
+        round(rnd.uniform(0, 100), 2),
+        rnd.choice((200,) * 12 + (301, 304, 404, 404, 500)),
+        rnd.choice(WORDS),
+        rnd.randint(0, 9),
+        rnd.choice(WORDS),
+        rnd.choice(('x', 'y', 'z')),
+    )
+
+def gen_sorted(rnd, i):
+    # Sorted keys, in runs of 8 lines.
+    return 'key{:010d} {}\n'.format(i // 8, rnd.randint(0, 10 ** 6))
+
+CORPORA = dict(
+    ls = gen_ls,
+    access = gen_access,
+    jsonl = gen_jsonl,
+    numeric = gen_numeric,
+    sorted = gen_sorted,
+    csv = gen_csv,
+)
+
+SEED = 1234
+BLOCKLIST_SIZE = 2000
+DATA_DIR = os.path.join(tempfile.gettempdir(), 'nab-bench')
+USERS = ('alice', 'bob', 'carol', 'dave', 'erin', 'frank', 'root')
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+          'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+WORDS = ('alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'golf',
+         'hotel', 'india', 'juliet', 'kilo', 'lima', 'mike', 'november',
+         'oscar', 'papa', 'quebec', 'romeo', 'sierra', 'tango', 'uniform')
+
+####
+# The benchmarks.
+####
+
+# (STEP, CORPUS, ARGS) for each core step.
+STEP_BENCHMARKS = [
+    ('pr', 'ls', '-s pr'),
+    ('wr', 'ls', '-s wr'),
+    ('chomp', 'ls', '-s chomp'),
+    ('strip', 'ls', '-s strip'),
+    ('lstrip', 'ls', '-s lstrip'),
+    ('rstrip', 'ls', '-s rstrip'),
+    ('split', 'ls', '-s split'),
+    ('join', 'ls', '-s split -s join ,'),
+    ('index', 'ls', '-s split -s index 4'),
+    ('rindex', 'ls', '-s split -s rindex 1'),
+    ('range', 'ls', '-s split -s range 1 4'),
+    ('field', 'ls', '-s field 0,4'),
+    ('head', 'ls', '-s head 1000000000'),
+    ('tail', 'ls', '-s tail 10'),
+    ('skip', 'ls', '-s skip 10'),
+    ('nl', 'ls', '-s chomp -s nl'),
+    ('prefix', 'ls', '-s prefix ">"'),
+    ('suffix', 'ls', '-s suffix "<"'),
+    ('freq', 'access', '-s split -s index 0 -s freq'),
+    ('sum', 'numeric', '-s split -s index 0 -s int -s sum'),
+    ('stats', 'numeric', '-s field 2 -s stats'),
+    ('groupby', 'access', '-s groupby -f 8'),
+    ('sort', 'ls', '-s sort -f 4 -n'),
+    ('str', 'numeric', '-s split -s index 0 -s int -s str'),
+    ('int', 'numeric', '-s split -s index 0 -s int'),
+    ('float', 'numeric', '-s split -s index 1 -s float'),
+    ('sub', 'access', r'-s sub "\d+" N'),
+    ('search', 'access', r'-s search "\"(\w+) " -g 1'),
+    ('grep', 'access', '-s grep " 404 "'),
+    ('findall', 'access', r'-s findall "\d+"'),
+    ('run', 'ls', '-s run "return val[::-1]"'),
+    ('jsond', 'jsonl', '-s jsond'),
+    ('jsonl', 'jsonl', '-s jsonl level'),
+    ('csv', 'csv', '-s csv 3'),
+    ('tsv', 'numeric', '-s tsv 0'),
+    ('flipflop', 'access', '-s flipflop " 404 " " 500 "'),
+    ('para', 'ls', '-s para'),
+    ('uniq', 'access', '-s split -s index 0 -s uniq'),
+    ('decode', 'ls', '--bytes -s decode'),
+]
+
+# (NAME, CORPUS, ARGS) for the realistic pipelines.
+PIPELINES = [
+    ('ls-total-size', 'ls', '-s chomp -s split -s index 4 -s int -s sum'),
+    ('ls-owners', 'ls', '-s split -s index 2 -s freq'),
+    ('access-status-freq', 'access', '-s split -s index 8 -s freq'),
+    ('access-404-paths', 'access',
+     r'-s grep " 404 " -s search "\"\w+ (\S+)" -g 1 -s uniq -s pr'),
+    ('access-top-paths', 'access',
+     r'-s search "\"\w+ (\S+)" -g 1 -s freq --top 10'),
+    ('access-top-paths-approx', 'access',
+     r'-s search "\"\w+ (\S+)" -g 1 -s freq --top 10 --approx 1000'),
+    ('access-paths-uniq-stream', 'access',
+     r'-s search "\"\w+ (\S+)" -g 1 -s uniq --stream -s pr'),
+    ('access-paths-uniq-bloom', 'access',
+     r'-s search "\"\w+ (\S+)" -g 1 -s uniq --bloom 0.001 -s pr'),
+    ('access-paths-uniq-spill', 'access',
+     r'-s search "\"\w+ (\S+)" -g 1 -s uniq --spill 64K -s pr'),
+    ('access-grep-prefilter', 'access', r'-s grep "\d+ 404 \d+" -s wr'),
+    ('access-blocklist', 'access', '-s grep -F -f {blocklist} -s wr'),
+    ('access-blocklist-search', 'access',
+     '-s search -F -f {blocklist} -s freq --top 10'),
+    ('access-status-bytes', 'access',
+     '-s groupby -f 8 -v 9 -a count sum mean'),
+    ('access-top-ip-bytes', 'access',
+     '-s groupby -f 0 -v 9 -a sum max --by sum --top 10'),
+    ('access-ip-bytes-spill', 'access',
+     '-s groupby -f 0 -v 9 -a sum --buffer 256K'),
+    ('access-get-bytes', 'access', '--bytes -s grep "GET /alpha" -s wr'),
+    ('jsonl-errors', 'jsonl', '-s grep "\\"level\\": \\"error\\"" -s wr'),
+    ('jsonl-level-freq', 'jsonl', '-s jsonl level -s freq'),
+    ('jsonl-level-freq-no-scan', 'jsonl', '-s jsonl level --no-scan -s freq'),
+    ('jsonl-user-freq', 'jsonl', '-s jsonl user -s freq'),
+    ('jsonl-elapsed-sum', 'jsonl', '-s jsonl elapsed -s sum'),
+    ('csv-split-freq', 'csv', '-s chomp -s split , -s index 7 -s freq'),
+    ('csv-freq', 'csv', '-s csv 7 -s freq'),
+    ('csv-sum', 'csv', '-s csv 5 -s int -s sum'),
+    ('numeric-sum', 'numeric', '-s split -s index 2 -s int -s sum'),
+    ('sorted-uniq', 'sorted', '-s split -s index 0 -s uniq -s pr'),
+    ('sorted-uniq-sorted', 'sorted',
+     '-s split -s index 0 -s uniq --sorted -s pr'),
+    ('sorted-freq', 'sorted', '-s split -s index 0 -s freq'),
+    ('sorted-freq-sorted', 'sorted', '-s split -s index 0 -s freq --sorted'),
+    ('numeric-sort-spill', 'numeric', '-s sort -f 2 -n --buffer 4M -s wr'),
+    ('numeric-stats', 'numeric', '-s field 2 -s stats -q 0.5 0.99'),
+    ('numeric-stats-approx', 'numeric',
+     '-s field 2 -s stats -q 0.5 0.99 --approx'),
+    ('numeric-head', 'numeric', '-s chomp -s head 100 -s pr'),
+]
+
+if __name__ == '__main__':
+    cli_main()
@@ -28,6 +28,10 @@ reqs = [
 ]
 
 extras = {
+    'speedups' : [
+        'pyahocorasick',
+        'numpy',
+    ],
     'test' : [
         'coverage',
         'pytest',
@@ -4,13 +4,18 @@
 
 from __future__ import absolute_import, unicode_literals, print_function
 
-from inspect import getmembers, isclass
 import argparse
 import collections
+import io
+import itertools
+import json
+import locale
+import mmap
 import os
-import random
-import string
+import stat
 import sys
+import tempfile
+import threading
 
 if sys.version_info >= (3, 5):
     from importlib.util import spec_from_file_location, module_from_spec
@@ -20,8 +25,15 @@ else:
     from imp import load_source
 
 from . import core_steps
-from .step import Step
-from .utils import getitem, getnext, ValIter, Meta
+from .compression import get_compression, get_stream_compression
+from .compression import open_compressed, read_compressed, text_wrapper, wrap_compressed
+from .fuse import compile_steps
+from .parallel import get_parallel_tasks, process_parallel
+from .profiler import Profiler
+from .step import Step, get_hook
+from .utils import get_cache_dir, getitem, getnext, parse_flush, parse_size, write_step_error
+from .utils import replace_file, write_atomic
+from .utils import ValIter, Meta
 from .version import __version__
 
 ####
@@ -39,6 +51,10 @@ def main(args = None):
     # Begin phase.
     for s in opts.steps:
         s.begin(s.opts)
+    opts.meta._set_steps(opts.steps)
+
+    # Install the profiler, if requested.
+    profiler = Profiler(opts.steps) if opts.profile else None
 
     # Discover phase.
     #
@@ -57,24 +73,52 @@ def main(args = None):
     # 4. Convert the raw data to the objects listed above and store the list of
     # FileSet on opts.
     #
-    raw_fsets = [FileSet.raw_fset(p) for p in opts.paths]
+    raw_fsets = [FileSet.raw_fset(p, opts.in_place) for p in opts.paths]
     for s in opts.steps:
         raw_fsets = s.discover(s.opts, raw_fsets)
     raw_fsets = raw_fsets or [FileSet.raw_fset(None)]
-    opts.fsets = [FileSet(**d) for d in raw_fsets]
+    streams = CompressedStreams()
+    opts.fsets = [
+        FileSet(
+            binary = opts.bytes,
+            flush = opts.flush,
+            compress = opts.compress,
+            fsync = opts.fsync,
+            skip_unchanged = opts.skip_unchanged,
+            streams = streams,
+            **d
+        )
+        for d in raw_fsets
+    ]
     opts.meta._set_n_files(len(opts.fsets))
+    set_tail_ranges(opts)
 
-    # Initialize, process, and finalize phases.
-    process_lines(opts)
-
-    # End phase.
-    for s in opts.steps:
-        s.end(s.opts, opts.meta)
+    try:
+        # Initialize, process, and finalize phases.
+        process_lines(opts)
+
+        # End phase. Output to STDOUT goes through its compressed stream,
+        # if it has one.
+        out = streams.get(sys.stdout)
+        if out:
+            opts.meta.out = FileHandle(':STDOUT:', out)
+            opts.meta.out.writer = Writer(out, opts.flush)
+        for s in opts.steps:
+            s.end(s.opts, opts.meta)
+        if out:
+            opts.meta.out.writer.close()
+    finally:
+        streams.close()
+    if profiler:
+        profiler.report(opts.profile_json)
 
 def print_help(opts):
-    msg = 'Usage: m [--help] -s STEP ... -- [PATH...]'
+    msg = 'Usage: m [--help] [OPTS] -s STEP ... -- [PATH...]'
     fmt = '  {:<12} {:<40} {}'
     print(msg)
+    print('\nOptions:')
+    for name, d, h in get_opt_help(OPTS_CONFIG):
+        print(fmt.format(name, d, h))
     print('\nSteps:')
     for sname, step in opts.valid_steps.items():
         d = step.DESC or ''
@@ -86,6 +130,52 @@ def print_help(opts):
 # CLI argument parsing.
 ####
 
+# Global options. They must appear before the first --step.
+OPTS_CONFIG = [
+    '--batch',
+    dict(type = int, default = 0, metavar = 'N',
+         help = 'Process vals in batches of N lines'),
+    '--no-fuse',
+    dict(action = 'store_true',
+         help = 'Do not compile the steps into a fused loop'),
+    '--jobs',
+    dict(type = int, default = 1, metavar = 'N',
+         help = 'Process files in N worker processes (0: one per CPU)'),
+    '--split',
+    dict(type = parse_size, default = 0, metavar = 'SIZE',
+         help = 'With --jobs, split input files into pieces of SIZE bytes'),
+    '--bytes',
+    dict(action = 'store_true',
+         help = 'Read input lines as bytes, decoding them only if needed'),
+    '--flush',
+    dict(type = parse_flush, default = None, metavar = 'POLICY',
+         help = 'Flush output: block, line, or every N seconds'),
+    '--compress',
+    dict(choices = ('gz', 'bz2', 'xz'), metavar = 'FMT',
+         help = 'Compress output: gz, bz2, or xz'),
+    '--in-place',
+    dict(action = 'store_true',
+         help = 'Write output back to each input file'),
+    '--fsync',
+    dict(action = 'store_true',
+         help = 'Sync in-place rewrites to disk before replacing files'),
+    '--skip-unchanged',
+    dict(action = 'store_true',
+         help = 'Leave files untouched if a rewrite would not change them'),
+    '--no-prefilter',
+    dict(action = 'store_true',
+         help = 'Do not check regex steps for required literals first'),
+    '--no-rewrite',
+    dict(action = 'store_true',
+         help = 'Do not replace split+index with the field step'),
+    '--profile',
+    dict(action = 'store_true',
+         help = 'Print time and val counts for each step to STDERR'),
+    '--profile-json',
+    dict(metavar = 'PATH',
+         help = 'With --profile, also write the results as JSON'),
+]
+
 def parse_args(orig_args):
     # Example:
     #
@@ -101,7 +191,7 @@ def parse_args(orig_args):
         steps = [],
         paths = [],
         fsets = [],
-        valid_steps = get_known_steps(),
+        valid_steps = StepRegistry(),
         meta = Meta(),
     )
 
@@ -125,6 +215,12 @@ def parse_args(orig_args):
         if a in ('--step', '-s')
     ]
 
+    # Parse the global options, which precede the first --step.
+    ap = get_opt_parser(OPTS_CONFIG)
+    d = vars(ap.parse_args(args[:getitem(js, 0, len(args))]))
+    for k, v in d.items():
+        setattr(opts, k, v)
+
     # Convert that list of a list of index pairs ready for use as a range.
     pairs = [
         (getitem(js, i), getitem(js, i + 1))
@@ -155,8 +251,66 @@ def parse_args(orig_args):
             msg = 'Invalid step: {}'.format(sname)
             exit(2, msg)
 
+    # Replace step sequences with faster equivalents.
+    if not opts.no_rewrite:
+        rewrite_steps(opts)
+
+    # In bytes mode, set up the steps that will receive bytes.
+    if opts.bytes:
+        set_bytes_steps(opts)
+    if opts.no_prefilter:
+        for s in opts.steps:
+            s.prefilter = False
+
     return opts
 
+def rewrite_steps(opts):
+    # Replaces a Split step followed by an Index or RIndex step with a Field
+    # step, which splits the val only as far as needed. The steps must be
+    # the built-in ones, and --strict must not be in use.
+    steps = opts.steps
+    i = 0
+    while i < len(steps) - 1:
+        s, nxt = steps[i:i + 2]
+        ok = (
+            type(s) is core_steps.Split and
+            type(nxt) in (core_steps.Index, core_steps.RIndex) and
+            not nxt.opts.strict
+        )
+        if ok:
+            j = nxt.opts.i
+            if type(nxt) is core_steps.RIndex:
+                j = - j
+            xs = [str(j)]
+            if s.opts.rgx:
+                xs.extend(['-d' + s.opts.rgx, '--rgx'])
+            steps[i:i + 2] = [new_step(core_steps.Field, 'field', xs, opts.meta)]
+        i += 1
+    for i, s in enumerate(steps):
+        s.sid = i + 1
+
+def new_step(cls, sname, xs, meta):
+    # Creates a step from a list of args, as given on the command line.
+    ap = get_opt_parser(cls.OPTS_CONFIG or [], sname)
+    sopts = Opts(**vars(ap.parse_args(xs)))
+    return cls(sid = None, name = sname, opts = sopts, meta = meta)
+
+def set_bytes_steps(opts):
+    # Input lines flow through the steps as bytes until reaching either a
+    # Decode step or a step unable to handle bytes. The latter gets a Decode
+    # step, with the default options, placed in front of it.
+    steps = opts.steps
+    for i, s in enumerate(steps):
+        if not s.BYTES:
+            dec = new_step(core_steps.Decode, 'decode', [], opts.meta)
+            steps.insert(i, dec)
+            break
+        s.bytes = True
+        if isinstance(s, core_steps.Decode):
+            break
+    for i, s in enumerate(steps):
+        s.sid = i + 1
+
 def get_opt_parser(configs, sname = None):
     prog = '--step {}'.format(sname) if sname else None
     ap = argparse.ArgumentParser(add_help = False, prog = prog)
@@ -169,6 +323,16 @@ def get_opt_parser(configs, sname = None):
             xs.append(obj)
     return ap
 
+def get_opt_help(configs):
+    # Takes an OPTS_CONFIG list. Yields (NAME, HELP, METAVAR) tuples.
+    xs = []
+    for obj in configs:
+        if isinstance(obj, dict):
+            yield ('/'.join(xs), obj.get('help', ''), obj.get('metavar', ''))
+            xs = []
+        else:
+            xs.append(obj)
+
 class Opts(object):
     # A class to hold command-line option values.
 
@@ -195,13 +359,57 @@ class Opts(object):
 ####
 
 def process_lines(opts):
+    engine = get_engine(opts)
+    ok = False
     try:
-        do_process_lines(opts)
+        # Profiling covers only the steps in the parent process.
+        serial = opts.jobs == 1 or opts.profile
+        tasks = None if serial else get_parallel_tasks(opts)
+        if tasks:
+            process_parallel(opts, engine, tasks)
+        else:
+            engine(opts, opts.fsets)
+        ok = True
     finally:
+        # After an error, in-place rewrites that are still open are
+        # abandoned, leaving their files as they were.
         for fset in opts.fsets:
-            fset.close_handles()
+            fset.close_handles(ok)
 
-def do_process_lines(opts):
+def set_tail_ranges(opts):
+    # If the first step that is not a one-to-one map (see Step.MAP) is a
+    # Tail, the lines before the last N of each input file cannot affect
+    # the results, so only those N lines need to be read.
+    for s in opts.steps:
+        if not s.MAP:
+            break
+    else:
+        return
+    if isinstance(s, core_steps.Tail):
+        for fset in opts.fsets:
+            fset.inp_range = fset.get_tail_range(s.opts.n)
+
+def get_engine(opts):
+    # Returns the function that will execute the process and finalize phases.
+    if opts.batch > 0 and can_batch(opts):
+        return do_process_batches
+    elif opts.no_fuse:
+        return do_process_lines
+    else:
+        return do_process_fused
+
+def can_batch(opts):
+    # Batch mode would reorder the side effects of steps relative to each
+    # other (see Step.EFFECTS), so it requires at most one step with them.
+    # Otherwise, warns the user and returns False.
+    names = [s.name for s in opts.steps if s.EFFECTS]
+    if len(names) > 1:
+        fmt = 'nab: --batch: not batching: steps {} have side effects\n'
+        sys.stderr.write(fmt.format(', '.join(names)))
+        return False
+    return True
+
+def do_process_lines(opts, fsets):
     # This function executes the process and finalize phases of a nab run.
     # It uses a stack containing various types of data and continues
     # until the stack is empty:
@@ -230,26 +438,11 @@ def do_process_lines(opts):
     # Setup.
     # - A Convenience var holding the global Meta instance.
     # - The index of the last Step in the run.
-    # - A format string for printing information if a Step's process()
-    #   or finalize() methods raise an exception.
     meta = opts.meta
     max_i = len(opts.steps) - 1
-    error_fmt = '\n'.join((
-        '',
-        'Step error:',
-        '  inp: {}',
-        '  out: {}',
-        '  err: {}',
-        '  overall_num: {}',
-        '  line_num: {}',
-        '  orig: {!r}',
-        '  val: {!r}',
-        '',
-        '',
-    ))
 
     # Process the stack until the FileSetCollection is exhausted.
-    stack = [FileSetCollection(opts.fsets)]
+    stack = [FileSetCollection(fsets)]
     while stack:
 
         # Get the next item from the stack.
@@ -272,16 +465,7 @@ def do_process_lines(opts):
                 else:
                     v = s.finalize(s.opts, meta)
             except Exception:
-                msg = error_fmt.format(
-                    meta.inp.path,
-                    meta.out.path,
-                    meta.err.path,
-                    meta.overall_num,
-                    meta.line_num,
-                    meta.orig,
-                    val.val,
-                )
-                sys.stderr.write(msg)
+                write_step_error(meta, repr(val.val))
                 raise
 
             # Decide what to add to the stack.
@@ -313,7 +497,7 @@ def do_process_lines(opts):
         # FileSet: get the next input line from the file.
         elif isinstance(item, FileSet):
             fset = item
-            line = getnext(fset)
+            line = None if meta.stop else getnext(fset)
             if line is None:
                 # The file is exhausted: add a Closer for the FileSet to the
                 # stack, followed by a FinalVal for every step. After all
@@ -352,6 +536,122 @@ def do_process_lines(opts):
         else:
             assert False, 'process_lines() got an unexpected data type'
 
+def do_process_fsets(opts, fsets, read, forward):
+    # This function provides the overall structure for the engines that
+    # work through the FileSet instances one at a time, rather than via
+    # the stack used by do_process_lines(). For each FileSet, it executes
+    # the initialize, process, and finalize phases, delegating the details
+    # to two engine-specific functions:
+    #
+    # - read(fset): run all input lines in the FileSet through the steps.
+    #
+    # - forward(i, v): run a val returned by a step's finalize() method (a
+    #   ValIter or a regular val) through the steps, starting at index i.
+    meta = opts.meta
+    steps = opts.steps
+    max_i = len(steps) - 1
+    for fset in fsets:
+
+        # Initialize phase.
+        fset.open_handles()
+        meta._set_path(fset.inp, fset.out, fset.err)
+        for s in steps:
+            s.initialize(s.opts, meta)
+
+        # Process phase (unless a step stopped the reading of all input).
+        if not meta.stop:
+            read(fset)
+
+        # Finalize phase. Any vals returned by a step's finalize() method are
+        # forwarded to downstream steps.
+        for i, s in enumerate(steps):
+            try:
+                v = s.finalize(s.opts, meta)
+            except Exception:
+                write_step_error(meta, repr(None))
+                raise
+            if v is not None and i < max_i:
+                forward(i + 1, v)
+
+        # Close the FileSet.
+        meta._unset_path()
+        fset.close_handles()
+
+def do_process_batches(opts, fsets):
+    # This function is the batch-mode alternative to do_process_lines(). It
+    # reads N lines at a time from each FileSet and passes the entire batch
+    # through the process_batch() method of each step in turn: see
+    # Step.process_batch(). That avoids most of the per-val overhead of the
+    # stack, at the cost of a change in execution order: each step sees the
+    # whole batch before the next step sees any of it. Hence the engine is
+    # not used when several steps have side effects (see can_batch()).
+    meta = opts.meta
+    n = opts.batch
+
+    def read(fset):
+        while not meta.stop:
+            lines = list(itertools.islice(fset, n))
+            if not lines:
+                break
+            meta._set_batch(lines)
+            process_batch(opts, 0, lines, list(meta.batch_range))
+
+    def forward(i, v):
+        vals, nums = compact_batch([v], [meta.line_num])
+        process_batch(opts, i, vals, nums)
+
+    do_process_fsets(opts, fsets, read, forward)
+
+def do_process_fused(opts, fsets):
+    # This function is the default alternative to do_process_lines(). It
+    # compiles the steps into a few tight loops (see nab.fuse) and then
+    # runs each FileSet through them.
+    read, forward = compile_steps(opts)
+    do_process_fsets(opts, fsets, read, forward)
+
+def process_batch(opts, i, vals, nums):
+    # Runs a batch of vals, along with their line numbers, through the
+    # steps, starting with the step at index i.
+    meta = opts.meta
+    steps = opts.steps
+    max_i = len(steps) - 1
+    while vals and i <= max_i:
+        s = steps[i]
+        meta.batch_nums = nums
+        try:
+            res = get_hook(s, 'process_batch')(s.opts, meta, vals)
+        except Exception:
+            write_step_error(meta, '<batch of {} vals>'.format(len(vals)))
+            raise
+        i += 1
+        if res is None or i > max_i:
+            break
+        elif None in res or any(map(ValIter.__instancecheck__, res)):
+            vals, nums = compact_batch(res, nums)
+        else:
+            vals = res
+
+def compact_batch(res, nums):
+    # Takes the list returned by a process_batch() method and the aligned
+    # line numbers. Drops the None values and expands the ValIter instances.
+    # Returns a new (VALS, NUMS) tuple.
+    vals2 = []
+    nums2 = []
+    for v, num in zip(res, nums):
+        if v is None:
+            continue
+        elif isinstance(v, ValIter):
+            # Like do_process_lines(), stop at the first None from a ValIter.
+            for x in v:
+                if x is None:
+                    break
+                vals2.append(x)
+                nums2.append(num)
+        else:
+            vals2.append(v)
+            nums2.append(num)
+    return (vals2, nums2)
+
 ####
 # Wrapper objects used by process_lines().
 #
@@ -382,28 +682,109 @@ class FileSetCollection(object):
 # Utility functions used to process a nab run.
 ####
 
-def get_known_steps():
-    mods = [core_steps] + get_user_step_modules()
+class StepRegistry(object):
+    # The steps known to nab, as a read-only mapping from step names to
+    # classes: those from core_steps, plus those from the modules listed in
+    # the NAB_MODULES environment variable, which take precedence.
+    #
+    # To keep startup fast, a user module is imported only if the run needs
+    # one of its steps. For that purpose, the step names of every user module
+    # are cached on disk, keyed by module path and modification time, so a
+    # module is imported just to learn its step names only when it changes.
+    # Operations on the registry as a whole (like items(), used by --help)
+    # import all of the modules.
+
+    def __init__(self, paths = None, cache_path = None):
+        self.core = get_module_steps(core_steps)
+        self.paths = get_user_step_paths() if paths is None else paths
+        self.cache_path = cache_path or get_registry_cache_path()
+        self.cache = None
+        self.modules = {}
+
+    def __getitem__(self, name):
+        for path in reversed(self.paths):
+            if name in self.get_names(path):
+                return self.get_steps(path)[name]
+        return self.core[name]
+
+    def __contains__(self, name):
+        try:
+            self[name]
+            return True
+        except KeyError:
+            return False
+
+    def items(self):
+        d = dict(self.core)
+        for path in self.paths:
+            d.update(self.get_steps(path))
+        return d.items()
+
+    def get_steps(self, path):
+        # Imports the module at the path (if not done already). Returns
+        # its steps, as a dict.
+        if path not in self.modules:
+            self.modules[path] = get_module_steps(import_from_path(path))
+        return self.modules[path]
+
+    def get_names(self, path):
+        # Returns the names of the steps defined by the module at the path:
+        # from the cache if it is current or, otherwise, by importing the
+        # module (and then updating the cache).
+        if self.cache is None:
+            self.cache = read_registry_cache(self.cache_path)
+        mtime = os.path.getmtime(path)
+        entry = self.cache.get(path)
+        if entry and entry['mtime'] == mtime:
+            return entry['names']
+        names = sorted(self.get_steps(path))
+        self.cache[path] = dict(mtime = mtime, names = names)
+        write_registry_cache(self.cache_path, self.cache)
+        return names
+
+def get_module_steps(m):
+    # Takes a module. Returns a dict mapping step names to the Step
+    # subclasses found in the module.
     return {
         x.NAME or name.lower() : x
-        for m in mods
-        for name, x in getmembers(m)
-        if isclass(x)
+        for name, x in sorted(vars(m).items())
+        if isinstance(x, type)
         and issubclass(x, Step)
         and x is not Step
     }
 
-def get_user_step_modules():
+def get_user_step_paths():
     s = os.environ.get('NAB_MODULES', None)
     if s:
         return [
-            import_from_path(p)
+            os.path.abspath(p)
             for p in s.split(os.pathsep)
             if os.path.isfile(p)
         ]
     else:
         return []
 
+def get_registry_cache_path():
+    return os.path.join(get_cache_dir(), 'steps.json')
+
+def read_registry_cache(path):
+    # A missing or unreadable cache is simply treated as empty.
+    try:
+        with open(path) as fh:
+            d = json.load(fh)
+        return d if isinstance(d, dict) else {}
+    except (IOError, OSError, ValueError):
+        return {}
+
+def write_registry_cache(path, cache):
+    # Writes to a temp file and then renames it, so that concurrent nab
+    # runs never see a partially written cache. Failures are ignored: the
+    # cache is merely an optimization.
+    try:
+        write_atomic(path, lambda fh: json.dump(cache, fh))
+    except (IOError, OSError):
+        pass
+
 def import_from_path(path):
     # Takes a string file path. Returns the imported module.
     name = os.path.basename(os.path.splitext(path)[0])
@@ -411,6 +792,8 @@ def import_from_path(path):
         spec = spec_from_file_location(name, path)
         m = module_from_spec(spec)
         spec.loader.exec_module(m)
+        # Register the module so its steps can be pickled (see --jobs).
+        sys.modules.setdefault(name, m)
         return m
     elif sys.version_info >= (3,3):
         return SourceFileLoader(name, path).load_module()
@@ -428,18 +811,57 @@ def exit(code, msg = None):
 # FileHandle and FileSet.
 ####
 
+class CompressedStreams(object):
+    # The compressed streams wrapping output handles that nab did not open,
+    # like STDOUT (see --compress). A handle gets one stream for the whole
+    # run, so that output written after its FileSets are closed, during the
+    # end phase, is part of the same stream. Closing the streams completes
+    # them, without closing the original handles.
+
+    def __init__(self):
+        self.streams = {}
+
+    def wrap(self, handle, fmt):
+        k = id(handle)
+        if k not in self.streams:
+            self.streams[k] = (handle, wrap_compressed(handle, fmt))
+        return self.streams[k][1]
+
+    def get(self, handle):
+        # The stream wrapping a handle, or None.
+        return self.streams.get(id(handle), (None, None))[1]
+
+    def close(self):
+        for handle, stream in self.streams.values():
+            stream.close()
+            handle.flush()
+        self.streams = {}
+
 class FileHandle(object):
     # An object to hold a file handle and metadata associated with it.
 
-    def __init__(self, path = None, handle = None, mode = None, **open_kws):
+    def __init__(self, path = None, handle = None, mode = None,
+                 compress = None, **open_kws):
         if not path:
             raise ValueError('FileHandle.path is required')
         self.path = path
         self.handle = handle
         self.mode = mode
+        # The compression format (gz, bz2, or xz) used when nab opens the
+        # file. If None, it is inferred from the file: see nab.compression.
+        # If False, the file is never treated as compressed.
+        self.compress = compress
         self.open_kws = open_kws or {}
         self.should_close = not handle
         self.temp_path = None
+        # For output and error: the Writer used by the steps.
+        self.writer = None
+        # For the standard streams: the name of the sys attribute (stdin,
+        # stdout, or stderr). The latter two are redirected to the Writer.
+        self.stream = None
+        # For output compared with the file it will replace: the
+        # CompareWriter (see --skip-unchanged).
+        self.compare = None
 
     def __str__(self):
         return repr(self)
@@ -462,16 +884,39 @@ class FileSet(object):
     OUT = 'out'
     ERR = 'err'
 
+    # The handles are looked up in the sys module when needed,
+    # so that callers can redirect the standard streams.
     STREAMS = {
-        INP: dict(path = ':STDIN:',  handle = sys.stdin,  mode = 'r'),
-        OUT: dict(path = ':STDOUT:', handle = sys.stdout, mode = 'w'),
-        ERR: dict(path = ':STDERR:', handle = sys.stderr, mode = 'w'),
+        INP: dict(path = ':STDIN:',  handle = 'stdin',  mode = 'r'),
+        OUT: dict(path = ':STDOUT:', handle = 'stdout', mode = 'w'),
+        ERR: dict(path = ':STDERR:', handle = 'stderr', mode = 'w'),
     }
 
-    def __init__(self, inp, out = None, err = None):
+    def __init__(self, inp, out = None, err = None,
+                 binary = False, flush = None, compress = None,
+                 fsync = False, skip_unchanged = False, streams = None):
         self.inp = self.new_fh(self.INP, inp)
         self.out = self.new_fh(self.OUT, out)
         self.err = self.new_fh(self.ERR, err)
+        # A (START, STOP) tuple of byte offsets, if only part
+        # of the input file should be read (see --split).
+        self.inp_range = None
+        # Whether to read the input as bytes (see --bytes).
+        self.binary = binary
+        # The flush policy for output and error (see --flush).
+        self.flush = flush
+        # The compression format for output (see --compress), and the
+        # compressed streams for handles that nab did not open.
+        self.compress = compress
+        self.streams = CompressedStreams() if streams is None else streams
+        # For output written over the input (see --in-place): whether to
+        # sync it to disk before replacing the input, and whether to leave
+        # the input untouched if the output is the same.
+        self.fsync = fsync
+        self.skip_unchanged = skip_unchanged
+        # (NAME, HANDLE) tuples for the standard streams redirected
+        # to the Writers while the FileSet is open.
+        self.redirected = []
 
     def new_fh(self, stream, d):
         # Determine which stream is relevant: inp, out, err.
@@ -494,11 +939,18 @@ class FileSet(object):
         else:
             # Otherwise, we will use the standard streams.
             # TODO: figure out if mode and/or open_kws make sense here.
-            return FileHandle(SD['path'], SD['handle'], mode, **d)
+            handle = getattr(sys, SD['handle'])
+            if isinstance(handle, StreamProxy):
+                handle = handle.orig
+            fh = FileHandle(SD['path'], handle, mode, **d)
+            fh.stream = SD['handle']
+            return fh
 
     @staticmethod
-    def raw_fset(path):
+    def raw_fset(path, in_place = False):
         d = {} if path is None else dict(path = path)
+        if in_place and path is not None:
+            return dict(inp = d, out = dict(path = path))
         return dict(inp = d)
 
     def __str__(self):
@@ -527,8 +979,21 @@ class FileSet(object):
 
         # Input.
         if not ib:
-            # Just open the file.
-            self.open_fh(ifh)
+            if self.inp_range:
+                # Open the file for reading a range of bytes.
+                self.open_range(ifh)
+            elif self.binary:
+                # Memory-map the file, if possible.
+                self.open_binary(ifh)
+            else:
+                # Just open the file.
+                self.open_fh(ifh)
+        elif self.get_compression(ifh):
+            # Decompress STDIN (see get_compression()).
+            ifh.handle = read_compressed(ifh.handle, self.get_compression(ifh), self.binary)
+        elif self.binary:
+            # Read from the binary buffer underlying a text handle.
+            ifh.handle = getattr(ifh.handle, 'buffer', ifh.handle)
 
         # Output.
         if not ob:
@@ -548,31 +1013,207 @@ class FileSet(object):
                 # if the input/error paths are the same.
                 self.open_or_temp(efh, ifh)
 
-    def close_handles(self, *xs):
+        # Compress output written to a handle that nab did not open. The
+        # compressed stream for a handle is shared by the FileSets of the run
+        # and completed after the end phase (see CompressedStreams).
+        fmt = self.compress if ofh.compress is None else ofh.compress
+        if ob and fmt:
+            orig = ofh.handle
+            ofh.handle = self.streams.wrap(orig, fmt)
+            if efh.handle is orig:
+                efh.handle = ofh.handle
+
+        # Writers for output and error, shared if they use the same handle.
+        ofh.writer = Writer(ofh.handle, self.flush)
+        if efh.handle is ofh.handle:
+            efh.writer = ofh.writer
+        else:
+            efh.writer = Writer(efh.handle, self.flush)
+
+        # While the FileSet is open, text written to the standard streams
+        # (for example, by print() in user code) goes through the same
+        # Writers, so that it stays in order with the output of the steps.
+        self.redirected = []
+        for fh in (ofh, efh):
+            if fh.stream and fh.stream not in dict(self.redirected):
+                orig = getattr(sys, fh.stream)
+                self.redirected.append((fh.stream, orig))
+                setattr(sys, fh.stream, StreamProxy(orig, fh.writer))
+
+    def close_handles(self, ok = True):
+        # Output written to a temp file replaces its target only if ok. The
+        # method can be called again: later calls have no effect on files.
+        for name, orig in reversed(self.redirected):
+            setattr(sys, name, orig)
+        self.redirected = []
         for fh in (self.inp, self.out, self.err):
+            if fh.writer:
+                fh.writer.close()
+                fh.writer = None
             if fh.should_close and fh.handle:
                 fh.handle.close()
+        for fh in (self.out, self.err):
+            if fh.temp_path:
+                self.replace_with_temp(fh, ok)
 
-    def open_fh(self, fh, path = None):
+    def open_fh(self, fh, path = None, mode = None):
         # PY2: open(name, mode, buffering)
         # PY3: open(file, mode, buffering, encoding, errors, newline, closefd, opener).
-        fh.handle = open(path or fh.path, fh.mode, **fh.open_kws)
+        path = path or fh.path
+        mode = mode or fh.mode
+        fmt = self.get_compression(fh)
+        if fmt:
+            fh.handle = open_compressed(path, fmt, mode, **fh.open_kws)
+        else:
+            fh.handle = open(path, mode, **fh.open_kws)
+
+    def get_compression(self, fh):
+        # Returns the compression format for a FileHandle that nab opens,
+        # or for STDIN, whose first bytes are peeked at. For output written
+        # to a temp file, the format comes from the final path -- which, for
+        # in-place edits, is the input path.
+        if fh.compress is not None:
+            return fh.compress or None
+        elif fh.handle and fh.stream == 'stdin':
+            return get_stream_compression(getattr(fh.handle, 'buffer', fh.handle))
+        elif fh is self.inp:
+            return get_compression(fh.path, magic = True)
+        else:
+            return get_compression(fh.path) or (fh is self.out and self.compress)
+
+    def get_tail_range(self, n):
+        # Returns a (START, STOP) range covering the last n lines of the
+        # input file -- or None if the input is not an uncompressed regular
+        # file opened by nab, or if its lines might not end with newline
+        # bytes, which is required for scanning backward from the end.
+        fh = self.inp
+        ok = (
+            not fh.handle and
+            not self.inp_range and
+            os.path.isfile(fh.path) and
+            not self.get_compression(fh)
+        )
+        if not ok:
+            return None
+        text = not (self.binary or 'b' in fh.mode)
+        if text:
+            enc = fh.open_kws.get('encoding') or locale.getpreferredencoding(False)
+            if '\n'.encode(enc) != b'\n':
+                return None
+        with open(fh.path, 'rb') as f:
+            start = tail_offset(f, n, text)
+            stop = f.seek(0, os.SEEK_END)
+        return None if start is None else (start, stop)
+
+    def open_range(self, fh):
+        raw = RangeReader(open(fh.path, 'rb'), *self.inp_range)
+        if self.binary:
+            fh.handle = io.BufferedReader(raw)
+            return
+        kws = {
+            k : v
+            for k, v in fh.open_kws.items()
+            if k in ('encoding', 'errors', 'newline')
+        }
+        fh.handle = io.TextIOWrapper(io.BufferedReader(raw), **kws)
+
+    def open_binary(self, fh):
+        if self.get_compression(fh):
+            self.open_fh(fh, mode = 'rb')
+            return
+        f = open(fh.path, 'rb')
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        except (ValueError, mmap.error, OSError):
+            # Empty files and non-regular files cannot be mapped.
+            fh.handle = f
+        else:
+            fh.handle = MappedReader(f, mm)
 
     def open_or_reuse(self, fh, other):
         if fh.path == other.path:
             fh.handle = other.handle
         else:
-            self.open_fh(self, fh)
+            self.open_fh(fh)
 
     def open_or_temp(self, fh, other):
         if fh.path == other.path:
-            fh.temp_path = temp_file_path()
-            self.open_fh(fh, path = fh.temp_path)
+            self.open_temp(fh)
         else:
             self.open_fh(fh)
 
+    def open_temp(self, fh):
+        # For output that will replace a file: opens a temp file in the same
+        # directory, so that renaming it over the file is atomic and needs
+        # no copying. It gets the mode and, if possible, the owner of the
+        # file. For a symlink, the file it points to is the one replaced.
+        target = os.path.realpath(fh.path)
+        d, name = os.path.split(target)
+        fd, fh.temp_path = tempfile.mkstemp(dir = d, prefix = '.' + name + '.', suffix = '.nab')
+        os.close(fd)
+        try:
+            st = os.stat(target)
+        except OSError:
+            st = None
+        if st:
+            os.chmod(fh.temp_path, stat.S_IMODE(st.st_mode))
+            try:
+                os.chown(fh.temp_path, st.st_uid, st.st_gid)
+            except (AttributeError, OSError):
+                pass
+        if self.skip_unchanged and st:
+            self.open_compare(fh, target)
+        else:
+            self.open_fh(fh, path = fh.temp_path)
+
+    def open_compare(self, fh, target):
+        # For --skip-unchanged: output to the temp file goes through a
+        # CompareWriter, which compares it with the target as it is written.
+        # For compressed files, the uncompressed bytes are compared.
+        fmt = self.get_compression(fh)
+        def open_target():
+            return open_compressed(target, fmt, 'rb') if fmt else open(target, 'rb')
+        try:
+            orig = open_target()
+        except (IOError, OSError):
+            self.open_fh(fh, path = fh.temp_path)
+            return
+        tmp = fh.temp_path
+        out = open_compressed(tmp, fmt, 'wb') if fmt else open(tmp, 'wb')
+        fh.compare = CompareWriter(out, orig, open_target)
+        buf = io.BufferedWriter(fh.compare)
+        fh.handle = buf if 'b' in fh.mode else text_wrapper(buf, fh.open_kws)
+
+    def replace_with_temp(self, fh, ok):
+        # Renames the temp file for a FileHandle over its target or, if the
+        # output is unwanted or unchanged (see --skip-unchanged), deletes it.
+        tmp = fh.temp_path
+        unchanged = fh.compare is not None and fh.compare.unchanged
+        fh.temp_path = None
+        fh.compare = None
+        target = os.path.realpath(fh.path)
+        try:
+            if unchanged:
+                ok = False
+            if ok:
+                if self.fsync:
+                    sync_path(tmp)
+                replace_file(tmp, target)
+                if self.fsync:
+                    # Best effort: some platforms, like Windows, cannot
+                    # open a directory to sync its entries.
+                    try:
+                        sync_path(os.path.dirname(target))
+                    except OSError:
+                        pass
+        finally:
+            if not ok:
+                os.remove(tmp)
+
     def __iter__(self):
-        return self
+        # Engines that simply loop over the input lines can bypass
+        # the FileSet and iterate over the handle directly.
+        return iter(self.inp.handle)
 
     def __next__(self):
         return next(self.inp.handle)
@@ -580,7 +1221,312 @@ class FileSet(object):
     def next(self):
         return self.__next__()
 
-def temp_file_path(n = 30):
-    suffix = ''.join(random.choices(string.ascii_lowercase, k = n))
-    return '/tmp/nab-' + suffix
+class MappedReader(object):
+    # An iterator over the lines of a memory-mapped file.
+
+    def __init__(self, fh, mm):
+        self.fh = fh
+        self.mm = mm
+
+    def __iter__(self):
+        return iter(self.mm.readline, b'')
+
+    def __next__(self):
+        line = self.mm.readline()
+        if line:
+            return line
+        else:
+            raise StopIteration
+
+    def next(self):
+        return self.__next__()
+
+    def close(self):
+        self.mm.close()
+        self.fh.close()
+
+class RangeReader(io.RawIOBase):
+    # A readable binary stream over a range of bytes in a file.
+
+    def __init__(self, fh, start, stop):
+        self.fh = fh
+        self.fh.seek(start)
+        self.remaining = stop - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = min(len(b), self.remaining)
+        if n <= 0:
+            return 0
+        n = self.fh.readinto(memoryview(b)[:n])
+        self.remaining -= n
+        return n
+
+    def close(self):
+        self.fh.close()
+        super(RangeReader, self).close()
+
+class CompareWriter(io.RawIOBase):
+    # A writable binary stream for output that will replace a file (see
+    # --skip-unchanged). It compares the bytes written with those read from
+    # the file, writing nothing while they match. At the first difference,
+    # it copies the matching bytes from the file and then writes through.
+    # If the output matches the whole file, nothing is ever written.
+
+    def __init__(self, out, orig, reopen):
+        # Takes the binary handle to write to, a binary handle to read the
+        # file from, and a function to open the latter again.
+        self.out = out
+        self.orig = orig
+        self.reopen = reopen
+        self.matched = 0
+        self.same = True
+        self.unchanged = False
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        b = bytes(b)
+        if self.same:
+            if self.read_orig(len(b)) == b:
+                self.matched += len(b)
+                return len(b)
+            self.diverge()
+        self.out.write(b)
+        return len(b)
+
+    def read_orig(self, n):
+        try:
+            return self.orig.read(n)
+        except Exception:
+            # A file that cannot be read (for example, corrupt
+            # compressed data) does not match.
+            return None
+
+    def diverge(self):
+        self.same = False
+        self.orig.close()
+        remaining = self.matched
+        with self.reopen() as fh:
+            while remaining:
+                data = fh.read(min(COMPARE_BUFSIZE, remaining))
+                if not data:
+                    break
+                self.out.write(data)
+                remaining -= len(data)
+
+    def close(self):
+        if not self.closed:
+            if self.same:
+                if self.read_orig(1) != b'':
+                    self.diverge()
+                else:
+                    self.unchanged = True
+                    self.orig.close()
+            self.out.close()
+        super(CompareWriter, self).close()
+
+def tail_offset(fh, n, text = False):
+    # Takes a binary file handle. Returns the byte offset where its last n
+    # lines begin, found by reading blocks backward from the end. In text
+    # mode, Python also ends lines at a lone carriage return: if any of the
+    # blocks read contain one, returns None.
+    end = fh.seek(0, os.SEEK_END)
+    if n <= 0:
+        return end
+    # The newline at the end of the file, if any, ends the last line
+    # rather than starting a new one: that is, it must be skipped.
+    need = n
+    if end:
+        fh.seek(end - 1)
+        need += fh.read(1) == b'\n'
+    pos = end
+    while pos > 0:
+        size = min(TAIL_BLOCK, pos)
+        pos -= size
+        fh.seek(pos)
+        block = fh.read(size)
+        if text and block.count(b'\r') != block.count(b'\r\n'):
+            return None
+        i = size
+        while True:
+            i = block.rfind(b'\n', 0, i)
+            if i < 0:
+                break
+            need -= 1
+            if need == 0:
+                return pos + i + 1
+    return 0
+
+# The size of the blocks read by tail_offset().
+TAIL_BLOCK = 2 ** 16
+
+class Writer(object):
+    # Collects the text written to an output handle, passing it along in
+    # large chunks via writelines(). The flush policy determines when that
+    # happens, beyond the point where the buffer is full:
+    #
+    # - 'block': only then (the default for files and pipes).
+    # - 'line': after every write (the default for terminals).
+    # - A number: every that many seconds, if any output is pending. A
+    #   background thread does it, so that output does not wait on input.
+    #
+    # Bytes can be written too (see --bytes). They go to the binary buffer
+    # underlying the handle, with the writer flushing any pending output
+    # whenever it switches between text and bytes, so that order is kept.
+
+    SIZE = 2 ** 16
+
+    def __init__(self, handle, policy = None):
+        if policy is None:
+            isatty = getattr(handle, 'isatty', None)
+            policy = 'line' if isatty and isatty() else 'block'
+        self.handle = handle
+        self.interval = (
+            None if policy == 'block' else
+            0 if policy == 'line' else
+            float(policy)
+        )
+        self.chunks = []
+        self.size = 0
+        self.binary = False
+        # For the timed policy: the lock shared with the flushing thread.
+        self.lock = None
+        self.done = None
+        self.thread = None
+        if self.interval:
+            self.lock = threading.RLock()
+            self.done = threading.Event()
+            self.thread = threading.Thread(target = self.tick)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def write(self, text):
+        if self.binary:
+            self.switch()
+        self.add(text)
+
+    def write_bytes(self, data):
+        if not self.binary:
+            self.switch()
+        self.add(data)
+
+    def add(self, x):
+        if self.lock:
+            with self.lock:
+                return self.append(x)
+        self.append(x)
+
+    def append(self, x):
+        self.chunks.append(x)
+        self.size += len(x)
+        if self.size >= self.SIZE:
+            self.flush(self.interval is not None)
+        elif self.interval == 0:
+            self.flush(True)
+
+    def print(self, *xs, **kws):
+        # Like the built-in print(), but writing to the buffer.
+        sep = kws.get('sep')
+        end = kws.get('end')
+        text = (' ' if sep is None else sep).join(map(str, xs))
+        self.write(text + ('\n' if end is None else end))
+        if kws.get('flush'):
+            self.flush(True)
+
+    def flush(self, handle = False):
+        # Writes the buffered chunks to the handle -- and, if requested,
+        # flushes the handle itself.
+        if self.lock:
+            with self.lock:
+                return self.flush_chunks(handle)
+        self.flush_chunks(handle)
+
+    def flush_chunks(self, handle):
+        if self.chunks:
+            fh = self.handle
+            if self.binary:
+                fh = getattr(fh, 'buffer', fh)
+            fh.writelines(self.chunks)
+            self.chunks = []
+            self.size = 0
+        if handle:
+            self.handle.flush()
+
+    def tick(self):
+        # Runs in the flushing thread of the timed policy.
+        while not self.done.wait(self.interval):
+            with self.lock:
+                if self.chunks:
+                    self.flush_chunks(True)
+
+    def switch(self):
+        # Switches between text and bytes.
+        self.flush(True)
+        self.binary = not self.binary
+
+    def close(self):
+        if self.thread:
+            self.done.set()
+            self.thread.join()
+            self.thread = None
+        self.flush(not getattr(self.handle, 'closed', False))
+
+class StreamProxy(object):
+    # Stands in for sys.stdout or sys.stderr while a FileSet is open,
+    # passing writes to its Writer. Anything else goes to the original.
+
+    def __init__(self, orig, writer):
+        self.orig = orig
+        self.writer = writer
+        self.buffer = BufferProxy(getattr(orig, 'buffer', orig), writer)
+
+    def write(self, text):
+        self.writer.write(text)
+        return len(text)
+
+    def writelines(self, texts):
+        for text in texts:
+            self.writer.write(text)
+
+    def flush(self):
+        self.writer.flush(True)
+
+    def __getattr__(self, name):
+        return getattr(self.orig, name)
+
+class BufferProxy(object):
+    # The binary buffer of a StreamProxy.
+
+    def __init__(self, orig, writer):
+        self.orig = orig
+        self.writer = writer
+
+    def write(self, data):
+        self.writer.write_bytes(data)
+        return len(data)
+
+    def writelines(self, datas):
+        for data in datas:
+            self.writer.write_bytes(data)
+
+    def flush(self):
+        self.writer.flush(True)
+
+    def __getattr__(self, name):
+        return getattr(self.orig, name)
+
+def sync_path(path):
+    # Flushes a file, or the entries of a directory, to disk.
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+# The size of the blocks copied by CompareWriter.
+COMPARE_BUFSIZE = 2 ** 20
 
@@ -0,0 +1,124 @@
+####
+# Reading and writing compressed files.
+#
+# Input files compressed with gzip, bzip2, or xz are detected by their
+# extension or, failing that, by their magic bytes, and are decompressed
+# as they are read. So is STDIN, by its magic bytes. Output is compressed when requested: see --compress
+# and the compress key of the FileHandle dicts returned by discover().
+#
+# The codec modules are imported only when needed, to keep them out of the
+# startup time of nab.
+####
+
+from __future__ import absolute_import, unicode_literals, print_function
+
+import io
+import os
+
+# Supported formats: the codec module and the open() keyword arguments.
+FORMATS = dict(
+    gz = ('gzip', dict(compresslevel = 6)),
+    bz2 = ('bz2', {}),
+    xz = ('lzma', {}),
+)
+
+EXTENSIONS = {
+    '.gz': 'gz',
+    '.bz2': 'bz2',
+    '.xz': 'xz',
+}
+
+MAGIC = (
+    (b'\x1f\x8b', 'gz'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+)
+
+# The buffer size for reading compressed input.
+BUFSIZE = 2 ** 18
+
+# The keyword arguments of open() that apply to the text layer.
+TEXT_KWS = ('encoding', 'errors', 'newline')
+
+def get_compression(path, magic = False):
+    # Takes a file path. Returns its compression format, based on its
+    # extension or, if requested, the first bytes of the file -- or
+    # None if it does not appear to be compressed.
+    ext = os.path.splitext(path)[1].lower()
+    if ext in EXTENSIONS:
+        return EXTENSIONS[ext]
+    elif magic and os.path.isfile(path):
+        with open(path, 'rb') as fh:
+            return get_magic(fh.read(6))
+    return None
+
+def get_stream_compression(buf):
+    # Takes a binary handle, such as the buffer of STDIN. Returns its
+    # compression format, based on its first bytes, or None. The bytes are
+    # peeked at rather than read, so handles without peek() return None.
+    peek = getattr(buf, 'peek', None)
+    if peek is None:
+        return None
+    try:
+        return get_magic(peek(6))
+    except (IOError, OSError, ValueError):
+        return None
+
+def get_magic(head):
+    # Returns the compression format indicated by the first bytes of a file.
+    for prefix, fmt in MAGIC:
+        if head.startswith(prefix):
+            return fmt
+    return None
+
+def open_compressed(path, fmt, mode, **open_kws):
+    # Takes the same arguments as open(), plus a compression format. Returns
+    # a file handle, in text mode unless the mode includes 'b'.
+    if mode.startswith('r'):
+        raw = get_codec(fmt, path, 'rb')
+        fh = io.BufferedReader(raw, buffer_size = BUFSIZE)
+    else:
+        fh = get_codec(fmt, path, mode[0] + 'b')
+    return fh if 'b' in mode else text_wrapper(fh, open_kws)
+
+def read_compressed(handle, fmt, binary = False):
+    # Takes a handle opened for reading (text with an underlying buffer, or
+    # bytes) and a compression format. Returns a handle that decompresses
+    # what it reads from the original, in text mode unless binary is true.
+    buf = getattr(handle, 'buffer', handle)
+    raw = get_codec(fmt, buf, 'rb')
+    fh = io.BufferedReader(raw, buffer_size = BUFSIZE)
+    if binary:
+        return fh
+    kws = dict(
+        encoding = getattr(handle, 'encoding', None),
+        errors = getattr(handle, 'errors', None),
+    )
+    return text_wrapper(fh, kws)
+
+def wrap_compressed(handle, fmt):
+    # Takes a handle opened for writing and a compression format. Returns
+    # a text handle that compresses what is written to it before passing
+    # it along to the original. Closing the new handle completes the
+    # compressed stream, without closing the original.
+    handle.flush()
+    buf = getattr(handle, 'buffer', handle)
+    enc = getattr(handle, 'encoding', None)
+    return text_wrapper(get_codec(fmt, buf, 'wb'), dict(encoding = enc))
+
+def get_codec(fmt, f, mode):
+    # Opens a path or file object via the codec module for the format.
+    try:
+        name, kws = FORMATS[fmt]
+    except KeyError:
+        raise ValueError('Invalid compression format: {}'.format(fmt))
+    mod = __import__(name)
+    return mod.open(f, mode, **kws)
+
+def text_wrapper(fh, open_kws):
+    kws = {
+        k : v
+        for k, v in open_kws.items()
+        if k in TEXT_KWS and v is not None
+    }
+    return io.TextIOWrapper(fh, **kws)
@@ -1,14 +1,25 @@
 from __future__ import absolute_import, unicode_literals, print_function
 
 import collections
+import csv
+import heapq
 import json
+import locale
+import operator
 import random
 import re
 import functools
+import itertools
+import pickle
 import sys
 
+from .jsonl import DECODER, MISSING, Projection, to_json, to_text
+from .patterns import PatternSet, is_literal, read_patterns
+from .sketches import BloomFilter, SeenSet, SpaceSaving
+from .spill import ExternalSorter
+from .stats import NumberStats, get_numpy, parse_number
 from .step import Step
-from .utils import ValIter
+from .utils import ValIter, compile_cached, parse_size
 
 ####
 # Printing and writing.
@@ -18,20 +29,54 @@ class Pr(Step):
 
     DESC = 'Print VAL'
     USAGE = '.'
+    SCOPE = None
+    BYTES = True
+    EFFECTS = True
 
     def process(self, opts, meta, val):
-        self.out(val)
+        if self.bytes and isinstance(val, bytes):
+            self.write(val + b'\n')
+        else:
+            self.out(decode_val(val) if self.bytes else val)
         return val
 
+    def process_batch(self, opts, meta, vals):
+        if self.bytes:
+            return Step.process_batch(self, opts, meta, vals)
+        self.out('\n'.join(map(str, vals)))
+        return vals
+
+    def fuse(self, opts):
+        if self.bytes:
+            return (FUSE_PR_BYTES, dict(out = self.out, decode = decode_val))
+        return ("meta.out.writer.write(str(val) + '\\n')", {})
+
 class Wr(Step):
 
     DESC = 'Print VAL'
     USAGE = '.'
+    SCOPE = None
+    BYTES = True
+    EFFECTS = True
 
     def process(self, opts, meta, val):
-        self.out(val, end = '')
+        if self.bytes and isinstance(val, bytes):
+            self.write(val)
+        else:
+            self.out(decode_val(val) if self.bytes else val, end = '')
         return val
 
+    def process_batch(self, opts, meta, vals):
+        if self.bytes:
+            return Step.process_batch(self, opts, meta, vals)
+        self.out(''.join(map(str, vals)), end = '')
+        return vals
+
+    def fuse(self, opts):
+        if self.bytes:
+            return (FUSE_WR_BYTES, dict(out = self.out, decode = decode_val))
+        return ('meta.out.writer.write(str(val))', {})
+
 ####
 # Chomping and stripping.
 ####
@@ -40,14 +85,31 @@ class Chomp(Step):
 
     DESC = 'Right-strip newline from VAL'
     USAGE = '.'
+    STATELESS = True
+    MAP = True
+    SCOPE = None
+    BYTES = True
+
+    def begin(self, opts):
+        opts.nl = self.as_bytes('\n')
 
     def process(self, opts, meta, val):
-        return val.rstrip('\n')
+        return val.rstrip(opts.nl)
+
+    def process_batch(self, opts, meta, vals):
+        nl = opts.nl
+        return [v.rstrip(nl) for v in vals]
+
+    def fuse(self, opts):
+        return ('val = val.rstrip({nl})', dict(nl = opts.nl))
 
 class Strip(Step):
 
     DESC = 'Strip VAL'
     USAGE = '[CHARS]'
+    STATELESS = True
+    MAP = True
+    SCOPE = None
 
     OPTS_CONFIG = [
         's',
@@ -57,26 +119,53 @@ class Strip(Step):
     def process(self, opts, meta, val):
         return val.strip(opts.s)
 
+    def process_batch(self, opts, meta, vals):
+        s = opts.s
+        return [v.strip(s) for v in vals]
+
+    def fuse(self, opts):
+        return ('val = val.strip({s})', dict(s = opts.s))
+
 class LStrip(Step):
 
     DESC = 'Left-strip VAL'
     USAGE = '[CHARS]'
+    STATELESS = True
+    MAP = True
+    SCOPE = None
 
     OPTS_CONFIG = Strip.OPTS_CONFIG
 
     def process(self, opts, meta, val):
         return val.lstrip(opts.s)
 
+    def process_batch(self, opts, meta, vals):
+        s = opts.s
+        return [v.lstrip(s) for v in vals]
+
+    def fuse(self, opts):
+        return ('val = val.lstrip({s})', dict(s = opts.s))
+
 class RStrip(Step):
 
     DESC = 'Right-strip VAL'
     USAGE = '[CHARS]'
+    STATELESS = True
+    MAP = True
+    SCOPE = None
 
     OPTS_CONFIG = Strip.OPTS_CONFIG
 
     def process(self, opts, meta, val):
         return val.rstrip(opts.s)
 
+    def process_batch(self, opts, meta, vals):
+        s = opts.s
+        return [v.rstrip(s) for v in vals]
+
+    def fuse(self, opts):
+        return ('val = val.rstrip({s})', dict(s = opts.s))
+
 ####
 # Splitting and joining.
 ####
@@ -85,6 +174,10 @@ class Split(Step):
 
     DESC = 'Split VAL'
     USAGE = '[RGX]'
+    STATELESS = True
+    MAP = True
+    SCOPE = None
+    BYTES = True
 
     OPTS_CONFIG = [
         'rgx',
@@ -92,7 +185,7 @@ class Split(Step):
     ]
 
     def begin(self, opts):
-        opts.rgx = re.compile(opts.rgx) if opts.rgx else None
+        opts.rgx = re.compile(self.as_bytes(opts.rgx)) if opts.rgx else None
 
     def process(self, opts, meta, val):
         if opts.rgx:
@@ -100,10 +193,25 @@ class Split(Step):
         else:
             return val.split()
 
+    def process_batch(self, opts, meta, vals):
+        if opts.rgx:
+            return list(map(opts.rgx.split, vals))
+        else:
+            return [v.split() for v in vals]
+
+    def fuse(self, opts):
+        if opts.rgx:
+            return ('val = {split}(val)', dict(split = opts.rgx.split))
+        else:
+            return ('val = val.split()', {})
+
 class Join(Step):
 
     DESC = 'Join elements of VAL'
     USAGE = 'JOIN'
+    STATELESS = True
+    MAP = True
+    SCOPE = None
 
     OPTS_CONFIG = [
         'j',
@@ -113,6 +221,12 @@ class Join(Step):
     def process(self, opts, meta, val):
         return opts.j.join(val)
 
+    def process_batch(self, opts, meta, vals):
+        return list(map(opts.j.join, vals))
+
+    def fuse(self, opts):
+        return ('val = {join}(val)', dict(join = opts.j.join))
+
 ####
 # Indexing.
 ####
@@ -121,6 +235,9 @@ class Index(Step):
 
     DESC = 'Get element at index from VAL'
     USAGE = 'I [--strict]'
+    STATELESS = True
+    SCOPE = None
+    BYTES = True
 
     OPTS_CONFIG = [
         'i',
@@ -129,14 +246,37 @@ class Index(Step):
         dict(action = 'store_true'),
     ]
 
+    # In bytes mode (see --bytes), indexing a line gets a one-byte bytes
+    # value rather than an int, like indexing a str gets a str.
+
     def process(self, opts, meta, val):
         try:
-            return val[opts.i]
+            v = val[opts.i]
         except IndexError:
             if opts.strict:
                 raise
             else:
                 return None
+        if self.bytes and isinstance(val, bytes):
+            return val[opts.i : opts.i + 1 or None]
+        return v
+
+    def process_batch(self, opts, meta, vals):
+        i = opts.i
+        if self.bytes:
+            return [self.process(opts, meta, v) for v in vals]
+        try:
+            return [v[i] for v in vals]
+        except IndexError:
+            return [self.process(opts, meta, v) for v in vals]
+
+    def fuse(self, opts):
+        if self.bytes:
+            return (FUSE_FILTER, dict(f = functools.partial(self.process, opts, None)))
+        elif opts.strict:
+            return ('val = val[{i}]\nif val is None:\n    continue', dict(i = opts.i))
+        else:
+            return (FUSE_INDEX, dict(i = opts.i))
 
 class RIndex(Index):
 
@@ -163,6 +303,266 @@ class Range(Index):
     def process(self, opts, meta, val):
         return val[opts.i : opts.j : opts.s]
 
+    def process_batch(self, opts, meta, vals):
+        sl = slice(opts.i, opts.j, opts.s)
+        return [v[sl] for v in vals]
+
+    def fuse(self, opts):
+        return ('val = val[{sl}]', dict(sl = slice(opts.i, opts.j, opts.s)))
+
+class Field(Step):
+
+    DESC = 'Get fields from VAL, splitting only as needed'
+    USAGE = 'I... [-d DELIM [--rgx]]'
+    STATELESS = True
+    SCOPE = None
+    BYTES = True
+
+    OPTS_CONFIG = [
+        'idxs',
+        dict(nargs = '+', metavar = 'I'),
+        '-d',
+        dict(metavar = 'DELIM'),
+        '--rgx',
+        dict(action = 'store_true'),
+    ]
+
+    # Equivalent to split followed by index, with fields separated by
+    # whitespace, by DELIM, or by matches of the regex DELIM (--rgx). The
+    # indexes can also be given together, as in 0,4,-1. With several, the
+    # new val is a tuple. A val lacking any of the fields is filtered out.
+    #
+    # Instead of splitting the whole val, the step stops after the highest
+    # index or, if every index is negative, splits from the right. A val
+    # with fields beyond those is not split any further.
+
+    def begin(self, opts):
+        txt = ','.join(opts.idxs)
+        try:
+            idxs = [int(i) for i in txt.split(',')]
+        except ValueError:
+            raise ValueError('{}: invalid indexes: {}'.format(self.name, txt))
+        d = self.as_bytes(opts.d)
+        rgx = None
+        if opts.rgx:
+            if d is None:
+                raise ValueError('{}: --rgx requires -d'.format(self.name))
+            if not is_literal(d):
+                rgx = re.compile(d)
+        lo = min(idxs)
+        hi = max(idxs)
+        if lo >= 0:
+            method = 'split'
+            n = hi + 1
+        elif hi < 0 and rgx is None:
+            method = 'rsplit'
+            n = - lo
+        else:
+            method = 'split'
+            n = -1
+        if rgx:
+            # A regex can only split from the left, and 0 means no limit.
+            opts.split = functools.partial(rgx.split, maxsplit = max(n, 0))
+            opts.expr = '{split}(val)'
+        else:
+            opts.split = operator.methodcaller(method, d, n)
+            opts.expr = 'val.{}({{d}}, {{n}})'.format(method)
+        opts.d = d
+        opts.n = n
+        opts.idxs = idxs
+        opts.get = operator.itemgetter(*idxs)
+
+    def process(self, opts, meta, val):
+        try:
+            return opts.get(opts.split(val))
+        except IndexError:
+            return None
+
+    def process_batch(self, opts, meta, vals):
+        get = opts.get
+        split = opts.split
+        try:
+            return [get(split(v)) for v in vals]
+        except IndexError:
+            return [self.process(opts, meta, v) for v in vals]
+
+    def fuse(self, opts):
+        names = dict(split = opts.split, d = opts.d, n = opts.n, get = opts.get)
+        if len(opts.idxs) == 1:
+            code = 'val = {}[{}]'.format(opts.expr, opts.idxs[0])
+        else:
+            code = 'val = {{get}}({})'.format(opts.expr)
+        return (FUSE_FIELD.format(code = code), names)
+
+####
+# Delimited data.
+####
+
+class Csv(Step):
+
+    DESC = 'Get columns from VAL, a CSV record'
+    USAGE = 'COL... [-d DELIM] [-q CHAR] [--no-quote] [--header]'
+    DELIM = ','
+
+    OPTS_CONFIG = [
+        'cols',
+        dict(nargs = '+', metavar = 'COL'),
+        '-d',
+        dict(metavar = 'DELIM'),
+        '-q',
+        dict(default = '"', metavar = 'CHAR'),
+        '--no-quote',
+        dict(action = 'store_true'),
+        '--header',
+        dict(action = 'store_true'),
+    ]
+
+    # Each COL is a column index (from zero) or, if the first line of each
+    # file is a header (--header), a column name. With one COL, the new val
+    # is the value of that column (or None, filtering the val out, if the
+    # record is too short); with several, a list of the values.
+    #
+    # Lines without the quote character are split at the delimiter, but
+    # only up to the highest column needed. Others go through the csv
+    # module, which handles quoted fields, including those spanning several
+    # lines (a val completing no record is filtered out). With --no-quote,
+    # every line is just split, and the step keeps no state across lines
+    # unless there is a header.
+
+    def begin(self, opts):
+        d = opts.d or self.DELIM
+        if len(d) != 1 or len(opts.q) != 1:
+            raise ValueError('{}: DELIM and CHAR must be single characters'.format(self.name))
+        opts.d = d
+        opts.q = None if opts.no_quote else opts.q
+        opts.cols = [int(c) if INT_RGX.match(c) else c for c in opts.cols]
+        named = not all(isinstance(c, int) for c in opts.cols)
+        if named:
+            opts.header = True
+        if opts.header or opts.q:
+            self.SCOPE = 'file'
+        else:
+            self.SCOPE = None
+            self.STATELESS = True
+        if opts.q:
+            self.feed = LineFeed()
+            self.reader = csv.reader(self.feed, delimiter = d, quotechar = opts.q)
+        self.set_cols(None if named else opts.cols)
+
+    def initialize(self, opts, meta):
+        self.need_header = opts.header
+        self.pending = None
+        # Whether the next line can take the quick path, if it lacks the
+        # quote character: no header or partial record to handle.
+        self.quick = not opts.header
+
+    def set_cols(self, idxs):
+        # Takes the column indexes, or None if they come from the header.
+        # The split gets one extra piece to hold the rest of the line.
+        self.idxs = idxs
+        if idxs is None:
+            return
+        self.maxsplit = max(idxs) + 1 if min(idxs) >= 0 else -1
+        self.one = len(idxs) == 1
+
+    def process(self, opts, meta, val):
+        return self.get(val)
+
+    def process_batch(self, opts, meta, vals):
+        return list(map(self.get, vals))
+
+    def fuse(self, opts):
+        # For a single column known in advance, the quick path is inline.
+        idxs = self.idxs
+        if idxs and self.one and idxs[0] >= 0:
+            cond = '{self}.quick and {q} not in val' if opts.q else '{self}.quick'
+            names = dict(get = self.get, q = opts.q, d = opts.d, n = self.maxsplit, i = idxs[0])
+            return (FUSE_CSV.format(cond = cond), names)
+        return (FUSE_FILTER, dict(f = self.get))
+
+    def finalize(self, opts, meta):
+        # A record left incomplete by the end of the file.
+        if self.pending is not None:
+            line = self.pending
+            self.pending = None
+            return self.project(self.read(line)[0])
+
+    def get(self, val):
+        q = self.opts.q
+        if self.quick and not (q and q in val):
+            return self.project(val.rstrip('\r\n').split(self.opts.d, self.maxsplit))
+        line = val.rstrip('\r\n')
+        if self.pending is not None:
+            line = self.pending + '\n' + line
+            self.pending = None
+        if q and q in line:
+            fields, more = self.read(line)
+            if more:
+                self.pending = line
+                self.quick = False
+                return None
+        else:
+            fields = line.split(self.opts.d, self.maxsplit if self.idxs else -1)
+        self.quick = True
+        if self.need_header:
+            self.need_header = False
+            self.read_header(fields)
+            return None
+        return self.project(fields)
+
+    def read(self, line):
+        # Parses a line with the csv module. Returns a (FIELDS, MORE) tuple,
+        # where MORE is true if the record continues on the next line.
+        feed = self.feed
+        feed.line = line
+        feed.more = False
+        return (next(self.reader, []), feed.more)
+
+    def read_header(self, fields):
+        cols = self.opts.cols
+        idxs = []
+        for c in cols:
+            if isinstance(c, int):
+                idxs.append(c)
+            elif c in fields:
+                idxs.append(fields.index(c))
+            else:
+                raise ValueError('{}: no column named {!r}'.format(self.name, c))
+        self.set_cols(idxs)
+
+    def project(self, fields):
+        n = len(fields)
+        xs = [fields[i] if -n <= i < n else None for i in self.idxs]
+        return xs[0] if self.one else xs
+
+class Tsv(Csv):
+
+    DESC = 'Get columns from VAL, a TSV record'
+    DELIM = '\t'
+
+class LineFeed(object):
+    # An iterator feeding one line at a time to a csv reader. If the reader
+    # asks for another line to complete a record, more becomes true.
+
+    def __init__(self):
+        self.line = None
+        self.more = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.line
+        if line is None:
+            self.more = True
+            raise StopIteration
+        self.line = None
+        return line
+
+    next = __next__
+
+INT_RGX = re.compile(r'-?\d+$')
+
 ####
 # Head, skip, etc.
 ####
@@ -171,6 +571,9 @@ class Head(Step):
 
     DESC = 'Get first N VALs'
     USAGE = '[N]'
+    STATELESS = True
+    SCOPE = 'file'
+    BYTES = True
 
     OPTS_CONFIG = [
         'n',
@@ -178,13 +581,34 @@ class Head(Step):
     ]
 
     def process(self, opts, meta, val):
+        if meta.line_num >= opts.n:
+            self.done()
         if meta.line_num <= opts.n:
             return val
 
+    def process_batch(self, opts, meta, vals):
+        n = opts.n
+        nums = meta.batch_nums
+        if nums[-1] >= n:
+            self.done()
+        return [v if num <= n else None for v, num in zip(vals, nums)]
+
+    def fuse(self, opts):
+        return (FUSE_HEAD, dict(n = opts.n))
+
 class Tail(Step):
 
     DESC = 'Get last N VALs'
     USAGE = '[N]'
+    BYTES = True
+    MERGE = True
+
+    # When the steps before Tail are one-to-one maps (see Step.MAP), nab
+    # reads only the last N lines of each input file that it can seek
+    # within, scanning backward from the end (see set_tail_ranges). In that
+    # case, meta.line_num and meta.overall_num count only the lines read,
+    # starting from 1 at the first of those N lines, just as they do for
+    # the pieces of a file split by --split.
 
     OPTS_CONFIG = [
         'n',
@@ -192,21 +616,31 @@ class Tail(Step):
     ]
 
     def begin(self, opts):
-        self.deq = collections.deque()
+        self.deq = collections.deque(maxlen = opts.n)
 
     def process(self, opts, meta, val):
-        if len(self.deq) >= opts.n:
-            self.deq.popleft()
         self.deq.append(val)
 
+    def process_batch(self, opts, meta, vals):
+        self.deq.extend(vals)
+
+    def fuse(self, opts):
+        return ('{self}.deq.append(val)\ncontinue', {})
+
     def finalize(self, opts, meta):
         if meta.is_last_file:
             return ValIter(self.deq)
 
+    def merge(self, other):
+        self.deq.extend(other.deq)
+
 class Skip(Step):
 
     DESC = 'Skip N VALs'
     USAGE = 'N'
+    STATELESS = True
+    SCOPE = 'file'
+    BYTES = True
 
     OPTS_CONFIG = [
         'n',
@@ -217,6 +651,13 @@ class Skip(Step):
         if meta.line_num > opts.n:
             return val
 
+    def process_batch(self, opts, meta, vals):
+        n = opts.n
+        return [v if num > n else None for v, num in zip(vals, meta.batch_nums)]
+
+    def fuse(self, opts):
+        return ('if meta.line_num <= {n}:\n    continue', dict(n = opts.n))
+
 ####
 # Prefix, suffix, and trailing newline.
 ####
@@ -225,14 +666,25 @@ class Nl(Step):
 
     DESC = 'Add newline to end of VAL'
     USAGE = '.'
+    STATELESS = True
+    SCOPE = None
 
     def process(self, opts, meta, val):
         return val if val.endswith('\n') else val + '\n'
 
+    def process_batch(self, opts, meta, vals):
+        return [v if v.endswith('\n') else v + '\n' for v in vals]
+
+    def fuse(self, opts):
+        return (FUSE_NL, {})
+
 class Prefix(Step):
 
     DESC = 'Add prefix to VAL'
     USAGE = 'PRE'
+    STATELESS = True
+    MAP = True
+    SCOPE = None
 
     OPTS_CONFIG = [
         'pre',
@@ -242,10 +694,20 @@ class Prefix(Step):
     def process(self, opts, meta, val):
         return opts.pre + val
 
+    def process_batch(self, opts, meta, vals):
+        pre = opts.pre
+        return [pre + v for v in vals]
+
+    def fuse(self, opts):
+        return ('val = {pre} + val', dict(pre = opts.pre))
+
 class Suffix(Step):
 
     DESC = 'Add suffix to VAL'
     USAGE = 'SUFF'
+    STATELESS = True
+    MAP = True
+    SCOPE = None
 
     OPTS_CONFIG = [
         'suff',
@@ -255,6 +717,13 @@ class Suffix(Step):
     def process(self, opts, meta, val):
         return val + opts.suff
 
+    def process_batch(self, opts, meta, vals):
+        suff = opts.suff
+        return [v + suff for v in vals]
+
+    def fuse(self, opts):
+        return ('val = val + {suff}', dict(suff = opts.suff))
+
 ####
 # Aggregations.
 ####
@@ -262,7 +731,8 @@ class Suffix(Step):
 class Freq(Step):
 
     DESC = 'Compute and print freq dist of VALs'
-    USAGE = '[--reverse] [--flip] [--delim D] [--rng X Y]'
+    USAGE = '[--reverse] [--flip] [--delim D] [--rng X Y] [--top K] [--approx N] [--sorted]'
+    MERGE = True
 
     OPTS_CONFIG = [
         '--reverse',
@@ -273,30 +743,124 @@ class Freq(Step):
         dict(default = ':'),
         '--rng',
         dict(type = int, nargs = 2, default = [-1, sys.maxsize]),
+        '--top',
+        dict(type = int, metavar = 'K'),
+        '--approx',
+        dict(type = int, metavar = 'N'),
+        '--sorted',
+        dict(action = 'store_true'),
     ]
 
     def begin(self, opts):
-        opts.freq = collections.Counter()
+        # With --approx, count in bounded memory: at most N distinct vals.
+        # With --sorted, the input must be sorted: each run of equal vals is
+        # counted and printed when it ends, in input order, taking constant
+        # memory (or, with --top, memory proportional to K).
+        if opts.sorted:
+            opts.approx = None
+            opts.freq = None
+            self.prev = UNSET
+            self.n = 0
+            self.tops = []
+            self.MERGE = False
+        elif opts.approx:
+            opts.freq = SpaceSaving(opts.approx)
+        else:
+            opts.freq = collections.Counter()
         opts.rng = range(*opts.rng)
 
     def process(self, opts, meta, val):
-        opts.freq[val] += 1
+        if opts.sorted:
+            if val == self.prev:
+                self.n += 1
+            else:
+                self.advance(val)
+        elif opts.approx:
+            opts.freq.add(val)
+        else:
+            opts.freq[val] += 1
+
+    def process_batch(self, opts, meta, vals):
+        if opts.sorted:
+            for v in vals:
+                self.process(opts, meta, v)
+        else:
+            opts.freq.update(vals)
+
+    def fuse(self, opts):
+        if opts.sorted:
+            return (FUSE_FREQ_SORTED, {})
+        elif opts.approx:
+            return ('{freq}.add(val)\ncontinue', dict(freq = opts.freq))
+        return ('{freq}[val] += 1\ncontinue', dict(freq = opts.freq))
+
+    def advance(self, val):
+        # In --sorted mode: closes the current run and starts a new one.
+        check_sorted(self, self.prev, val)
+        self.close_run(self.opts)
+        self.prev = val
+        self.n = 1
+
+    def close_run(self, opts):
+        n = self.n
+        if n and n in opts.rng:
+            if opts.top is None:
+                self.print_count(opts, n, self.prev)
+            else:
+                # Keep the top K counts seen so far, trimming
+                # the list whenever it doubles in size.
+                self.tops.append((n, self.prev))
+                if len(self.tops) >= 2 * opts.top:
+                    self.tops = self.get_top(opts, self.tops)
+
+    def get_top(self, opts, tups):
+        # With --top, a partial sort via heapq yields the same K
+        # tuples as a full sort followed by a slice.
+        if opts.reverse:
+            return heapq.nsmallest(opts.top, tups)
+        else:
+            return heapq.nlargest(opts.top, tups)
+
+    def print_count(self, opts, n, k):
+        xs = (k, opts.delim, n) if opts.flip else (n, opts.delim, k)
+        msg = '{} {} {}'.format(*xs)
+        if opts.approx:
+            msg += ' (error <= {})'.format(opts.freq.error(k))
+        self.out(msg)
 
     def end(self, opts, meta):
+        if opts.sorted:
+            self.close_run(opts)
+            if opts.top is not None:
+                for n, k in self.get_top(opts, self.tops):
+                    self.print_count(opts, n, k)
+            return
         tups = [
             (n, k)
             for k, n in opts.freq.items()
             if n in opts.rng
         ]
-        for n, k in sorted(tups, reverse = not opts.reverse):
-            xs = (k, opts.delim, n) if opts.flip else (n, opts.delim, k)
-            msg = '{} {} {}'.format(*xs)
-            self.out(msg)
+        if opts.top is None:
+            tups = sorted(tups, reverse = not opts.reverse)
+        else:
+            tups = self.get_top(opts, tups)
+        for n, k in tups:
+            self.print_count(opts, n, k)
+        if opts.approx:
+            fmt = 'freq: {} vals, {} tracked; counts overstated by at most {}'
+            self.err(fmt.format(opts.freq.total, len(opts.freq), opts.freq.max_error))
+
+    def merge(self, other):
+        if self.opts.approx:
+            self.opts.freq.merge(other.opts.freq)
+        else:
+            self.opts.freq.update(other.opts.freq)
 
 class Sum(Step):
 
     DESC = 'Compute and print sum of VALs'
     USAGE = '.'
+    MERGE = True
 
     def begin(self, opts):
         opts.sum = 0
@@ -304,9 +868,495 @@ class Sum(Step):
     def process(self, opts, meta, val):
         opts.sum += val
 
+    def process_batch(self, opts, meta, vals):
+        opts.sum = sum(vals, opts.sum)
+
+    def fuse(self, opts):
+        return ('{opts}.sum += val\ncontinue', {})
+
     def end(self, opts, meta):
         self.out(opts.sum)
 
+    def merge(self, other):
+        self.opts.sum += other.opts.sum
+
+class Stats(Step):
+
+    DESC = 'Compute summary statistics of VALs'
+    USAGE = '[-q Q...] [--approx [--compression N]] [--per-file] [--json] [--no-numpy]'
+    MERGE = True
+
+    OPTS_CONFIG = [
+        '-q',
+        dict(type = float, nargs = '+', default = [], metavar = 'Q'),
+        '--approx',
+        dict(action = 'store_true'),
+        '--compression',
+        dict(type = int, default = 200, metavar = 'N'),
+        '--per-file',
+        dict(action = 'store_true'),
+        '--json',
+        dict(action = 'store_true'),
+        '--no-numpy',
+        dict(action = 'store_true'),
+    ]
+
+    # Vals are numbers or their text. Prints the count, sum, min, max, mean,
+    # standard deviation (of the population), and the quantiles given by
+    # -q, from 0 to 1 (see nab.stats). Quantiles are exact, unless --approx
+    # is used to bound memory. With --per-file, the statistics for each
+    # file are printed after it. With --json, they are printed as a JSON
+    # object.
+
+    def begin(self, opts):
+        for q in opts.q:
+            if not 0 <= q <= 1:
+                raise ValueError('{}: quantiles must be from 0 to 1'.format(self.name))
+        np = None if opts.no_numpy else get_numpy()
+        opts.stats = NumberStats(opts.approx, opts.compression, np)
+        if opts.per_file:
+            self.SCOPE = 'file'
+
+    def process(self, opts, meta, val):
+        opts.stats.add(val)
+
+    def process_batch(self, opts, meta, vals):
+        opts.stats.extend(vals)
+
+    def fuse(self, opts):
+        # In exact mode, ints go straight into their array.
+        if opts.approx:
+            return ('{add}(val)\ncontinue', dict(add = opts.stats.add))
+        else:
+            names = dict(append = opts.stats.ints.append, add = opts.stats.add, parse = parse_number)
+            return (FUSE_STATS, names)
+
+    def finalize(self, opts, meta):
+        if opts.per_file:
+            self.report(opts)
+            opts.stats.clear()
+
+    def end(self, opts, meta):
+        if not opts.per_file:
+            self.report(opts)
+
+    def report(self, opts):
+        d = opts.stats.results(opts.q)
+        if opts.json:
+            self.out(json.dumps(d))
+        else:
+            for k, v in d.items():
+                self.out(k, '-' if v is None else v)
+
+    def merge(self, other):
+        self.opts.stats.merge(other.opts.stats)
+
+####
+# Sorting.
+####
+
+class Sort(Step):
+
+    DESC = 'Sort VALs'
+    USAGE = '[-f N [-d RGX]] [--rgx RGX [-g N]] [--key EXPR] [-n] [-r] [--per-file] [--buffer SIZE]'
+    BYTES = True
+    MERGE = True
+
+    OPTS_CONFIG = [
+        '-f',
+        dict(type = int, metavar = 'N'),
+        '-d',
+        dict(metavar = 'RGX'),
+        '--rgx',
+        dict(),
+        '-g',
+        dict(type = int, default = 0),
+        '--key',
+        dict(metavar = 'EXPR'),
+        '-n',
+        dict(action = 'store_true'),
+        '-r',
+        dict(action = 'store_true'),
+        '--per-file',
+        dict(action = 'store_true'),
+        '--buffer',
+        dict(type = parse_size, default = parse_size('256M'), metavar = 'SIZE'),
+    ]
+
+    # The sort key of a VAL is the VAL itself or, if requested, one of the
+    # following: field N (numbered from 0) after splitting on whitespace or
+    # RGX; group N of the first match of --rgx; or the value of a Python
+    # expression using the name val. Vals lacking a key sort as though the
+    # key were empty. With -n, keys are converted to floats (non-numeric
+    # keys sort as 0). The sort is stable, even with -r.
+    #
+    # Vals are held in memory until they exceed the --buffer size; then they
+    # are sorted and written to temp files, which get merged at the end. By
+    # default, the step sorts the vals of all files together, emitting them
+    # after the last file; with --per-file, it sorts each file separately.
+
+    def begin(self, opts):
+        self.sort_key = self.get_key(opts)
+        if opts.per_file:
+            self.SCOPE = 'file'
+        self.reset()
+
+    def get_key(self, opts):
+        # Returns a function to compute the sort key of a val, or None.
+        key = get_extractor(self, opts.f, opts.d, opts.rgx, opts.g, opts.key)
+        if key is None:
+            if opts.n:
+                key = lambda v: v
+            else:
+                return None
+        if opts.n:
+            return functools.partial(numeric_key, key)
+        else:
+            return key
+
+    def reset(self):
+        # Records are (KEY, VAL) tuples, or just vals if there is no key.
+        opts = self.opts
+        self.sorter = ExternalSorter(
+            opts.buffer,
+            key = None if self.sort_key is None else operator.itemgetter(0),
+            reverse = opts.r,
+        )
+
+    def process(self, opts, meta, val):
+        if self.sort_key is None:
+            self.sorter.add(val)
+        else:
+            self.sorter.add((self.sort_key(val), val))
+
+    def process_batch(self, opts, meta, vals):
+        add = self.sorter.add
+        key = self.sort_key
+        if key is None:
+            for v in vals:
+                add(v)
+        else:
+            for v in vals:
+                add((key(v), v))
+
+    def fuse(self, opts):
+        if self.sort_key is None:
+            return ('{self}.sorter.add(val)\ncontinue', {})
+        return ('{self}.sorter.add(({key}(val), val))\ncontinue', dict(key = self.sort_key))
+
+    def finalize(self, opts, meta):
+        if opts.per_file or meta.is_last_file:
+            sorter = self.sorter
+            self.reset()
+            if self.sort_key is None:
+                return ValIter(sorter)
+            else:
+                return ValIter(v for k, v in sorter)
+
+    def merge(self, other):
+        self.sorter.merge(other.sorter)
+
+    def __getstate__(self):
+        # The key function is a closure, which cannot be pickled when a
+        # worker returns the step (see --jobs). The parent has its own.
+        d = dict(vars(self))
+        d.pop('sort_key', None)
+        return d
+
+def numeric_key(key, val):
+    try:
+        return float(key(val))
+    except (TypeError, ValueError):
+        return 0.0
+
+def get_extractor(step, f = None, d = None, rgx = None, g = 0, expr = None):
+    # Returns a function to get part of a val: field f (numbered from 0)
+    # after splitting on whitespace or the regex d; group g of the first
+    # match of rgx; or the value of the Python expression expr, using the
+    # name val. Missing parts are empty. Returns None if no part is given.
+    empty = step.as_bytes('')
+    if f is not None:
+        i = f
+        if d:
+            split = re.compile(step.as_bytes(d)).split
+        else:
+            split = lambda v: v.split()
+        def get(v):
+            xs = split(v)
+            return xs[i] if -len(xs) <= i < len(xs) else empty
+    elif rgx:
+        rgx = re.compile(step.as_bytes(rgx))
+        def get(v):
+            m = rgx.search(v)
+            return (m.group(g) or empty) if m else empty
+    elif expr:
+        get = eval('lambda val: ' + expr, globals())
+    else:
+        return None
+    return get
+
+####
+# Grouping.
+####
+
+# The aggregates, and how to get each from a state (see GroupBy.add).
+GROUP_AGGS = collections.OrderedDict((
+    ('count', operator.itemgetter(0)),
+    ('sum', operator.itemgetter(1)),
+    ('min', operator.itemgetter(2)),
+    ('max', operator.itemgetter(3)),
+    ('mean', lambda st: st[1] / float(st[0])),
+    ('distinct', lambda st: len(st[-1])),
+))
+
+class GroupBy(Step):
+
+    DESC = 'Compute aggregates of VALs by key'
+    USAGE = (
+        '[-f N [-d RGX]] [--rgx RGX [-g N]] [--key EXPR] '
+        '[-v N] [--vrgx RGX [--vg N]] [--val EXPR] [-a AGG...] '
+        '[--by AGG] [-r] [--top K] [--delim D] [--json] [--buffer SIZE]'
+    )
+    MERGE = True
+
+    OPTS_CONFIG = [
+        '-f',
+        dict(type = int, metavar = 'N'),
+        '-d',
+        dict(metavar = 'RGX'),
+        '--rgx',
+        dict(),
+        '-g',
+        dict(type = int, default = 0),
+        '--key',
+        dict(metavar = 'EXPR'),
+        '-v',
+        dict(type = int, metavar = 'N'),
+        '--vrgx',
+        dict(metavar = 'RGX'),
+        '--vg',
+        dict(type = int, default = 0, metavar = 'N'),
+        '--val',
+        dict(metavar = 'EXPR'),
+        '-a',
+        dict(nargs = '+', choices = GROUP_AGGS, default = ['count'], metavar = 'AGG'),
+        '--by',
+        dict(choices = GROUP_AGGS, metavar = 'AGG'),
+        '-r',
+        dict(action = 'store_true'),
+        '--top',
+        dict(type = int, metavar = 'K'),
+        '--delim',
+        dict(default = '\t'),
+        '--json',
+        dict(action = 'store_true'),
+        '--buffer',
+        dict(type = parse_size, default = parse_size('256M'), metavar = 'SIZE'),
+    ]
+
+    # The key of a VAL is the VAL itself or, as with sort, field N, group N
+    # of --rgx, or the value of --key EXPR. Likewise, its value is the VAL
+    # itself, field -v N, group --vg N of --vrgx, or the value of --val
+    # EXPR. The aggregates (AGG) are count, sum, min, max, mean, and
+    # distinct (the number of distinct values); all but count and distinct
+    # take numbers or their text. If any of those is requested, vals whose
+    # value is missing or not a number are skipped, counting toward none
+    # of the aggregates, and their number is reported to STDERR.
+    #
+    # After the last file, prints a line for each key: the key and its
+    # aggregates, separated by D (or, with --json, as a JSON object). Keys
+    # come in sorted order or, with --by, in descending order of that
+    # aggregate; -r reverses the order. With --top, only the first K keys
+    # are printed.
+    #
+    # Each key has one small list in a dict, holding only the accumulators
+    # its aggregates need. When the estimated size of the dict exceeds the
+    # --buffer size, its entries are sorted by key and written to temp
+    # files; at the end, those runs are merged, and the entries for each
+    # key are combined. Keys that cannot be compared with each other, such
+    # as numbers and text, are ordered by type first (see group_order()).
+
+    def begin(self, opts):
+        aggs = opts.a
+        if opts.by and opts.by not in aggs:
+            raise ValueError('{}: --by must be one of the aggregates'.format(self.name))
+        self.get_key = get_extractor(self, opts.f, opts.d, opts.rgx, opts.g, opts.key)
+        self.get_val = get_extractor(self, opts.v, opts.d, opts.vrgx, opts.vg, opts.val)
+        self.numeric = any(a in ('sum', 'min', 'max', 'mean') for a in aggs)
+        self.distinct = 'distinct' in aggs
+        self.table = {}
+        self.size = 0
+        self.sorter = None
+        self.skipped = 0
+
+    def process(self, opts, meta, val):
+        k = self.get_key(val) if self.get_key else val
+        x = self.get_val(val) if self.get_val else val
+        self.add(k, x)
+
+    def fuse(self, opts):
+        k = '{key}(val)' if self.get_key else 'val'
+        x = '{value}(val)' if self.get_val else 'val'
+        code = '{add}(' + k + ', ' + x + ')'
+        names = dict(add = self.add, key = self.get_key, value = self.get_val)
+        f = opts.f
+        v = opts.v
+        if f is not None and v is not None and not opts.d and min(f, v) >= 0:
+            # Both from fields: split once, and only as far as needed.
+            hi = max(f, v)
+            code = FUSE_GROUPBY_FIELDS.format(f = f, v = v, hi = hi, maxsplit = hi + 1, code = code)
+        return (code + '\ncontinue', names)
+
+    def add(self, k, x):
+        # State: [COUNT, SUM, MIN, MAX, DISTINCT], but with only the count
+        # and, if needed, the sum, min, and max (as numbers) and the
+        # distinct values (a set, always last).
+        if self.numeric and not isinstance(x, (int, float)):
+            try:
+                x = parse_number(x)
+            except (TypeError, ValueError):
+                self.skipped += 1
+                return
+        st = self.table.get(k)
+        if st is None:
+            st = self.new_state(k, x)
+        st[0] += 1
+        if self.numeric:
+            st[1] += x
+            if x < st[2]:
+                st[2] = x
+            elif x > st[3]:
+                st[3] = x
+        if self.distinct:
+            xs = st[-1]
+            if x not in xs:
+                xs.add(x)
+                self.size += sys.getsizeof(x) + GROUP_ENTRY_SIZE // 2
+                if self.size > self.opts.buffer:
+                    self.spill()
+
+    def new_state(self, k, x):
+        # The size is checked only when adding a key or a distinct value.
+        if self.size > self.opts.buffer:
+            self.spill()
+        st = [0, 0, x, x] if self.numeric else [0]
+        if self.distinct:
+            st.append(set())
+        self.table[k] = st
+        self.size += sys.getsizeof(k) + GROUP_ENTRY_SIZE
+        return st
+
+    def combine(self, st, other):
+        # Folds the state of one key into another state for the same key.
+        st[0] += other[0]
+        if self.numeric:
+            st[1] += other[1]
+            st[2] = min(st[2], other[2])
+            st[3] = max(st[3], other[3])
+        if self.distinct:
+            st[-1] |= other[-1]
+
+    def spill(self):
+        # Moves the entries of the dict to a sorted run.
+        if self.sorter is None:
+            self.sorter = ExternalSorter(self.opts.buffer, key = group_order)
+        for item in self.table.items():
+            self.sorter.add(item)
+        self.sorter.spill()
+        self.table = {}
+        self.size = 0
+
+    def groups(self):
+        # Yields (KEY, STATE) tuples in key order.
+        if self.sorter is None:
+            for item in sorted(self.table.items(), key = group_order):
+                yield item
+            return
+        sorter = self.sorter
+        for item in self.table.items():
+            sorter.add(item)
+        self.table = {}
+        try:
+            for k, grp in itertools.groupby(sorter, key = operator.itemgetter(0)):
+                st = next(grp)[1]
+                for _, other in grp:
+                    self.combine(st, other)
+                yield (k, st)
+        finally:
+            sorter.close()
+
+    def rows(self):
+        # Yields (KEY, AGGREGATES) tuples in key order.
+        gets = [GROUP_AGGS[a] for a in self.opts.a]
+        for k, st in self.groups():
+            yield (k, [g(st) for g in gets])
+
+    def end(self, opts, meta):
+        rows = self.rows()
+        if opts.by is None:
+            sort_key = group_order
+            reverse = opts.r
+        else:
+            i = opts.a.index(opts.by)
+            sort_key = lambda row: row[1][i]
+            reverse = not opts.r
+        if not reverse and opts.by is None:
+            pass
+        elif opts.top is not None:
+            f = heapq.nlargest if reverse else heapq.nsmallest
+            rows = f(opts.top, rows, key = sort_key)
+        else:
+            sorter = ExternalSorter(opts.buffer, key = sort_key, reverse = reverse)
+            for row in rows:
+                sorter.add(row)
+            rows = sorter
+        if opts.top is not None:
+            rows = itertools.islice(rows, opts.top)
+        for k, xs in rows:
+            if opts.json:
+                d = collections.OrderedDict(key = k)
+                d.update(zip(opts.a, xs))
+                self.out(json.dumps(d))
+            else:
+                self.out(opts.delim.join(map(str, [k] + xs)))
+        if self.skipped:
+            self.err('{}: skipped {} vals without a number'.format(self.name, self.skipped))
+
+    def merge(self, other):
+        for k, st in other.table.items():
+            mine = self.table.get(k)
+            if mine is None:
+                self.table[k] = st
+            else:
+                self.combine(mine, st)
+        self.size += other.size
+        self.skipped += other.skipped
+        if other.sorter:
+            if self.sorter:
+                self.sorter.merge(other.sorter)
+            else:
+                self.sorter = other.sorter
+        if self.size > self.opts.buffer:
+            self.spill()
+
+    def __getstate__(self):
+        # As with Sort, the extractors cannot be pickled.
+        d = dict(vars(self))
+        d.pop('get_key', None)
+        d.pop('get_val', None)
+        return d
+
+def group_order(item):
+    # Takes a (KEY, ...) tuple from GroupBy. Returns its sort key: the type of
+    # KEY and then KEY, with numbers first. Keys of different types might not
+    # be comparable, and merging sorted runs requires a total order.
+    k = item[0]
+    return ('' if isinstance(k, (int, float)) else type(k).__name__, k)
+
+# A rough estimate of the memory used by a key in GroupBy, beyond the key
+# itself: its dict entry and state.
+GROUP_ENTRY_SIZE = 150
+
 ####
 # Basic conversions: str, int, float.
 ####
@@ -315,26 +1365,107 @@ class Str(Step):
 
     DESC = 'Convert VAL to str'
     USAGE = '.'
+    STATELESS = True
+    MAP = True
+    SCOPE = None
 
     def process(self, opts, meta, val):
         return str(val)
 
+    def process_batch(self, opts, meta, vals):
+        return list(map(str, vals))
+
+    def fuse(self, opts):
+        return ('val = str(val)', {})
+
 class Int(Step):
 
     DESC = 'Convert VAL to int'
     USAGE = '.'
+    STATELESS = True
+    SCOPE = None
+
+    # Vals holding integers are converted directly, which is faster and
+    # exact for large ones; others go through float().
 
     def process(self, opts, meta, val):
-        return int(float(val))
+        try:
+            return int(val)
+        except ValueError:
+            return int(float(val))
+
+    def process_batch(self, opts, meta, vals):
+        try:
+            return list(map(int, vals))
+        except ValueError:
+            return [self.process(opts, meta, v) for v in vals]
+
+    def fuse(self, opts):
+        return (FUSE_INT, {})
 
 class Float(Step):
 
     DESC = 'Convert VAL to float'
     USAGE = '.'
+    STATELESS = True
+    SCOPE = None
 
     def process(self, opts, meta, val):
         return float(val)
 
+    def process_batch(self, opts, meta, vals):
+        return list(map(float, vals))
+
+    def fuse(self, opts):
+        return ('val = float(val)', {})
+
+class Decode(Step):
+
+    DESC = 'Decode VAL from bytes'
+    USAGE = '[ENCODING] [--errors E]'
+    STATELESS = True
+    SCOPE = None
+    BYTES = True
+
+    OPTS_CONFIG = [
+        'encoding',
+        dict(nargs = '?'),
+        '--errors',
+        dict(default = 'strict'),
+    ]
+
+    def initialize(self, opts, meta):
+        # By default, use the encoding that nab would have used
+        # to open the input file in text mode.
+        self.encoding = (
+            opts.encoding or
+            meta.inp.open_kws.get('encoding') or
+            locale.getpreferredencoding(False)
+        )
+
+    def process(self, opts, meta, val):
+        return decode_val(val, self.encoding, opts.errors)
+
+    def process_batch(self, opts, meta, vals):
+        enc = self.encoding
+        errors = opts.errors
+        return [decode_val(v, enc, errors) for v in vals]
+
+    def fuse(self, opts):
+        names = dict(process = self.process, errors = opts.errors)
+        return (FUSE_DECODE, names)
+
+def decode_val(val, encoding = None, errors = 'strict'):
+    # Takes a val. Returns it decoded to text if it is bytes -- or, if it is
+    # a list or tuple, with its bytes elements decoded. Otherwise, returns
+    # the val unchanged.
+    if isinstance(val, bytes):
+        return val.decode(encoding or locale.getpreferredencoding(False), errors)
+    elif isinstance(val, (list, tuple)):
+        return type(val)(decode_val(v, encoding, errors) for v in val)
+    else:
+        return val
+
 ####
 # Regex substitution, searching, grepping, and findall.
 ####
@@ -343,6 +1474,10 @@ class Sub(Step):
 
     DESC = 'Find regex in VAL and replace it'
     USAGE = 'RGX REPL [-n N] [-f] [-i N]'
+    STATELESS = True
+    MAP = True
+    SCOPE = None
+    BYTES = True
 
     OPTS_CONFIG = [
         'rgx',
@@ -358,62 +1493,159 @@ class Sub(Step):
     ]
 
     def begin(self, opts):
-        opts.rgx = re.compile(opts.rgx)
+        opts.rgx = self.compile(opts.rgx)
         if opts.f:
+            # User code might fail or have side effects.
+            self.MAP = False
             indent = ' ' * opts.i
             code = 'def _repl(m):\n{}{}'.format(indent, opts.repl)
             d = {}
-            exec(code, globals(), d)
+            exec(compile_cached(code, '<sub -f>'), globals(), d)
             opts.repl = d['_repl']
+        else:
+            opts.repl = self.as_bytes(opts.repl)
 
     def process(self, opts, meta, val):
         return opts.rgx.sub(opts.repl, val, count = opts.n)
 
+    def process_batch(self, opts, meta, vals):
+        sub = opts.rgx.rgx.sub
+        lit = opts.rgx.lit
+        repl = opts.repl
+        n = opts.n
+        if lit is None:
+            return [sub(repl, v, n) for v in vals]
+        else:
+            return [sub(repl, v, n) if lit in v else v for v in vals]
+
+    def fuse(self, opts):
+        lit = opts.rgx.lit
+        names = dict(sub = opts.rgx.rgx.sub, repl = opts.repl, n = opts.n, lit = lit)
+        if lit is None:
+            return ('val = {sub}({repl}, val, {n})', names)
+        return ('if {lit} in val:\n    val = {sub}({repl}, val, {n})', names)
+
 class Search(Step):
 
     DESC = 'Find regex in VAL and get it'
-    USAGE = 'RGX [-g N] [-a]'
+    USAGE = 'RGX [-g N] [-a] [--first] | -f PATH [-F] [-i] [-a] [--first]'
+    STATELESS = True
+    SCOPE = None
+    BYTES = True
 
     OPTS_CONFIG = [
         'rgx',
-        dict(),
+        dict(nargs = '?'),
         '-g',
         dict(type = int, default = 0),
         '-a',
         dict(action = 'store_true'),
+        '--first',
+        dict(action = 'store_true'),
+        '-f',
+        dict(metavar = 'PATH'),
+        '-F',
+        dict(action = 'store_true'),
+        '-i',
+        dict(action = 'store_true'),
     ]
 
+    # With -f, the patterns are read from a file, one per line, and the val
+    # becomes the pattern that matched -- or, with -a, a (PATTERN, MATCHED)
+    # tuple. The patterns are literal strings if -F is given or if none
+    # contains a regex metacharacter: see nab.patterns.
+
     def begin(self, opts):
-        opts.rgx = re.compile(opts.rgx)
+        if opts.f:
+            search = get_pattern_set(self, opts, literal = opts.F or None).search
+            opts.find = search if opts.a else first_of(search)
+        else:
+            f = re.IGNORECASE if opts.i else 0
+            opts.rgx = self.compile(require_rgx(self, opts), f)
+        if opts.first:
+            # The step is done with a file after its first match.
+            self.STATELESS = False
+            self.SCOPE = 'file'
+
+    def initialize(self, opts, meta):
+        self.found = False
 
     def process(self, opts, meta, val):
-        m = opts.rgx.search(val)
-        if m:
-            if opts.a:
-                return m.groups()
-            else:
-                return m.group(opts.g)
+        if opts.first and self.found:
+            return None
+        if opts.f:
+            v = opts.find(val)
+            if v is None:
+                return None
+        else:
+            m = opts.rgx.search(val)
+            if not m:
+                return None
+            v = m.groups() if opts.a else m.group(opts.g)
+        if opts.first:
+            self.found = True
+            self.done()
+        return v
+
+    def process_batch(self, opts, meta, vals):
+        if opts.first:
+            return Step.process_batch(self, opts, meta, vals)
+        elif opts.f:
+            return list(map(opts.find, vals))
+        ms = prefiltered(opts.rgx.rgx.search, opts.rgx.lit, vals)
+        if opts.a:
+            return [m.groups() if m else None for m in ms]
+        else:
+            g = opts.g
+            return [m.group(g) if m else None for m in ms]
+
+    def fuse(self, opts):
+        if opts.first:
+            return None
+        elif opts.f:
+            return (FUSE_SEARCH_F, dict(find = opts.find))
+        lit = opts.rgx.lit
+        names = dict(search = opts.rgx.rgx.search, g = opts.g, lit = lit)
+        code = FUSE_SEARCH_A if opts.a else FUSE_SEARCH
+        return (code if lit is None else FUSE_PREFILTER + code, names)
 
 class Grep(Step):
 
     DESC = 'Use regex to filter VALs'
-    USAGE = 'RGX [-i] [-v] [-s]'
+    USAGE = 'RGX [-i] [-v] [-s|-F] | -f PATH [-i] [-v] [-s|-F]'
+    STATELESS = True
+    SCOPE = None
+    BYTES = True
 
     OPTS_CONFIG = [
         'rgx',
-        dict(),
+        dict(nargs = '?'),
         '-i',
         dict(action = 'store_true'),
         '-v',
         dict(action = 'store_true'),
         '-s',
+        '-F',
         dict(action = 'store_true'),
+        '-f',
+        dict(metavar = 'PATH'),
     ]
 
+    # With -f, the patterns are read from a file, one per line, and matched
+    # all at once. They are literal strings if -s (or its alias -F, which
+    # does not collide with the --step flag) is given or if none contains
+    # a regex metacharacter: see nab.patterns.
+
     def begin(self, opts):
+        if opts.f:
+            opts.search = get_pattern_set(self, opts, literal = opts.s or None).test
+            opts.s = False
+            return
+        opts.rgx = self.as_bytes(require_rgx(self, opts))
         if not opts.s:
             f = re.IGNORECASE if opts.i else 0
-            opts.rgx = re.compile(opts.rgx, flags = f)
+            opts.nrgx = self.compile(opts.rgx, f)
+            opts.search = opts.nrgx.search
 
     def process(self, opts, meta, val):
         if opts.s:
@@ -422,13 +1654,76 @@ class Grep(Step):
             else:
                 m = opts.rgx in val
         else:
-            m = bool(opts.rgx.search(val))
+            m = bool(opts.search(val))
         return None if m == opts.v else val
 
+    def process_batch(self, opts, meta, vals):
+        if opts.s:
+            if opts.i:
+                s = opts.rgx.lower()
+                ms = [s in v.lower() for v in vals]
+            else:
+                s = opts.rgx
+                ms = [s in v for v in vals]
+        elif opts.f:
+            ms = map(opts.search, vals)
+        else:
+            ms = prefiltered(opts.nrgx.rgx.search, opts.nrgx.lit, vals)
+        if opts.v:
+            return [None if m else v for v, m in zip(vals, ms)]
+        else:
+            return [v if m else None for v, m in zip(vals, ms)]
+
+    def fuse(self, opts):
+        if opts.s:
+            names = dict(s = opts.rgx.lower() if opts.i else opts.rgx)
+            test = '{s} in val.lower()' if opts.i else '{s} in val'
+        elif opts.f or opts.nrgx.lit is None:
+            names = dict(s = opts.search)
+            test = '{s}(val)'
+        else:
+            names = dict(s = opts.nrgx.rgx.search, lit = opts.nrgx.lit)
+            test = '{lit} in val and {s}(val)'
+        fmt = 'if {}:\n    continue' if opts.v else 'if not ({}):\n    continue'
+        return (fmt.format(test), names)
+
+def get_pattern_set(step, opts, literal = None):
+    # For the -f option of Grep and Search: returns a PatternSet for the
+    # patterns in the file, plus RGX if given.
+    pats = read_patterns(opts.f)
+    if opts.rgx is not None:
+        pats.append(opts.rgx)
+    pats = [step.as_bytes(p) for p in pats]
+    return PatternSet(pats, literal = literal, ignore_case = opts.i)
+
+def prefiltered(search, lit, vals):
+    # Returns a list of the matches of search() against the vals, or None
+    # for the vals lacking the literal (unless it is None).
+    if lit is None:
+        return list(map(search, vals))
+    else:
+        return [search(v) if lit in v else None for v in vals]
+
+def first_of(search):
+    # Takes the search() method of a PatternSet. Returns a function that
+    # returns just the matching pattern.
+    def find(val):
+        res = search(val)
+        return None if res is None else res[0]
+    return find
+
+def require_rgx(step, opts):
+    if opts.rgx is None:
+        raise ValueError('{}: RGX or -f PATH is required'.format(step.name))
+    return opts.rgx
+
 class FindAll(Step):
 
     DESC = 'Find all in VAL'
     USAGE = 'RGX'
+    STATELESS = True
+    SCOPE = None
+    BYTES = True
 
     OPTS_CONFIG = [
         'rgx',
@@ -436,11 +1731,26 @@ class FindAll(Step):
     ]
 
     def begin(self, opts):
-        opts.rgx = re.compile(opts.rgx)
+        opts.rgx = self.compile(opts.rgx)
 
     def process(self, opts, meta, val):
         return opts.rgx.findall(val)
 
+    def process_batch(self, opts, meta, vals):
+        findall = opts.rgx.rgx.findall
+        lit = opts.rgx.lit
+        if lit is None:
+            return list(map(findall, vals))
+        else:
+            return [findall(v) if lit in v else [] for v in vals]
+
+    def fuse(self, opts):
+        lit = opts.rgx.lit
+        names = dict(findall = opts.rgx.rgx.findall, lit = lit)
+        if lit is None:
+            return ('val = {findall}(val)', names)
+        return ('val = {findall}(val) if {lit} in val else []', names)
+
 ####
 # Run user-supplied code.
 ####
@@ -448,23 +1758,86 @@ class FindAll(Step):
 class Run(Step):
 
     DESC = 'Run code against VAL'
-    USAGE = 'CODE [-i N]'
+    USAGE = '[CODE] [-i N] [--vals] [--init CODE] [--final CODE] [--end CODE]'
 
     OPTS_CONFIG = [
         'code',
-        dict(),
+        dict(nargs = '?'),
         '-i',
         dict(type = int, default = 4),
+        '--vals',
+        dict(action = 'store_true'),
+        '--init',
+        dict(metavar = 'CODE'),
+        '--final',
+        dict(metavar = 'CODE'),
+        '--end',
+        dict(metavar = 'CODE'),
     ]
 
+    # CODE is the body of a function taking self, opts, meta, and val, and
+    # returning the new val (None to filter it out). With --vals, it takes a
+    # list named vals instead, returning a list aligned with it, as does
+    # Step.process_batch(): it gets whole batches with --batch N, and lists
+    # of one val otherwise. Without CODE, vals pass through unchanged.
+    #
+    # The other blocks run once: --init during the begin phase, --final
+    # after each file (returning a val to emit, if any), and --end during
+    # the end phase. All of the code shares one namespace as its globals,
+    # which starts with self, opts, and meta. Names assigned by --init are
+    # visible to the other blocks, which must declare them global to
+    # rebind them. The compiled code is cached (see utils.compile_cached).
+
     def begin(self, opts):
         # Reference: https://stackoverflow.com/questions/972.
+        ns = dict(globals(), self = self, opts = opts, meta = self.meta)
+        if opts.init:
+            exec(compile_cached(opts.init, '<run --init>'), ns)
         indent = ' ' * opts.i
-        fmt = 'def _process(self, opts, meta, val):\n{}{}\n'
-        code = fmt.format(indent, opts.code)
-        d = {}
-        exec(code, globals(), d)
-        self.process = functools.partial(d['_process'], self)
+        arg = 'vals' if opts.vals else 'val'
+        funcs = [
+            ('_process', opts.code, ', ' + arg),
+            ('_final', opts.final, ''),
+            ('_end', opts.end, ''),
+        ]
+        src = ''.join(
+            RUN_FUNC_FMT.format(name, args, indent, code)
+            for name, code, args in funcs
+            if code
+        )
+        if src:
+            exec(compile_cached(src, '<run>'), ns)
+        f = ns.get('_process')
+        if f and not opts.vals:
+            self.process = functools.partial(f, self)
+        self.process_vals = f and functools.partial(f, self)
+        # Without CODE, process() is a pass-through; with --vals, the code
+        # is written for batches, so batch mode must not be turned off.
+        self.EFFECTS = bool(f) and not opts.vals
+        self.final = ns.get('_final')
+        self.end_code = ns.get('_end')
+
+    def process(self, opts, meta, val):
+        # Used only with --vals or without CODE.
+        if self.process_vals:
+            res = self.process_vals(opts, meta, [val])
+            return res[0] if res else None
+        return val
+
+    def process_batch(self, opts, meta, vals):
+        if self.process_vals:
+            return self.process_vals(opts, meta, vals)
+        return vals
+
+    def finalize(self, opts, meta):
+        if self.final:
+            return self.final(self, opts, meta)
+
+    def end(self, opts, meta):
+        if self.end_code:
+            self.end_code(self, opts, meta)
+
+RUN_FUNC_FMT = 'def {}(self, opts, meta{}):\n{}{}\n'
 
 ####
 # JSON handling.
@@ -474,6 +1847,8 @@ class JsonD(Step):
 
     DESC = 'Convert VAL to JSON'
     USAGE = '[I]'
+    STATELESS = True
+    SCOPE = None
 
     OPTS_CONFIG = [
         '-i',
@@ -484,6 +1859,89 @@ class JsonD(Step):
         d = json.loads(val)
         return json.dumps(d, indent = opts.i)
 
+class JsonL(Step):
+
+    DESC = 'Get fields from VAL, a JSON document'
+    USAGE = '[PATH...] [--json|--str] [--default VAL] [--no-scan]'
+    STATELESS = True
+    SCOPE = None
+
+    OPTS_CONFIG = [
+        'paths',
+        dict(nargs = '*', metavar = 'PATH'),
+        '--json',
+        dict(action = 'store_true'),
+        '--str',
+        dict(action = 'store_true'),
+        '--default',
+        dict(metavar = 'VAL'),
+        '--no-scan',
+        dict(action = 'store_true'),
+    ]
+
+    # Each PATH names a field, as in a.b[0].c (see nab.jsonl). With one
+    # PATH, the new val is the value of that field; with several, a tuple of
+    # their values (which freq can count, if none is an object or list);
+    # with none, the whole document. Missing fields get the --default value
+    # (parsed as JSON, if possible), or None; with one PATH, so do null
+    # fields, and a val getting None is filtered out.
+    #
+    # With --json, the new val is compact JSON text instead. With --str,
+    # each value is text: strings as they are, None as an empty string, and
+    # other values as compact JSON. Steps that need text, like grep, need
+    # one PATH and one of those options, as field values can be numbers.
+
+    def begin(self, opts):
+        if opts.json and opts.str:
+            raise ValueError('{}: --json and --str are exclusive'.format(self.name))
+        default = opts.default
+        if default is not None:
+            try:
+                default = json.loads(default)
+            except ValueError:
+                pass
+        opts.get = get_fields_func(opts.paths, default, opts.json, opts.str, not opts.no_scan)
+
+    def process(self, opts, meta, val):
+        return opts.get(val)
+
+    def process_batch(self, opts, meta, vals):
+        return list(map(opts.get, vals))
+
+    def fuse(self, opts):
+        return (FUSE_FILTER, dict(f = opts.get))
+
+def get_fields_func(paths, default, as_json, as_str, scan):
+    # Returns the function used by JsonL to get the new val.
+    proj = Projection(paths, scan = scan)
+    get = proj.get
+    decode = DECODER.decode
+    if not paths:
+        f = decode
+    elif len(paths) == 1:
+        if as_str:
+            def f(val):
+                x = get(val)[0]
+                x = default if x is MISSING or x is None else x
+                return None if x is None else to_text(x)
+            return f
+        def f(val):
+            x = get(val)[0]
+            return default if x is MISSING or x is None else x
+    elif as_str:
+        def f(val):
+            return tuple(to_text(default if x is MISSING else x) for x in get(val))
+        return f
+    else:
+        def f(val):
+            return tuple(default if x is MISSING else x for x in get(val))
+    if as_json or as_str:
+        g = f
+        def f(val):
+            x = g(val)
+            return None if x is None else to_json(x)
+    return f
+
 ####
 # Other.
 ####
@@ -491,25 +1949,34 @@ class JsonD(Step):
 class FlipFlop(Step):
 
     DESC = 'Filter VALs using flip-flop regexes'
-    USAGE = 'RGX RGX'
+    USAGE = 'RGX RGX [--once]'
 
     OPTS_CONFIG = [
         'rgx1',
         dict(),
         'rgx2',
         dict(),
+        '--once',
+        dict(action = 'store_true'),
     ]
 
     def begin(self, opts):
-        opts.rgx1 = re.compile(opts.rgx1)
-        opts.rgx2 = re.compile(opts.rgx2)
+        opts.rgx1 = self.compile(opts.rgx1)
+        opts.rgx2 = self.compile(opts.rgx2)
         opts.on = False
+        opts.closed = False
 
     def process(self, opts, meta, val):
-        if opts.on:
+        if opts.closed:
+            return None
+        elif opts.on:
             m = opts.rgx2.search(val)
             if m:
                 opts.on = False
+                if opts.once:
+                    # With --once, the step is done after the first range.
+                    opts.closed = True
+                    self.done(run = True)
         else:
             m = opts.rgx1.search(val)
             if m:
@@ -523,6 +1990,7 @@ class Para(Step):
 
     DESC = 'Group VALs as paragraphs and emit'
     USAGE = '.'
+    SCOPE = 'file'
 
     def begin(self, opts):
         self.para = []
@@ -548,21 +2016,288 @@ class Para(Step):
 class Uniq(Step):
 
     DESC = 'Emit unique VALs'
-    USAGE = '.'
+    USAGE = '[--sorted] [--stream] [--hash] [--bloom P [--capacity N]] [--spill SIZE]'
+    BYTES = True
+    MERGE = True
+
+    OPTS_CONFIG = [
+        '--sorted',
+        dict(action = 'store_true'),
+        '--stream',
+        dict(action = 'store_true'),
+        '--hash',
+        dict(action = 'store_true'),
+        '--bloom',
+        dict(type = float, metavar = 'P'),
+        '--capacity',
+        dict(type = int, default = 10 ** 7, metavar = 'N'),
+        '--spill',
+        dict(type = parse_size, metavar = 'SIZE'),
+    ]
+
+    # The modes:
+    #
+    # - By default, the unique vals are held in memory and emitted at the end.
+    #
+    # - With --sorted, the input must be sorted. Each val is emitted as soon
+    #   as it differs from the prior one, taking constant memory.
+    #
+    # - With --stream, each val is emitted as soon as it is first seen. The
+    #   seen vals are held in memory -- or, with --hash, just their hashes,
+    #   which can collide. With --bloom, they go into a Bloom filter sized for
+    #   N distinct vals, taking fixed memory but dropping a fraction P of the
+    #   unique vals as false positives. Both options imply --stream.
+    #
+    # - With --spill, the unique vals are exact and emitted at the end, but
+    #   once the vals held in memory exceed SIZE, they are written to sorted
+    #   runs on disk and deduplicated by merging the runs.
+    #
+    # Only the default mode can be merged (see --jobs).
 
     def begin(self, opts):
+        self.prev = UNSET
+        if opts.sorted:
+            self.seen = None
+            opts.spill = None
+        elif opts.bloom:
+            self.seen = BloomFilter(opts.capacity, opts.bloom)
+        elif opts.hash or opts.stream:
+            self.seen = SeenSet(hashed = opts.hash)
+        else:
+            self.seen = None
+        if opts.sorted or self.seen is not None or opts.spill:
+            self.MERGE = False
         self.reset()
 
     def process(self, opts, meta, val):
-        if val not in self.uniq:
-            self.uniq[val] = None
+        if opts.sorted:
+            if val != self.prev:
+                self.advance(val)
+                return val
+        elif self.seen is not None:
+            return None if self.seen.add(val) else val
+        elif val not in self.uniq:
+            if opts.spill:
+                self.add_spillable(opts, val)
+            else:
+                self.uniq[val] = None
+
+    def process_batch(self, opts, meta, vals):
+        if self.seen is not None:
+            add = self.seen.add
+            return [None if add(v) else v for v in vals]
+        elif opts.sorted or opts.spill:
+            return [self.process(opts, meta, v) for v in vals]
+        else:
+            self.uniq.update(dict.fromkeys(vals))
+
+    def fuse(self, opts):
+        if opts.sorted:
+            return (FUSE_UNIQ_SORTED, {})
+        elif self.seen is not None:
+            return (FUSE_UNIQ_STREAM, dict(add = self.seen.add))
+        elif opts.spill:
+            return None
+        return (FUSE_UNIQ, {})
 
     def finalize(self, opts, meta):
-        if meta.is_last_file and self.uniq:
-            res = self.uniq
+        if meta.is_last_file and (self.uniq or self.sorter):
+            uniq = self.uniq
+            sorter = self.sorter
             self.reset()
-            return ValIter(res)
+            if sorter is not None:
+                self.spill(uniq, sorter)
+                return ValIter(self.merge_runs(sorter))
+            return ValIter(uniq)
 
     def reset(self):
         self.uniq = collections.OrderedDict()
+        self.n = 0
+        self.size = 0
+        self.sorter = None
+
+    def advance(self, val):
+        # In --sorted mode: starts a new run of equal vals.
+        check_sorted(self, self.prev, val)
+        self.prev = val
+
+    def add_spillable(self, opts, val):
+        # Adds a new val in --spill mode, recording its overall index.
+        self.uniq[val] = self.n
+        self.n += 1
+        self.size += sys.getsizeof(val) + UNIQ_ENTRY_SIZE
+        if self.size > opts.spill:
+            self.spill()
+
+    def spill(self, uniq = None, sorter = None):
+        # Moves the unique vals from memory to the sorter, as (KEY, I)
+        # tuples: the pickled val (sortable regardless of the type of the
+        # val) and its index. A val can recur in later spills, with a
+        # higher index.
+        if uniq is None:
+            uniq = self.uniq
+            self.uniq = collections.OrderedDict()
+            self.size = 0
+        if sorter is None:
+            if self.sorter is None:
+                self.sorter = ExternalSorter(self.opts.spill)
+            sorter = self.sorter
+        for val, i in uniq.items():
+            sorter.add((pickle.dumps(val, pickle.HIGHEST_PROTOCOL), i))
+
+    def merge_runs(self, sorter):
+        # Yields the unique vals in the order they were first seen. A merge
+        # of the sorted runs finds the lowest index for each val; a second
+        # sort puts the vals back in index order.
+        by_index = ExternalSorter(self.opts.spill)
+        try:
+            for k, grp in itertools.groupby(sorter, key = lambda r: r[0]):
+                by_index.add((next(grp)[1], k))
+            for i, k in by_index:
+                yield pickle.loads(k)
+        finally:
+            sorter.close()
+            by_index.close()
+
+    def merge(self, other):
+        self.uniq.update(dict.fromkeys(other.uniq))
+
+# The estimated memory used by each entry in the dict held by Uniq,
+# beyond the val itself.
+UNIQ_ENTRY_SIZE = 100
+
+def check_sorted(step, prev, val):
+    # For the --sorted options: fails if a val sorts before the prior one.
+    if prev is not UNSET and val < prev:
+        fmt = '{} --sorted: input is not sorted: {!r} follows {!r}'
+        raise ValueError(fmt.format(step.name, val, prev))
+
+# A placeholder for the prior val, before the first one arrives.
+UNSET = object()
+
+####
+# Code templates used by fuse() methods.
+####
 
+FUSE_PR_BYTES = """\
+if isinstance(val, bytes):
+    {self}.write(val + b'\\n')
+else:
+    {out}({decode}(val))"""
+
+FUSE_WR_BYTES = """\
+if isinstance(val, bytes):
+    {self}.write(val)
+else:
+    {out}({decode}(val), end = '')"""
+
+FUSE_DECODE = """\
+if isinstance(val, bytes):
+    val = val.decode({self}.encoding, {errors})
+else:
+    val = {process}({opts}, meta, val)"""
+
+FUSE_HEAD = """\
+if meta.line_num >= {n}:
+    {self}.done()
+    if meta.line_num > {n}:
+        continue"""
+
+FUSE_CSV = """\
+if {cond}:
+    val = val.rstrip('\\r\\n').split({{d}}, {{n}})
+    val = val[{{i}}] if len(val) > {{i}} else None
+else:
+    val = {{get}}(val)
+if val is None:
+    continue"""
+
+FUSE_FIELD = """\
+try:
+    {code}
+except IndexError:
+    continue"""
+
+FUSE_GROUPBY_FIELDS = """\
+xs = val.split(None, {maxsplit})
+if len(xs) > {hi}:
+    {{add}}(xs[{f}], xs[{v}])
+else:
+    {code}"""
+
+FUSE_INT = """\
+try:
+    val = int(val)
+except ValueError:
+    val = int(float(val))"""
+
+FUSE_STATS = """\
+if val.__class__ is str:
+    val = {parse}(val)
+try:
+    {append}(val)
+except (TypeError, OverflowError):
+    {add}(val)
+continue"""
+
+FUSE_FILTER = """\
+val = {f}(val)
+if val is None:
+    continue"""
+
+FUSE_INDEX = """\
+try:
+    val = val[{i}]
+except IndexError:
+    continue
+if val is None:
+    continue"""
+
+FUSE_NL = """\
+if not val.endswith('\\n'):
+    val = val + '\\n'"""
+
+FUSE_SEARCH = """\
+m = {search}(val)
+if not m:
+    continue
+val = m.group({g})
+if val is None:
+    continue"""
+
+FUSE_PREFILTER = """\
+if {lit} not in val:
+    continue
+"""
+
+FUSE_SEARCH_F = """\
+val = {find}(val)
+if val is None:
+    continue"""
+
+FUSE_SEARCH_A = """\
+m = {search}(val)
+if not m:
+    continue
+val = m.groups()"""
+
+FUSE_FREQ_SORTED = """\
+if val == {self}.prev:
+    {self}.n += 1
+else:
+    {self}.advance(val)
+continue"""
+
+FUSE_UNIQ = """\
+if val not in {self}.uniq:
+    {self}.uniq[val] = None
+continue"""
+
+FUSE_UNIQ_SORTED = """\
+if val == {self}.prev:
+    continue
+{self}.advance(val)"""
+
+FUSE_UNIQ_STREAM = """\
+if {add}(val):
+    continue"""
@@ -0,0 +1,148 @@
+####
+# Compiling the steps of a nab run into fused Python functions.
+#
+# For a typical run like `-s chomp -s split -s index 4 -s int -s sum`,
+# the stack machine in cli.do_process_lines() spends most of its time on
+# bookkeeping: creating Val tuples, pushing and popping them, and checking
+# types. This module generates the source code for a few functions that do
+# the same work in a single loop:
+#
+#   def _make(meta, ...):
+#       def _read(fset):
+#           for val in fset:
+#               if meta.stop:
+#                   break
+#               try:
+#                   meta.orig = val
+#                   meta.line_num += 1
+#                   meta.overall_num += 1
+#                   val = val.rstrip('\n')
+#                   val = _2_split(val)
+#                   ...
+#               except Exception:
+#                   ...
+#       def _feed_1(v):
+#           ...
+#       return (_read, {1: _feed_1, ...})
+#
+# A step can supply the code for its portion of the loop via its fuse()
+# method: see Step.fuse(). Otherwise, the generated code calls the step's
+# process() method and handles the return value just as the stack machine
+# would: None filters the val out; a ValIter fans out into multiple vals,
+# each forwarded to the downstream steps.
+####
+
+from __future__ import absolute_import, unicode_literals, print_function
+
+from .step import get_hook
+from .utils import write_step_error, ValIter
+
+def compile_steps(opts):
+    # Takes the Opts for a run. Compiles the steps and returns a (READ,
+    # FORWARD) tuple of functions, ready for use by cli.do_process_fsets().
+    steps = opts.steps
+    ns = dict(
+        meta = opts.meta,
+        ValIter = ValIter,
+        write_step_error = write_step_error,
+    )
+
+    # Assemble the body of the line loop for each step index where
+    # vals can enter the pipeline: 0 for input lines and 1+ for vals
+    # returned by finalize() methods.
+    bodies = [get_step_code(steps, i, ns) for i in range(len(steps) or 1)]
+
+    # Assemble the source code.
+    lines = ['def _make({}):'.format(', '.join(sorted(ns)))]
+    lines.extend(indent(FUNC_READ, 1))
+    lines.extend(indent(bodies[0], 4))
+    lines.extend(indent(FUNC_EXCEPT, 1))
+    for i in range(1, len(steps)):
+        lines.extend(indent(FUNC_FEED.format(i), 1))
+        lines.extend(indent(bodies[i], 4))
+        lines.extend(indent(FUNC_EXCEPT, 1))
+    feeds = ', '.join('{}: _feed_{}'.format(i, i) for i in range(1, len(steps)))
+    lines.append('    return (_read, {{{}}})'.format(feeds))
+    code = '\n'.join(lines) + '\n'
+
+    # Compile it and create the functions.
+    d = {}
+    exec(code, globals(), d)
+    read, feeds = d['_make'](**ns)
+    return (read, lambda i, v: feeds[i](v))
+
+def get_step_code(steps, i, ns):
+    # Returns a list of source code lines to run a val through the steps,
+    # starting with the step at index i. Adds the objects needed by that
+    # code to the ns dict.
+    lines = []
+    depth = 0
+    max_i = len(steps) - 1
+    for j in range(i, max_i + 1):
+        s = steps[j]
+        fused = get_hook(s, 'fuse')(s.opts)
+        if fused:
+            # A fused step: add its code, after replacing its placeholders
+            # with names that are unique to the step.
+            code, names = fused
+            names = dict(names, self = s, opts = s.opts)
+            uniq = {k : '_{}_{}'.format(j, k) for k in names}
+            ns.update((uniq[k], v) for k, v in names.items())
+            xs = code.format(**uniq).split('\n')
+        elif j == max_i:
+            # The last step: just call its process() method. As in the
+            # stack machine, any returned val is ignored.
+            ns['_{}_process'.format(j)] = s.process
+            ns['_{}_opts'.format(j)] = s.opts
+            xs = ['_{0}_process(_{0}_opts, meta, val)'.format(j)]
+        else:
+            # A regular step: call its process() method and skip to the next
+            # val if it returns None. Otherwise, loop over the val(s) returned:
+            # the rest of the code will be nested inside that loop.
+            ns['_{}_process'.format(j)] = s.process
+            ns['_{}_opts'.format(j)] = s.opts
+            xs = STEP_CALL.format(j).split('\n')
+        lines.extend(indent(xs, depth))
+        if not fused and j < max_i:
+            depth += 1
+    return lines or ['pass']
+
+def indent(xs, n):
+    # Takes some lines of code, either as a list or a string. Returns them
+    # as a list, indented by N levels.
+    xs = xs.split('\n') if isinstance(xs, str) else xs
+    return [('    ' * n + x) if x else x for x in xs]
+
+####
+# Code templates.
+####
+
+FUNC_READ = """\
+def _read(fset):
+    for val in fset:
+        if meta.stop:
+            break
+        try:
+            meta.orig = val
+            meta.line_num += 1
+            meta.overall_num += 1"""
+
+FUNC_FEED = """\
+def _feed_{}(v):
+    for val in (v if isinstance(v, ValIter) else (v,)):
+        if val is None:
+            break
+        try:"""
+
+FUNC_EXCEPT = """\
+        except Exception:
+            write_step_error(meta, repr(val))
+            raise"""
+
+STEP_CALL = """\
+_v = _{0}_process(_{0}_opts, meta, val)
+if _v is None:
+    continue
+for val in (_v if isinstance(_v, ValIter) else (_v,)):
+    if val is None:
+        break"""
@@ -0,0 +1,171 @@
+####
+# Getting fields from JSON documents (see the jsonl step).
+#
+# A field path names a value within a document: keys separated by dots, and
+# list indexes in brackets, as in a.b[0].c. Getting a few fields from each
+# line of a JSON Lines file does not require parsing the whole line. For the
+# first key of a path, a Projection looks for the key, as a JSON string, in
+# the raw text:
+#
+# - If the key is absent, so is the field, and there is nothing to parse.
+#
+# - If the key appears once, with no object or list opening before it other
+#   than the document itself, it can only be a top-level key. Its value is
+#   parsed on its own, starting just after the colon.
+#
+# Otherwise, the whole document is parsed, once per val. Paths for which the
+# scan mostly fails stop using it, which suits logs whose keys come in a
+# consistent order. Each scan costs roughly half as much as parsing a typical
+# log line, so with more than SCAN_MAX paths, documents are always parsed.
+#
+# A scan finds the same values as a full parse, with two exceptions: it does
+# not check the rest of the document, so a malformed line can yield fields
+# rather than an error; and for a document with duplicate keys (which JSON
+# leaves undefined), it can find a different one.
+####
+
+from __future__ import absolute_import, unicode_literals, print_function
+
+import json
+import re
+
+class Projection(object):
+
+    def __init__(self, paths, scan = True):
+        self.paths = [parse_path(p) for p in paths]
+        # For each path starting with a key: the key as a JSON string, or
+        # None if the path does not use the scan.
+        self.needles = [
+            json.dumps(p[0], ensure_ascii = False)
+            if scan and p and not isinstance(p[0], int) else None
+            for p in self.paths
+        ]
+        if len(self.paths) - self.needles.count(None) > SCAN_MAX:
+            self.needles = [None] * len(self.paths)
+        # The number of vals seen, and of failed scans for each path. After
+        # SCAN_TRIAL vals, paths whose scan failed for most of them stop
+        # using it, as a failed scan only adds to the cost of the parse.
+        self.n = 0
+        self.failed = [0] * len(self.paths)
+
+    def get(self, val):
+        # Takes the text of a document. Returns a list of the values of the
+        # paths, with MISSING for the absent ones.
+        self.n += 1
+        if self.n == SCAN_TRIAL:
+            self.end_trial()
+        xs = []
+        doc = UNPARSED
+        for i, path in enumerate(self.paths):
+            needle = self.needles[i]
+            x = UNPARSED
+            if needle and doc is UNPARSED:
+                x = scan_key(val, needle)
+                keys = path[1:]
+                if x is UNPARSED:
+                    self.failed[i] += 1
+            if x is UNPARSED:
+                if doc is UNPARSED:
+                    doc = DECODER.decode(val)
+                x = doc
+                keys = path
+            xs.append(walk(x, keys))
+        return xs
+
+    def end_trial(self):
+        for i, n in enumerate(self.failed):
+            if n * 2 > self.n:
+                self.needles[i] = None
+
+def scan_key(val, needle):
+    # Takes the text of a document and a top-level key, as a JSON string.
+    # Returns the value of the key, MISSING if the key is absent, or
+    # UNPARSED if the scan cannot tell. Keys can also be spelled with \u
+    # escapes (or, for slashes, \/), so absence is certain only if the text
+    # has neither.
+    i = val.find(needle)
+    if i < 0:
+        if '\\u' in val or '\\/' in val:
+            return UNPARSED
+        return MISSING
+    j = i + len(needle)
+    ok = (
+        val.find(needle, j) < 0 and
+        val.count('{', 0, i) == 1 and
+        val.find('[', 0, i) < 0 and
+        val[i - 1] != '\\'
+    )
+    if ok:
+        m = COLON_RGX.match(val, j)
+        if m:
+            try:
+                return DECODER.scan_once(val, m.end())[0]
+            except StopIteration:
+                pass
+    return UNPARSED
+
+def walk(x, keys):
+    # Follows the keys from a value. Returns the value at their end, or
+    # MISSING. Indexes apply only to lists, and keys only to objects.
+    for k in keys:
+        if x is MISSING:
+            break
+        elif isinstance(k, int):
+            if isinstance(x, list) and -len(x) <= k < len(x):
+                x = x[k]
+            else:
+                x = MISSING
+        elif isinstance(x, dict):
+            x = x.get(k, MISSING)
+        else:
+            x = MISSING
+    return x
+
+def parse_path(path):
+    # Takes a field path, as in a.b[0].c. Returns a tuple of keys (str) and
+    # indexes (int).
+    keys = []
+    pos = 0
+    while pos < len(path):
+        m = PATH_RGX.match(path, pos)
+        if not m or (m.group(1) and pos and not m.group(0).startswith('.')):
+            raise ValueError('invalid field path: {!r}'.format(path))
+        if m.group(1) is None:
+            keys.append(int(m.group(2)))
+        else:
+            keys.append(m.group(1))
+        pos = m.end()
+    if not keys:
+        raise ValueError('invalid field path: {!r}'.format(path))
+    return tuple(keys)
+
+def to_json(x):
+    # Compact JSON text for a value.
+    return COMPACT.encode(x)
+
+def to_text(x):
+    # Text for a value: a string as it is, None as an empty string, and
+    # anything else as compact JSON.
+    if isinstance(x, str):
+        return x
+    elif x is None:
+        return ''
+    else:
+        return COMPACT.encode(x)
+
+# Values used by get(): one for absent fields, the other for documents
+# (or values) not yet parsed.
+MISSING = object()
+UNPARSED = object()
+
+# The decoder and encoder, created once rather than for each val.
+DECODER = json.JSONDecoder()
+COMPACT = json.JSONEncoder(ensure_ascii = False, separators = (',', ':'))
+
+# The number of vals after which to stop unhelpful scans, and the most
+# paths for which to use them.
+SCAN_TRIAL = 1000
+SCAN_MAX = 2
+
+PATH_RGX = re.compile(r'\.?([^.\[\]]+)|\[(-?\d+)\]')
+COLON_RGX = re.compile(r'[ \t\n\r]*:[ \t\n\r]*')
@@ -0,0 +1,252 @@
+####
+# Processing input in parallel worker processes.
+#
+# With --jobs N, the FileSet instances of a run are spread across a pool of
+# worker processes. With --split SIZE, large input files are also cut into
+# pieces at line boundaries, each handled as a separate task, provided that
+# no step relies on per-file state or line numbers. The approach:
+#
+# - The parent executes the begin and discover phases, as usual, and then
+#   forks the workers, which inherit the steps in their post-begin state.
+#
+# - Each worker runs one FileSet (or piece of one) through the initialize,
+#   process, and finalize phases, using the regular engine. Output written
+#   to handles that nab did not open itself (for example, STDOUT) is
+#   captured in temp files, whose paths are returned to the parent, along
+#   with the steps that keep state across files (those whose SCOPE is
+#   'run'). Spooling the output to disk keeps the memory used by a task
+#   independent of the amount of output.
+#
+# - The parent copies the captured output, a block at a time, in input
+#   order, and folds the returned steps together via Step.merge().
+#
+# - The last task is processed by the parent itself, after merging the
+#   state from the workers into its own steps. As a result, steps that emit
+#   their results during the finalize phase of the last file (like Tail and
+#   Uniq) behave exactly as they would in a serial run.
+#
+# One difference from a serial run: within a worker, meta.overall_num
+# counts only the lines of the worker's task. Likewise, meta.line_num is
+# relative to the start of a piece, which is why steps relying on line
+# numbers prevent splitting.
+####
+
+from __future__ import absolute_import, unicode_literals, print_function
+
+import io
+import os
+import shutil
+import sys
+import tempfile
+
+def get_parallel_tasks(opts):
+    # Returns a list of (I, RANGE) tuples, one for each task in a parallel
+    # run: the index of a FileSet, along with either None (process the whole
+    # file) or a (START, STOP) tuple of byte offsets (process a piece of it).
+    # Returns None if the run cannot be processed in parallel, warning the
+    # user if appropriate.
+    for s in opts.steps:
+        if s.SCOPE == 'run' and not can_merge(s):
+            fmt = 'step {} keeps state across files but cannot merge it'
+            warn(fmt.format(s.name))
+            return None
+
+    # Splitting files is an option only if every step either is unaffected
+    # by the position of a val in its file or can merge its state.
+    size = opts.split
+    if size:
+        for s in opts.steps:
+            if s.SCOPE == 'file':
+                fmt = 'not splitting files: step {} relies on per-file state'
+                warn(fmt.format(s.name), serial = False)
+                size = 0
+                break
+
+    # Assemble the tasks. The multiprocessing module is imported only when
+    # needed, as it adds noticeably to the startup time of nab.
+    import multiprocessing
+    tasks = [
+        (i, rng)
+        for i, fset in enumerate(opts.fsets)
+        for rng in get_ranges(fset, size)
+    ]
+    if len(tasks) < 2:
+        return None
+    elif 'fork' not in multiprocessing.get_all_start_methods():
+        warn('requires the fork start method')
+        return None
+    else:
+        return tasks
+
+def can_merge(step):
+    # See Step.MERGE, which Uniq, for one, turns off in some modes.
+    return step.MERGE
+
+def get_ranges(fset, size):
+    # Takes a FileSet and a size in bytes. Returns a list of byte ranges that
+    # split its input file into pieces of roughly that size, each starting at
+    # the beginning of a line -- or [None] if the input cannot be split. The
+    # input must be an uncompressed regular file opened by nab, and its output
+    # must be written to handles that nab did not open (for example, STDOUT),
+    # which get captured and reassembled in order.
+    inp = fset.inp
+    if fset.inp_range:
+        # Already limited to a range (see Tail).
+        return [fset.inp_range]
+    ok = (
+        size and
+        not inp.handle and
+        fset.out.handle and
+        fset.err.handle and
+        os.path.isfile(inp.path) and
+        os.path.getsize(inp.path) > size and
+        not fset.get_compression(inp)
+    )
+    if not ok:
+        return [None]
+    stop = os.path.getsize(inp.path)
+    offsets = [0]
+    with open(inp.path, 'rb') as fh:
+        while offsets[-1] + size < stop:
+            fh.seek(offsets[-1] + size)
+            fh.readline()
+            if fh.tell() >= stop:
+                break
+            offsets.append(fh.tell())
+    offsets.append(stop)
+    return list(zip(offsets, offsets[1:]))
+
+def process_parallel(opts, engine, tasks):
+    # Executes the initialize, process, and finalize phases of the run. All
+    # tasks except the last are processed in worker processes.
+    global WORKER_ARGS
+    spool = tempfile.mkdtemp(prefix = 'nab-jobs-')
+    WORKER_ARGS = (opts, engine, spool)
+    try:
+        process_tasks(opts, engine, tasks)
+    finally:
+        shutil.rmtree(spool, ignore_errors = True)
+
+def process_tasks(opts, engine, tasks):
+    fsets = opts.fsets
+    n = len(tasks) - 1
+    jobs = min(opts.jobs or os.cpu_count() or 1, n)
+
+    # Process the tasks in workers. Each worker process handles only one
+    # task: that way, every task starts with the steps in their post-begin
+    # state. For that reason, the parent does not alter its own steps until
+    # all workers are done.
+    import multiprocessing
+    merged = None
+    n_lines = 0
+    ctx = multiprocessing.get_context('fork')
+    with ctx.Pool(jobs, maxtasksperchild = 1) as pool:
+        results = pool.imap(process_worker, tasks[:-1])
+        for (i, rng), (outputs, k_lines, states) in zip(tasks, results):
+            for k, path in outputs:
+                write_output(getattr(fsets[i], k).handle, path)
+            n_lines += k_lines
+            if merged is None:
+                merged = states
+            else:
+                for s, other in zip(merged, states):
+                    if s is not None:
+                        s.merge(other)
+
+    # Merge the worker states into the parent's steps, and set up the Meta
+    # instance as though the parent had processed the prior tasks.
+    for s, other in zip(opts.steps, merged):
+        if other is not None:
+            s.merge(other)
+    i, rng = tasks[-1]
+    opts.meta.file_num = i
+    opts.meta.overall_num += n_lines
+
+    # Process the last task.
+    fsets[i].inp_range = rng
+    engine(opts, fsets[i:i + 1])
+
+def process_worker(task):
+    # Runs in a worker process. Takes an (I, RANGE) task. Processes it,
+    # capturing the output written to handles that nab did not open, and
+    # returns an (OUTPUTS, N_LINES, STATES) tuple: a list of (STREAM, PATH)
+    # tuples, for the temp files holding the output, the number of lines
+    # read, and the steps whose state must be merged by the parent (None
+    # for the other steps).
+    opts, engine, spool = WORKER_ARGS
+    i, rng = task
+    fset = opts.fsets[i]
+    fset.inp_range = rng
+    meta = opts.meta
+    meta.file_num = i
+    meta.partial = True
+
+    # Replace handles that nab did not open with temp files. They write
+    # through to bytes, which steps can also write directly (see --bytes),
+    # so that the two kinds of output stay in order.
+    bufs = {}
+    streams = []
+    for k in (fset.OUT, fset.ERR):
+        fh = getattr(fset, k)
+        if not fh.should_close:
+            if id(fh.handle) not in bufs:
+                enc = getattr(fh.handle, 'encoding', None) or ENCODING
+                fd, path = tempfile.mkstemp(dir = spool)
+                buf = io.TextIOWrapper(
+                    io.open(fd, 'wb'),
+                    encoding = enc,
+                    write_through = True,
+                )
+                bufs[id(fh.handle)] = buf
+                streams.append((k, path, buf))
+            fh.handle = bufs[id(fh.handle)]
+
+    # Process the FileSet.
+    ok = False
+    try:
+        engine(opts, [fset])
+        ok = True
+    finally:
+        fset.close_handles(ok)
+        # Complete any compressed streams (see --compress): the output of
+        # each task is a separate one, and the parent writes them in order.
+        fset.streams.close()
+
+    # Return the results.
+    for k, path, buf in streams:
+        buf.close()
+    outputs = [
+        (k, path)
+        for k, path, buf in streams
+        if os.path.getsize(path)
+    ]
+    states = [s if s.SCOPE == 'run' else None for s in opts.steps]
+    return (outputs, meta.overall_num, states)
+
+def write_output(handle, path):
+    # Copies the output captured by a worker to a handle, via its underlying
+    # binary buffer if it has one, and deletes the temp file.
+    handle.flush()
+    if hasattr(handle, 'buffer'):
+        with open(path, 'rb') as fh:
+            shutil.copyfileobj(fh, handle.buffer, COPY_BUFSIZE)
+        handle.buffer.flush()
+    else:
+        enc = getattr(handle, 'encoding', None) or ENCODING
+        with io.open(path, encoding = enc, newline = '') as fh:
+            shutil.copyfileobj(fh, handle, COPY_BUFSIZE)
+    os.remove(path)
+
+def warn(msg, serial = True):
+    prefix = 'running serially: ' if serial else ''
+    sys.stderr.write('nab: --jobs: {}{}\n'.format(prefix, msg))
+
+# The encoding of captured output, if the handle does not say.
+ENCODING = 'utf-8'
+
+# The size of the blocks in which captured output is copied.
+COPY_BUFSIZE = 2 ** 20
+
+# The arguments used by process_worker(), inherited from the parent
+# process when the worker is forked.
+WORKER_ARGS = None
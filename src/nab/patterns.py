@@ -0,0 +1,377 @@
+####
+# Matching regexes efficiently.
+#
+# Part 1: literal prefilters. Most vals passed to a regex-based step cannot
+# match, and a plain substring check rules them out faster than the regex
+# engine can. A NabRgx wraps a compiled regex along with the longest literal
+# substring that every match must contain, found by analyzing the parsed
+# regex. Its methods return early for vals lacking the literal.
+#
+# Part 2: matching many patterns at once (see grep -f and search -f).
+#
+# A PatternSet finds the first place in a val where any of its patterns
+# match, and reports which pattern that was. How it matches depends on the
+# patterns:
+#
+# - Literal strings: via an Aho-Corasick automaton, if the optional
+#   pyahocorasick library is installed, which takes linear time regardless
+#   of the number of patterns. Otherwise, via a regex shaped like a trie of
+#   the strings, so that the regex engine never tries a common prefix more
+#   than once. Either way, the longest pattern matching at the leftmost
+#   position wins.
+#
+# - Regexes: via a single regex combining them as alternatives, each in its
+#   own group, so that the match reveals its pattern. Where several match at
+#   the leftmost position, the first one listed wins. Patterns that cannot
+#   be combined (those with backreferences, whose group numbers would shift,
+#   or with clashing group names or flags) are searched one at a time.
+#
+# The patterns and vals can be text or bytes (see --bytes), but not both.
+####
+
+from __future__ import absolute_import, unicode_literals, print_function
+
+import re
+
+try:
+    from re import _constants as sre_constants, _parser as sre_parse
+except ImportError:
+    import sre_constants
+    import sre_parse
+
+####
+# Literal prefilters.
+####
+
+class NabRgx(object):
+    # A compiled regex with a literal prefilter. Steps use its methods when
+    # processing one val at a time; their fused and batch code checks the
+    # literal inline (lit is None when there is no prefilter). The methods
+    # count the vals rejected by the prefilter, for --profile.
+
+    def __init__(self, rgx, prefilter = True):
+        self.rgx = rgx
+        self.lit = required_literal(rgx) if prefilter else None
+        self.rejected = 0
+
+    def __repr__(self):
+        return 'NabRgx({!r}, lit = {!r})'.format(self.rgx.pattern, self.lit)
+
+    def search(self, val):
+        if self.lit is not None and self.lit not in val:
+            self.rejected += 1
+            return None
+        return self.rgx.search(val)
+
+    def sub(self, repl, val, count = 0):
+        if self.lit is not None and self.lit not in val:
+            self.rejected += 1
+            return val
+        return self.rgx.sub(repl, val, count)
+
+    def findall(self, val):
+        if self.lit is not None and self.lit not in val:
+            self.rejected += 1
+            return []
+        return self.rgx.findall(val)
+
+def required_literal(rgx):
+    # Takes a compiled regex. Returns the longest literal substring (str or
+    # bytes, like the pattern) that every match must contain, or None.
+    if rgx.flags & re.IGNORECASE:
+        return None
+    try:
+        parsed = sre_parse.parse(rgx.pattern, rgx.flags)
+    except Exception:
+        return None
+    runs = literal_runs(parsed)
+    if not runs:
+        return None
+    run = max(runs, key = len)
+    if isinstance(rgx.pattern, bytes):
+        return bytes(bytearray(run))
+    else:
+        return ''.join(map(chr, run))
+
+def literal_runs(items):
+    # Takes a parsed regex: a sequence of (OP, ARGS) items. Returns a list of
+    # the runs of literal characters (as lists of code points) that every
+    # match must contain. The analysis is conservative: it looks inside
+    # groups and required repetitions but ignores alternatives.
+    c = sre_constants
+    repeats = (c.MAX_REPEAT, c.MIN_REPEAT, getattr(c, 'POSSESSIVE_REPEAT', None))
+    runs = []
+    run = []
+    for op, av in items:
+        if op is c.LITERAL:
+            run.append(av)
+            continue
+        elif op is c.AT:
+            # Anchors match no characters, so the run can continue.
+            continue
+        if run:
+            runs.append(run)
+            run = []
+        if op is c.SUBPATTERN:
+            add_flags = av[1]
+            if not add_flags & re.IGNORECASE:
+                runs.extend(literal_runs(av[-1]))
+        elif op is getattr(c, 'ATOMIC_GROUP', None):
+            runs.extend(literal_runs(av))
+        elif op in repeats:
+            lo, hi, sub = av
+            if lo >= 1:
+                runs.extend(literal_runs(sub))
+    if run:
+        runs.append(run)
+    return runs
+
+####
+# Matching many patterns at once.
+####
+
+class PatternSet(object):
+
+    def __init__(self, patterns, literal = None, ignore_case = False):
+        # If literal is None, the patterns are taken as literal strings
+        # unless one of them contains a regex metacharacter. The instance
+        # gets two methods, based on the patterns: search(VAL) returns a
+        # (PATTERN, MATCHED) tuple for the first match in the val, or None;
+        # and test(VAL) returns a true value if any pattern matches.
+        self.patterns = list(patterns)
+        if literal is None:
+            literal = all(map(is_literal, self.patterns))
+        self.literal = literal
+        self.ignore_case = ignore_case
+        self.automaton = None
+        self.rgx = None
+        if not self.patterns:
+            # A regex that never matches.
+            self.rgx = re.compile(r'(?!)')
+            self.search = lambda val: None
+            self.test = self.rgx.search
+        elif literal:
+            self.init_literal()
+        else:
+            self.init_regex()
+
+    def init_literal(self):
+        # Map each string to its pattern: the first one listed, if they
+        # collide when ignoring case.
+        fold = self.fold
+        self.lookup = {}
+        for p in self.patterns:
+            self.lookup.setdefault(fold(p), p)
+        ahocorasick = get_ahocorasick()
+        text = not isinstance(self.patterns[0], bytes)
+        if ahocorasick and text:
+            a = ahocorasick.Automaton()
+            for k, p in self.lookup.items():
+                a.add_word(k, (len(k), p))
+            a.make_automaton()
+            self.automaton = a
+            self.maxlen = max(map(len, self.lookup))
+            self.search = self.search_automaton
+            self.test = self.test_automaton
+        else:
+            f = re.IGNORECASE if self.ignore_case else 0
+            self.rgx = re.compile(trie_regex(list(self.lookup)), flags = f)
+            self.search = self.search_trie
+            self.test = self.rgx.search
+
+    def init_regex(self):
+        # Two combined regexes. In the first, used to find matches, each
+        # regex is in a non-capturing group, as the regex engine handles
+        # many capturing groups slowly. In the second, used only to tell
+        # which pattern matched, each regex is in a capturing group; the
+        # lastindex of a match is the outermost group containing it. Map
+        # those group numbers to the patterns.
+        f = re.IGNORECASE if self.ignore_case else 0
+        text = isinstance(self.patterns[0], str)
+        enc = (lambda x: x) if text else (lambda x: x.encode('ascii'))
+        self.compiled = [(p, re.compile(p, f)) for p in self.patterns]
+        if any(has_backrefs(rgx) for p, rgx in self.compiled):
+            self.init_each()
+            return
+        self.groups = {}
+        n = 1
+        for p, rgx in self.compiled:
+            self.groups[n] = p
+            n += 1 + rgx.groups
+        join = enc('|').join
+        try:
+            self.rgx = re.compile(join(enc('(?:') + p + enc(')') for p in self.patterns), flags = f)
+            self.grouped = re.compile(join(enc('(') + p + enc(')') for p in self.patterns), flags = f)
+        except re.error:
+            self.rgx = None
+            self.init_each()
+            return
+        self.search = self.search_regex
+        self.test = self.rgx.search
+
+    def init_each(self):
+        # Search for the patterns one at a time.
+        self.search = self.search_each
+        self.test = self.test_each
+
+    def fold(self, x):
+        return x.lower() if self.ignore_case else x
+
+    def search_trie(self, val):
+        m = self.rgx.search(val)
+        if m:
+            x = m.group(0)
+            return (self.lookup[self.fold(x)], x)
+
+    def search_each(self, val):
+        best = None
+        for p, rgx in self.compiled:
+            m = rgx.search(val)
+            if m and (best is None or m.start() < best[1].start()):
+                best = (p, m)
+        if best:
+            return (best[0], best[1].group(0))
+
+    def test_each(self, val):
+        return any(rgx.search(val) for p, rgx in self.compiled)
+
+    def search_regex(self, val):
+        m = self.rgx.search(val)
+        if m:
+            m = self.grouped.match(val, m.start())
+            return (self.groups[m.lastindex], m.group(m.lastindex))
+
+    def search_automaton(self, val):
+        # The automaton reports matches in order of their end positions,
+        # so the leftmost and longest one might not come first. Keep the
+        # best so far until no remaining match could start at or before
+        # it, given the length of the longest pattern.
+        folded = self.fold(val)
+        if len(folded) != len(val):
+            return self.search_folded(val)
+        best = None
+        for end, (n, p) in self.automaton.iter(folded):
+            if best and end - self.maxlen >= best[0]:
+                break
+            start = end - n + 1
+            if best is None or start < best[0] or (start == best[0] and n > best[1]):
+                best = (start, n, p)
+        if best:
+            start, n, p = best
+            return (p, val[start:start + n])
+
+    def test_automaton(self, val):
+        folded = self.fold(val)
+        if len(folded) != len(val):
+            return self.search_folded(val) is not None
+        for x in self.automaton.iter(folded):
+            return True
+        return False
+
+    def search_folded(self, val):
+        # For a val whose length changes when ignoring case (for example,
+        # 'İ'.lower() has two characters), offsets found by the automaton
+        # do not map back to the val. Such vals are rare, so they use the
+        # trie regex, compiled only when first needed.
+        if self.rgx is None:
+            self.rgx = re.compile(trie_regex(list(self.lookup)), flags = re.IGNORECASE)
+        m = self.rgx.search(val)
+        if m:
+            x = m.group(0)
+            p = self.lookup.get(self.fold(x))
+            if p is None:
+                # The regex engine and lower() disagree about the case of x.
+                p = next(
+                    p for p in self.patterns
+                    if re.match(re.escape(p) + '$', x, flags = re.IGNORECASE)
+                )
+            return (p, x)
+
+def has_backrefs(rgx):
+    # Takes a compiled regex. Returns whether it refers to its own groups by
+    # number or name, via backreferences or conditionals.
+    c = sre_constants
+    refs = (c.GROUPREF, c.GROUPREF_EXISTS, c.GROUPREF_IGNORE)
+    refs += tuple(
+        getattr(c, name) for name in ('GROUPREF_LOC_IGNORE', 'GROUPREF_UNI_IGNORE')
+        if hasattr(c, name)
+    )
+    try:
+        parsed = sre_parse.parse(rgx.pattern, rgx.flags)
+    except Exception:
+        return True
+    return any(op in refs for op, av in iter_ops(parsed))
+
+def iter_ops(items):
+    # Takes a parsed regex. Yields its (OP, ARGS) items, at all depths.
+    for op, av in items:
+        yield (op, av)
+        for x in (av if isinstance(av, (tuple, list)) else ()):
+            if isinstance(x, sre_parse.SubPattern):
+                for item in iter_ops(x):
+                    yield item
+            elif isinstance(x, (tuple, list)):
+                for y in x:
+                    if isinstance(y, sre_parse.SubPattern):
+                        for item in iter_ops(y):
+                            yield item
+
+def is_literal(p):
+    # Whether a pattern contains no regex metacharacters.
+    chars = REGEX_CHARS if isinstance(p, str) else REGEX_BYTES
+    return not any(c in p for c in chars)
+
+def trie_regex(words):
+    # Takes literal strings (or bytes). Returns a regex matching any of
+    # them, organized as a trie, preferring longer matches.
+    trie = {}
+    for w in words:
+        node = trie
+        for i in range(len(w)):
+            node = node.setdefault(w[i:i + 1], {})
+        node[None] = True
+    return trie_node_regex(trie, words[0][:0])
+
+def trie_node_regex(node, empty):
+    # Returns the regex for the strings below a trie node. Chains of nodes
+    # with a single child are collapsed into one literal, which also keeps
+    # the recursion depth to the number of branching points.
+    alts = []
+    for k in sorted(k for k in node if k is not None):
+        prefix = [k]
+        child = node[k]
+        while len(child) == 1 and None not in child:
+            k2, child = next(iter(child.items()))
+            prefix.append(k2)
+        literal = re.escape(empty.join(prefix))
+        if len(child) == 1:
+            alts.append(literal)
+        else:
+            alts.append(literal + trie_node_regex(child, empty))
+    if isinstance(empty, bytes):
+        bar, start, stop, opt = b'|', b'(?:', b')', b'?'
+    else:
+        bar, start, stop, opt = '|', '(?:', ')', '?'
+    rgx = alts[0] if len(alts) == 1 else start + bar.join(alts) + stop
+    if None in node:
+        if len(alts) == 1:
+            rgx = start + rgx + stop
+        rgx += opt
+    return rgx
+
+def get_ahocorasick():
+    # Imported only when needed, as it is optional.
+    try:
+        import ahocorasick
+    except ImportError:
+        return None
+    return ahocorasick
+
+def read_patterns(path):
+    # Reads a patterns file: one pattern per line, skipping blank lines.
+    with open(path) as fh:
+        lines = [line.rstrip('\r\n') for line in fh]
+    return [line for line in lines if line]
+
+REGEX_CHARS = '.^$*+?{}[]\\|()'
+REGEX_BYTES = [REGEX_CHARS[i:i + 1].encode('ascii') for i in range(len(REGEX_CHARS))]
@@ -0,0 +1,182 @@
+####
+# Profiling the steps of a nab run (see --profile).
+#
+# The profiler wraps the initialize(), process(), and finalize() methods of
+# each step with functions that time the calls and count the vals going in
+# and out. The wrappers are installed as instance attributes after the begin
+# phase, so runs without --profile are unaffected. While profiling, steps are
+# always called via process(): the engines ignore the fuse() and
+# process_batch() hooks of a step whose process() was replaced (see
+# step.get_hook).
+#
+# Vals emitted through a ValIter are counted as the downstream steps consume
+# them. Time spent producing those vals lazily is not attributed to the step.
+#
+# For steps whose regexes have a literal prefilter (see nab.patterns), the
+# profile also reports the share of vals that the prefilter rejected.
+####
+
+from __future__ import absolute_import, unicode_literals, print_function
+
+import json
+import sys
+import time
+
+from .patterns import NabRgx
+from .utils import ValIter
+
+clock = getattr(time, 'perf_counter', time.time)
+
+class StepProfile(object):
+    # The statistics collected for one step.
+
+    FIELDS = (
+        'sid',
+        'name',
+        'calls',
+        'vals_in',
+        'vals_out',
+        'filtered',
+        'valiters',
+        'fanout',
+        'process_time',
+        'other_time',
+        'prefilters',
+        'prefiltered',
+    )
+
+    def __init__(self, step):
+        self.sid = step.sid
+        self.name = step.name
+        # Calls to initialize(), process(), and finalize().
+        self.calls = 0
+        # Vals passed to process(); vals emitted via process() or finalize().
+        self.vals_in = 0
+        self.vals_out = 0
+        # Vals for which process() returned None.
+        self.filtered = 0
+        # Number of ValIter returned and the total vals they yielded.
+        self.valiters = 0
+        self.fanout = 0
+        # Seconds spent in process() and in the other methods.
+        self.process_time = 0.0
+        self.other_time = 0.0
+        # The regexes of the step that have a literal prefilter.
+        self.rgxs = [
+            x for x in vars(step.opts).values()
+            if isinstance(x, NabRgx) and x.lit is not None
+        ]
+
+    @property
+    def prefilters(self):
+        # The literals, as text.
+        return [
+            x.lit.decode('utf-8', 'replace') if isinstance(x.lit, bytes) else x.lit
+            for x in self.rgxs
+        ]
+
+    @property
+    def prefiltered(self):
+        # Vals rejected by the prefilters, or None if there are none.
+        return sum(x.rejected for x in self.rgxs) if self.rgxs else None
+
+    def count(self, v):
+        # Takes a val returned by a step method. Updates the counts
+        # and returns the val -- or, for a ValIter, a counting proxy.
+        if v is None:
+            pass
+        elif isinstance(v, ValIter):
+            self.valiters += 1
+            return ValIter(self.count_iter(v))
+        else:
+            self.vals_out += 1
+        return v
+
+    def count_iter(self, vit):
+        for v in vit:
+            if v is None:
+                break
+            self.fanout += 1
+            self.vals_out += 1
+            yield v
+
+    def to_dict(self):
+        return {k : getattr(self, k) for k in self.FIELDS}
+
+class Profiler(object):
+
+    def __init__(self, steps):
+        self.profiles = [StepProfile(s) for s in steps]
+        self.start = clock()
+        for s, prof in zip(steps, self.profiles):
+            s.process = wrap_process(prof, s.process)
+            s.initialize = wrap_other(prof, s.initialize, False)
+            s.finalize = wrap_other(prof, s.finalize, True)
+
+    def report(self, json_path = None, fh = None):
+        # Prints a table to STDERR and, if requested, writes JSON.
+        fh = fh or sys.stderr
+        wall = clock() - self.start
+        fh.write(REPORT_HEADER.format(wall))
+        fh.write(REPORT_FMT.format(*REPORT_COLS))
+        for prof in self.profiles:
+            vin = prof.vals_in
+            fh.write(REPORT_FMT.format(
+                '{} {}'.format(prof.sid, prof.name),
+                prof.calls,
+                '{:.3f}'.format(prof.process_time),
+                '{:.3f}'.format(prof.other_time),
+                vin,
+                prof.vals_out,
+                prof.valiters,
+                ratio('{:.2f}', prof.fanout, prof.valiters),
+                ratio('{:.1%}', prof.filtered, vin),
+                ratio('{:.1%}', prof.prefiltered, vin if prof.rgxs else 0),
+            ))
+        if json_path:
+            d = dict(
+                wall_time = wall,
+                steps = [prof.to_dict() for prof in self.profiles],
+            )
+            with open(json_path, 'w') as jfh:
+                json.dump(d, jfh, indent = 4)
+
+def ratio(fmt, n, d):
+    return fmt.format(float(n) / d) if d else '-'
+
+def wrap_process(prof, f):
+    def process(opts, meta, val):
+        t = clock()
+        v = f(opts, meta, val)
+        prof.process_time += clock() - t
+        prof.calls += 1
+        prof.vals_in += 1
+        if v is None:
+            prof.filtered += 1
+        return prof.count(v)
+    return process
+
+def wrap_other(prof, f, emits):
+    # For initialize() and finalize(): the latter can emit vals.
+    def method(opts, meta):
+        t = clock()
+        v = f(opts, meta)
+        prof.other_time += clock() - t
+        prof.calls += 1
+        return prof.count(v) if emits else v
+    return method
+
+REPORT_HEADER = '\nProfile (wall time: {:.3f}s):\n'
+REPORT_FMT = '  {:<16} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9}\n'
+REPORT_COLS = (
+    'step',
+    'calls',
+    'time',
+    'other',
+    'in',
+    'out',
+    'valiters',
+    'fan-out',
+    'filtered',
+    'prefilter',
+)
@@ -0,0 +1,330 @@
+####
+# Data structures that summarize a stream of vals, mostly in bounded memory:
+# approximate counts, sets for checking whether a val was seen before, and
+# approximate quantiles.
+####
+
+from __future__ import absolute_import, unicode_literals, print_function
+
+import heapq
+import itertools
+import math
+
+class SpaceSaving(object):
+    # Approximate counts of the most frequent vals, via the Space-Saving
+    # algorithm (Metwally, Agrawal, and El Abbadi, 2005).
+    #
+    # At most capacity vals are tracked. Once full, a new val replaces the
+    # tracked val with the lowest count, taking over that count (plus one)
+    # and recording it as the error of the new count. As a result:
+    #
+    # - Each count overstates the true count by at most its error.
+    # - Errors never exceed total / capacity.
+    # - Every val whose true count exceeds total / capacity is tracked.
+    #
+    # To find the lowest count quickly, a min-heap holds one (COUNT, I, VAL)
+    # entry per tracked val. Counts go up without touching the heap, so an
+    # entry can be stale; stale entries are refreshed as they surface.
+
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError('SpaceSaving capacity must be positive')
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.heap = []
+        self.total = 0
+        self.seq = itertools.count()
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, x, n = 1):
+        self.total += n
+        counts = self.counts
+        if x in counts:
+            counts[x] += n
+        elif len(counts) < self.capacity:
+            self.track(x, n, 0)
+        else:
+            low = self.evict()
+            self.track(x, low + n, low)
+
+    def update(self, xs):
+        for x in xs:
+            self.add(x)
+
+    def items(self):
+        return self.counts.items()
+
+    def error(self, x):
+        return self.errors.get(x, 0)
+
+    @property
+    def max_error(self):
+        # The bound on the error of any count.
+        return self.total // self.capacity
+
+    def track(self, x, count, error):
+        self.counts[x] = count
+        self.errors[x] = error
+        heapq.heappush(self.heap, (count, next(self.seq), x))
+
+    def evict(self):
+        # Stops tracking the val with the lowest count. Returns that count.
+        heap = self.heap
+        counts = self.counts
+        while True:
+            count, i, x = heap[0]
+            current = counts[x]
+            if current == count:
+                heapq.heappop(heap)
+                del counts[x]
+                del self.errors[x]
+                return count
+            heapq.heapreplace(heap, (current, i, x))
+
+    def merge(self, other):
+        # Folds in another summary (see Step.merge). A val tracked by only
+        # one summary might have been counted, and evicted, by the other
+        # one; if that one was full, the val gets its lowest count added
+        # to both its count and its error.
+        lows = [
+            min(s.counts.values()) if len(s) >= s.capacity else 0
+            for s in (self, other)
+        ]
+        counts = {}
+        errors = {}
+        for x in set(self.counts) | set(other.counts):
+            count = 0
+            error = 0
+            for s, low in zip((self, other), lows):
+                if x in s.counts:
+                    count += s.counts[x]
+                    error += s.errors[x]
+                else:
+                    count += low
+                    error += low
+            counts[x] = count
+            errors[x] = error
+        keep = heapq.nlargest(self.capacity, counts, key = counts.get)
+        total = self.total + other.total
+        self.__init__(self.capacity)
+        self.total = total
+        for x in keep:
+            self.track(x, counts[x], errors[x])
+
+class SeenSet(object):
+    # A set used to check whether vals were seen before. If hashed is true,
+    # it keeps only the hash of each val, which saves memory for long vals
+    # but lets distinct vals collide (for 64-bit hashes, the odds are low:
+    # roughly one in a thousand after a hundred million distinct vals).
+
+    def __init__(self, hashed = False):
+        self.hashed = hashed
+        self.keys = set()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, x):
+        # Adds a val. Returns true if it was already present.
+        k = hash(x) if self.hashed else x
+        if k in self.keys:
+            return True
+        else:
+            self.keys.add(k)
+            return False
+
+class BloomFilter(object):
+    # A fixed-size set of vals with false positives but no false negatives,
+    # sized for a capacity of distinct vals and a false-positive rate. Has
+    # the same add() method as SeenSet.
+
+    def __init__(self, capacity, error_rate):
+        if not 0 < error_rate < 1:
+            raise ValueError('BloomFilter error_rate must be between 0 and 1')
+        ln2 = math.log(2)
+        n = max(1, capacity)
+        self.m = int(math.ceil(-n * math.log(error_rate) / ln2 ** 2))
+        self.k = max(1, int(round(float(self.m) / n * ln2)))
+        self.bits = bytearray((self.m + 7) // 8)
+        self.n = 0
+
+    def __len__(self):
+        # The number of vals added that were not already present.
+        return self.n
+
+    def add(self, x):
+        # Adds a val. Returns true if it was (probably) already present.
+        # The bit positions come from double hashing, using two values
+        # derived from the built-in hash of the val.
+        h1 = mix64(hash(x) & MASK64)
+        h2 = mix64(h1) | 1
+        m = self.m
+        bits = self.bits
+        present = True
+        for i in range(self.k):
+            pos = (h1 + i * h2) % m
+            mask = 1 << (pos & 7)
+            if not bits[pos >> 3] & mask:
+                bits[pos >> 3] |= mask
+                present = False
+        if not present:
+            self.n += 1
+        return present
+
+class TDigest(object):
+    # Approximate quantiles of numbers, via a t-digest (Dunning and Ertl,
+    # 2019): a sorted list of centroids, each a mean and a weight (the
+    # number of values it stands for). Centroids near the median stand for
+    # many values, and those near the extremes for few, which keeps the
+    # error small where it matters relative to the quantile. The number of
+    # centroids stays below about compression / 2.
+    #
+    # Values are buffered and merged into the centroids in bulk: values and
+    # centroids are sorted together, and consecutive ones are combined when
+    # their quantiles fall within the same unit of the scale function
+    # k(q) = compression / (2 * pi) * asin(2 * q - 1). If np (the NumPy
+    # module) is given, the merge is vectorized.
+
+    def __init__(self, compression = 200, np = None):
+        if compression < 2:
+            raise ValueError('TDigest compression must be at least 2')
+        self.compression = compression
+        self.np = np
+        self.means = []
+        self.weights = []
+        self.buffer = []
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def __len__(self):
+        # The number of values added.
+        return self.total + len(self.buffer)
+
+    def add(self, x):
+        self.buffer.append(x)
+        if len(self.buffer) >= TDIGEST_BUFFER:
+            self.compress()
+
+    def update(self, xs):
+        self.buffer.extend(xs)
+        if len(self.buffer) >= TDIGEST_BUFFER:
+            self.compress()
+
+    def merge(self, other):
+        # Folds in another digest (see Step.merge).
+        other.compress()
+        self.compress(other.means, other.weights, other.min, other.max)
+
+    def compress(self, means = (), weights = (), lo = None, hi = None):
+        # Merges the buffered values, along with any other centroids, into
+        # the centroids of the digest.
+        buf = self.buffer
+        if not buf and not means:
+            return
+        self.buffer = []
+        if buf:
+            lo = min(buf) if lo is None else min(lo, min(buf))
+            hi = max(buf) if hi is None else max(hi, max(buf))
+        if lo is not None:
+            self.min = lo if self.min is None else min(self.min, lo)
+            self.max = hi if self.max is None else max(self.max, hi)
+        total = self.total + len(buf) + sum(weights)
+        scale = self.compression / (2 * math.pi)
+        if self.np:
+            self.means, self.weights = self.merge_np(buf, means, weights, total, scale)
+        else:
+            pts = heapq.merge(
+                zip(self.means, self.weights),
+                sorted(zip(means, weights)),
+                ((x, 1) for x in sorted(buf)),
+            )
+            self.means, self.weights = self.merge_py(pts, total, scale)
+        self.total = total
+
+    def merge_py(self, pts, total, scale):
+        # Takes the (MEAN, WEIGHT) points, sorted. Returns the new means and
+        # weights, as lists.
+        asin = math.asin
+        means = []
+        weights = []
+        cum = 0
+        k = None
+        for m, w in pts:
+            cum += w
+            kb = int(scale * (asin(2.0 * (cum - w / 2.0) / total - 1) + math.pi / 2))
+            if kb == k:
+                sw += w
+                sm += m * w
+            else:
+                if k is not None:
+                    means.append(sm / sw)
+                    weights.append(sw)
+                k = kb
+                sw = w
+                sm = m * w
+        means.append(sm / sw)
+        weights.append(sw)
+        return (means, weights)
+
+    def merge_np(self, buf, means, weights, total, scale):
+        # The same merge as merge_py(), vectorized.
+        np = self.np
+        m = np.concatenate((
+            np.asarray(self.means, dtype = float),
+            np.asarray(means, dtype = float),
+            np.asarray(buf, dtype = float),
+        ))
+        w = np.concatenate((
+            np.asarray(self.weights, dtype = float),
+            np.asarray(weights, dtype = float),
+            np.ones(len(buf)),
+        ))
+        order = np.argsort(m, kind = 'mergesort')
+        m = m[order]
+        w = w[order]
+        q = (np.cumsum(w) - w / 2) / total
+        kb = np.floor(scale * (np.arcsin(2 * q - 1) + np.pi / 2))
+        starts = np.flatnonzero(np.concatenate(([True], kb[1:] != kb[:-1])))
+        sw = np.add.reduceat(w, starts)
+        sm = np.add.reduceat(m * w, starts)
+        return ((sm / sw).tolist(), sw.tolist())
+
+    def quantile(self, q):
+        # Returns the estimated value at quantile q (0 to 1), or None if
+        # the digest is empty. Interpolates linearly between the centers
+        # of the centroids, and between the outer ones and the min or max.
+        self.compress()
+        means = self.means
+        weights = self.weights
+        if not means:
+            return None
+        target = q * self.total
+        cum = 0.0
+        prev_m = self.min
+        prev_c = 0.0
+        for m, w in zip(means, weights):
+            c = cum + w / 2.0
+            if target < c:
+                return prev_m + (m - prev_m) * (target - prev_c) / (c - prev_c)
+            cum += w
+            prev_m = m
+            prev_c = c
+        if cum == prev_c:
+            return self.max
+        return prev_m + (self.max - prev_m) * (target - prev_c) / (cum - prev_c)
+
+def mix64(h):
+    # The SplitMix64 finalizer: spreads the bits of a 64-bit int, since the
+    # built-in hash of small ints is just the int itself.
+    h = (h ^ (h >> 30)) * 0xbf58476d1ce4e5b9 & MASK64
+    h = (h ^ (h >> 27)) * 0x94d049bb133111eb & MASK64
+    return h ^ (h >> 31)
+
+MASK64 = 2 ** 64 - 1
+
+# The number of values a TDigest buffers before merging them.
+TDIGEST_BUFFER = 2 ** 16
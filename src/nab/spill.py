@@ -0,0 +1,120 @@
+####
+# Sorting more data than fits in memory.
+#
+# An ExternalSorter collects records in memory until their estimated size
+# exceeds a budget. It then sorts them and writes them to a temp file, as a
+# sorted run. Iterating over the sorter merges the runs along with the
+# records still in memory, yielding all of the records in sorted order.
+#
+# Records are pickled, so they can be any picklable objects, as long as
+# they (or the keys derived from them) can be compared with each other.
+# The sort is stable: records with equal keys come out in the order added.
+####
+
+from __future__ import absolute_import, unicode_literals, print_function
+
+import heapq
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+
+class ExternalSorter(object):
+
+    def __init__(self, budget, key = None, reverse = False, sizeof = None):
+        # The budget is in bytes; sizeof(RECORD) estimates the memory
+        # used by a record.
+        self.budget = budget
+        self.key = key
+        self.reverse = reverse
+        self.sizeof = sizeof or estimate_size
+        self.records = []
+        self.size = 0
+        self.runs = []
+        self.dirs = []
+
+    def add(self, record):
+        self.records.append(record)
+        self.size += self.sizeof(record)
+        if self.size > self.budget:
+            self.spill()
+
+    def spill(self):
+        # Writes the in-memory records to a new sorted run.
+        if not self.records:
+            return
+        if not self.dirs:
+            self.dirs.append(tempfile.mkdtemp(prefix = 'nab-spill-'))
+        self.records.sort(key = self.key, reverse = self.reverse)
+        fd, path = tempfile.mkstemp(dir = self.dirs[0], suffix = '.run')
+        with os.fdopen(fd, 'wb', RUN_BUFSIZE) as fh:
+            dump = pickle.Pickler(fh, PROTOCOL).dump
+            for r in self.records:
+                dump(r)
+        self.runs.append(path)
+        self.records = []
+        self.size = 0
+
+    @property
+    def spilled(self):
+        return bool(self.runs)
+
+    def __iter__(self):
+        # Yields all records, in sorted order. Afterward, the sorter is empty
+        # and its temp files are gone.
+        self.records.sort(key = self.key, reverse = self.reverse)
+        its = [read_run(p) for p in self.runs]
+        its.append(iter(self.records))
+        self.records = []
+        self.size = 0
+        try:
+            if len(its) == 1:
+                for r in its[0]:
+                    yield r
+            else:
+                # The merge is stable: ties go to the earlier run.
+                merged = heapq.merge(*its, key = self.key, reverse = self.reverse)
+                for r in merged:
+                    yield r
+        finally:
+            self.close()
+
+    def merge(self, other):
+        # Takes another sorter, whose records were added after those of this
+        # one, and takes over its records and temp files (see Step.merge).
+        self.spill()
+        self.runs.extend(other.runs)
+        self.dirs.extend(other.dirs)
+        self.records = other.records
+        self.size = other.size
+        other.runs = []
+        other.dirs = []
+        other.records = []
+
+    def close(self):
+        # Deletes the temp files.
+        for d in self.dirs:
+            shutil.rmtree(d, ignore_errors = True)
+        self.dirs = []
+        self.runs = []
+
+def read_run(path):
+    with open(path, 'rb', RUN_BUFSIZE) as fh:
+        load = pickle.Unpickler(fh).load
+        while True:
+            try:
+                yield load()
+            except EOFError:
+                return
+
+def estimate_size(x):
+    # A rough estimate of the memory used by a record, including
+    # the elements of a tuple or list.
+    n = sys.getsizeof(x)
+    if isinstance(x, (tuple, list)):
+        n += sum(sys.getsizeof(y) for y in x)
+    return n
+
+PROTOCOL = pickle.HIGHEST_PROTOCOL
+RUN_BUFSIZE = 2 ** 18
@@ -0,0 +1,248 @@
+####
+# Summary statistics of numbers (see the stats step).
+#
+# Numbers are collected into typed arrays rather than lists of Python
+# objects: ints that fit in 64 bits in an array('q'), other numbers in an
+# array('d'). The statistics are computed from those arrays in bulk, using
+# NumPy if it is installed, or else pure Python. The two give the same
+# results, apart from floating-point rounding. Sums are exact for ints and
+# correctly rounded for floats.
+#
+# A Moments instance holds the count, sum, min, max, mean, and sum of squared
+# deviations of some numbers. Instances for separate chunks of numbers can be
+# combined (Chan, Golub, and LeVeque, 1979), which lets the approximate mode
+# (see NumberStats) summarize its input a chunk at a time, in bounded memory.
+####
+
+from __future__ import absolute_import, unicode_literals, print_function
+
+import collections
+import copy
+import itertools
+import math
+
+from array import array
+
+from .sketches import TDigest
+
+class NumberStats(object):
+    # Collects numbers and reports statistics about them. In exact mode,
+    # every number is kept, for exact quantiles. In approximate mode, the
+    # numbers are summarized every STATS_CHUNK numbers, with quantiles
+    # estimated by a TDigest.
+
+    def __init__(self, approx = False, compression = 200, np = None):
+        self.approx = approx
+        self.compression = compression
+        self.np = np
+        self.ints = array('q')
+        self.floats = array('d')
+        self.clear()
+
+    def __getstate__(self):
+        # Modules cannot be pickled (see --jobs), so a copy uses pure Python.
+        d = dict(self.__dict__, np = None)
+        if self.digest:
+            d['digest'] = copy.copy(self.digest)
+            d['digest'].np = None
+        return d
+
+    def clear(self):
+        # The arrays are emptied in place, as the stats step binds their
+        # methods in its fused code.
+        del self.ints[:]
+        del self.floats[:]
+        self.moments = Moments()
+        self.digest = TDigest(self.compression, self.np) if self.approx else None
+
+    def __len__(self):
+        return self.moments.n + len(self.ints) + len(self.floats)
+
+    def add(self, x):
+        # Takes an int, a float, or the text of one.
+        if not isinstance(x, (int, float)):
+            x = parse_number(x)
+        if isinstance(x, int):
+            try:
+                self.ints.append(x)
+            except OverflowError:
+                self.floats.append(float(x))
+        else:
+            self.floats.append(x)
+        if self.approx and len(self.ints) + len(self.floats) >= STATS_CHUNK:
+            self.flush()
+
+    def extend(self, xs):
+        # Adds a list of numbers. Ints are added in bulk, if possible; the
+        # array is restored if that fails partway.
+        ints = self.ints
+        n = len(ints)
+        try:
+            ints.extend(xs)
+        except (TypeError, OverflowError):
+            del ints[n:]
+            for x in xs:
+                self.add(x)
+            return
+        if self.approx and len(ints) + len(self.floats) >= STATS_CHUNK:
+            self.flush()
+
+    def flush(self):
+        # Summarizes the numbers in the arrays and empties them.
+        ints = self.ints
+        floats = self.floats
+        if not (ints or floats):
+            return
+        self.moments.combine(get_moments(ints, floats, self.np))
+        if self.np:
+            self.digest.update(get_values(ints, floats, self.np))
+        else:
+            self.digest.update(itertools.chain(ints, floats))
+        del ints[:]
+        del floats[:]
+
+    def merge(self, other):
+        # Folds in another instance (see Step.merge).
+        if self.approx:
+            self.flush()
+            other.flush()
+            self.moments.combine(other.moments)
+            self.digest.merge(other.digest)
+        else:
+            self.ints.extend(other.ints)
+            self.floats.extend(other.floats)
+
+    def results(self, qs):
+        # Returns an OrderedDict of the statistics, with the quantiles in
+        # qs named like p50. Values are None for empty input.
+        if self.approx:
+            self.flush()
+            m = self.moments
+            quantiles = [self.digest.quantile(q) for q in qs]
+        else:
+            m = get_moments(self.ints, self.floats, self.np)
+            quantiles = get_quantiles(self.ints, self.floats, qs, self.np)
+        d = collections.OrderedDict()
+        d['count'] = m.n
+        d['sum'] = m.sum
+        d['min'] = m.min
+        d['max'] = m.max
+        d['mean'] = m.mean if m.n else None
+        d['stddev'] = math.sqrt(m.m2 / m.n) if m.n else None
+        for q, x in zip(qs, quantiles):
+            d['p{:g}'.format(q * 100)] = x
+        return d
+
+class Moments(object):
+    # The count, sum, min, max, mean, and sum of squared deviations from the
+    # mean (M2) of some numbers. The sum is kept as an exact int part and a
+    # float part, along with the number of floats.
+
+    def __init__(self, n = 0, isum = 0, fsum = 0.0, nf = 0, lo = None, hi = None, mean = 0.0, m2 = 0.0):
+        self.n = n
+        self.isum = isum
+        self.fsum = fsum
+        self.nf = nf
+        self.min = lo
+        self.max = hi
+        self.mean = mean
+        self.m2 = m2
+
+    @property
+    def sum(self):
+        return self.isum + self.fsum if self.nf else self.isum
+
+    def combine(self, other):
+        if not other.n:
+            return
+        if not self.n:
+            self.__dict__.update(other.__dict__)
+            return
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.m2 += other.m2 + delta * delta * self.n * other.n / n
+        self.mean += delta * other.n / n
+        self.n = n
+        self.isum += other.isum
+        self.fsum = math.fsum((self.fsum, other.fsum))
+        self.nf += other.nf
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+def get_moments(ints, floats, np = None):
+    # Takes the arrays. Returns their Moments.
+    n = len(ints) + len(floats)
+    if not n:
+        return Moments()
+    fsum = math.fsum(floats)
+    if np:
+        a = np.frombuffer(ints, dtype = np.int64) if ints else None
+        f = np.frombuffer(floats, dtype = np.float64) if floats else None
+        bounds = []
+        isum = 0
+        if a is not None:
+            lo = int(a.min())
+            hi = int(a.max())
+            bounds.extend((lo, hi))
+            # Summing in NumPy is exact unless the total could overflow.
+            if max(-lo, hi) * len(a) < 2 ** 63:
+                isum = int(a.sum())
+            else:
+                isum = sum(ints)
+        if f is not None:
+            bounds.extend((float(f.min()), float(f.max())))
+        mean = (isum + fsum) / n
+        x = get_values(ints, floats, np)
+        m2 = float(np.square(x - mean).sum())
+    else:
+        isum = sum(ints)
+        bounds = [min(xs) for xs in (ints, floats) if xs]
+        bounds += [max(xs) for xs in (ints, floats) if xs]
+        mean = (isum + fsum) / n
+        m2 = math.fsum((x - mean) ** 2 for x in itertools.chain(ints, floats))
+    return Moments(n, isum, fsum, len(floats), min(bounds), max(bounds), mean, m2)
+
+def get_quantiles(ints, floats, qs, np = None):
+    # Returns the exact quantiles of the numbers, interpolating linearly
+    # between the closest ranks (like the NumPy default).
+    if not qs:
+        return []
+    if not (ints or floats):
+        return [None] * len(qs)
+    if np:
+        x = get_values(ints, floats, np)
+        return [float(v) for v in np.quantile(x, qs)]
+    xs = sorted(itertools.chain(ints, floats))
+    res = []
+    for q in qs:
+        pos = q * (len(xs) - 1)
+        i = int(pos)
+        j = min(i + 1, len(xs) - 1)
+        res.append(xs[i] + (xs[j] - xs[i]) * (pos - i))
+    return res
+
+def get_values(ints, floats, np):
+    # All of the numbers, as one NumPy array of floats.
+    return np.concatenate((
+        np.frombuffer(ints, dtype = np.int64).astype(np.float64) if ints else np.empty(0),
+        np.frombuffer(floats, dtype = np.float64) if floats else np.empty(0),
+    ))
+
+def parse_number(txt):
+    # Takes the text of a number. Tries int() first, which is faster than
+    # float() and exact for large ints.
+    try:
+        return int(txt)
+    except ValueError:
+        return float(txt)
+
+def get_numpy():
+    # Imported only when needed, as it is optional and slow to import.
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+# The number of numbers summarized at a time in approximate mode.
+STATS_CHUNK = 2 ** 16
@@ -1,7 +1,11 @@
 from __future__ import absolute_import, unicode_literals, print_function
 
+import locale
+import re
 import sys
 
+from .patterns import NabRgx
+
 class Step(object):
 
     NAME = None
@@ -10,11 +14,51 @@ class Step(object):
     USAGE = None
     OPTS_CONFIG = None
 
+    # Whether process() keeps no state and has no side effects, so that the
+    # engine can skip calling it (for example, when a downstream step is
+    # done with the current file) without changing the results of the run.
+    STATELESS = False
+
+    # Whether process() is a pure one-to-one map: it returns exactly one val
+    # for each val (never None or a ValIter), depends on nothing but the val,
+    # has no side effects, and does not fail on text input. Downstream steps
+    # then see one val per input line, in order, which lets nab skip input
+    # that cannot affect the results (see Tail).
+    MAP = False
+
+    # The scope of the input, beyond the current val, that can affect what the
+    # step does: None (nothing else), 'file' (per-file state or line numbers
+    # within the file), or 'run' (state kept across files). This determines
+    # whether the input can be processed in parallel: see --jobs and merge().
+    SCOPE = 'run'
+
+    # Whether merge() can fold the state of another instance into this one.
+    # Steps whose SCOPE is 'run' need this to process input in parallel (see
+    # --jobs). A step whose state cannot be merged in some configurations
+    # can set the instance attribute to false during the begin phase.
+    MERGE = False
+
+    # Whether process() has side effects, such as writing output, whose
+    # order relative to those of other steps matters. Batch mode runs each
+    # step over a whole batch before the next, so it is used only if at most
+    # one step has them (see --batch).
+    EFFECTS = False
+
+    # Whether process() can handle bytes vals, as read from the input in
+    # bytes mode (see --bytes). In that mode, nab sets the instance attribute
+    # bytes to true for the steps that will receive bytes; the first step
+    # unable to handle them gets a Decode step placed in front of it.
+    BYTES = False
+
     def __init__(self, sid, name, opts, meta):
         self.sid = sid
         self.name = name
         self.opts = opts
         self.meta = meta
+        self.bytes = False
+        # Whether regexes compiled via compile() get a literal
+        # prefilter (see --no-prefilter).
+        self.prefilter = True
 
     def __str__(self):
         return repr(self)
@@ -28,12 +72,53 @@ class Step(object):
         )
 
     def out(self, *xs, **kws):
-        kws.setdefault('file', getattr(self.meta.out, 'handle', None) or sys.stdout)
-        print(*xs, **kws)
+        # While a file is being processed, output goes through the buffered
+        # Writer for its output handle (see --flush).
+        w = getattr(self.meta.out, 'writer', None)
+        if w and 'file' not in kws:
+            w.print(*xs, **kws)
+        else:
+            kws.setdefault('file', getattr(self.meta.out, 'handle', None) or sys.stdout)
+            print(*xs, **kws)
 
     def err(self, *xs, **kws):
-        kws.setdefault('file', getattr(self.meta.err, 'handle', None) or sys.stderr)
-        print(*xs, **kws)
+        w = getattr(self.meta.err, 'writer', None)
+        if w and 'file' not in kws:
+            w.print(*xs, **kws)
+        else:
+            kws.setdefault('file', getattr(self.meta.err, 'handle', None) or sys.stderr)
+            print(*xs, **kws)
+
+    def write(self, data):
+        # Writes bytes to the binary buffer underlying the output handle.
+        w = getattr(self.meta.out, 'writer', None)
+        if w:
+            w.write_bytes(data)
+        else:
+            fh = getattr(self.meta.out, 'handle', None) or sys.stdout
+            fh.flush()
+            getattr(fh, 'buffer', fh).write(data)
+
+    def as_bytes(self, x):
+        # Takes a str from the step's options. Returns it encoded as bytes if
+        # the step receives bytes vals; otherwise, returns it unchanged.
+        if self.bytes and x is not None and not isinstance(x, bytes):
+            return x.encode(locale.getpreferredencoding(False))
+        else:
+            return x
+
+    def compile(self, rgx, flags = 0):
+        # Takes a regex from the step's options. Returns a NabRgx: the
+        # compiled regex, with a literal prefilter (see nab.patterns).
+        return NabRgx(re.compile(self.as_bytes(rgx), flags), self.prefilter)
+
+    def done(self, run = False):
+        # The step can call this method to signal that it will filter out
+        # every further val for the current file -- or, if run is true, for
+        # the rest of the run. If all upstream steps are stateless, nab will
+        # stop reading the input and move on to the finalize phase. The step
+        # must still return None for any vals it receives after the call.
+        self.meta._set_done(self, run)
 
     def begin(self, opts):
         # The Step can configure itself -- including the ability
@@ -66,6 +151,44 @@ class Step(object):
         # Process one Line.
         return val
 
+    def process_batch(self, opts, meta, vals):
+        # Process a list of vals (used only in batch mode; see --batch).
+        #
+        # Returns a list aligned with vals: each element is what process()
+        # would have returned for the corresponding val (None to filter it out
+        # or a ValIter to fan out). If every val is filtered out, the method
+        # can simply return None.
+        #
+        # Steps can override this hook to do their work a batch at a time.
+        # Those needing line numbers can use meta.batch_nums, a list aligned
+        # with vals holding the line number that each val came from. This
+        # default implementation points the Meta instance at that line before
+        # calling process(), just as the regular engine would.
+        res = []
+        for num, val in zip(meta.batch_nums, vals):
+            meta._seek_batch(num)
+            res.append(self.process(opts, meta, val))
+        meta._seek_batch()
+        return res
+
+    def fuse(self, opts):
+        # Returns the code that the fused engine (see nab.fuse) should run
+        # instead of calling process() -- or None to just call process().
+        #
+        # The return is a (CODE, NAMES) tuple. CODE is one or more lines of
+        # Python operating on a variable named val; to filter the val out,
+        # the code can use a continue statement. NAMES is a dict of the
+        # objects that the code needs, each referenced in CODE as a format
+        # placeholder. For example:
+        #
+        #   ('val = val.strip({chars})', dict(chars = opts.s))
+        #
+        # The {self} and {opts} placeholders are always available, as is the
+        # Meta instance, via the name meta. Because the names are bound when
+        # the code is compiled (after the begin phase), mutable state should
+        # be accessed through {self} or {opts}.
+        return None
+
     def finalize(self, opts, meta):
         # After a file is closed.
         pass
@@ -74,3 +197,26 @@ class Step(object):
         # Emit or persist overall results.
         pass
 
+    def merge(self, other):
+        # Used when processing input in parallel (see --jobs), for steps with
+        # the MERGE trait. Takes another instance of the step that processed
+        # a later portion of the input in a worker process, and folds its
+        # state into this instance.
+        pass
+
+def get_hook(step, name):
+    # Returns a step attribute that serves as an alternative to process(),
+    # such as process_batch(). If the attribute was inherited from a class
+    # above the one that supplied process(), it cannot be trusted -- for
+    # example, Range inherits from Index but does its own processing -- so
+    # the Step default is returned instead.
+    if 'process' not in vars(step):
+        for cls in type(step).__mro__:
+            d = vars(cls)
+            if name in d:
+                return getattr(step, name)
+            elif 'process' in d:
+                break
+    x = getattr(Step, name)
+    return x.__get__(step) if callable(x) else x
+
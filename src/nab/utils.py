@@ -1,5 +1,8 @@
 from __future__ import absolute_import, unicode_literals, print_function
 
+import os
+import sys
+
 def getitem(xs, i, default = None):
     # A non-raising __getitem__().
     try:
@@ -17,6 +20,120 @@ def getnext(it, default = None):
 def iff(pred, t = True, f = False):
     return t if pred else f
 
+def parse_size(txt):
+    # Takes a size in bytes, like 1000, 64K, 512M, or 2G. Returns an int.
+    units = dict(K = 2 ** 10, M = 2 ** 20, G = 2 ** 30)
+    txt = txt.strip().upper()
+    if txt[-1:] in units:
+        return int(float(txt[:-1]) * units[txt[-1]])
+    else:
+        return int(txt)
+
+def parse_flush(txt):
+    # Takes a flush policy for output: block, line, or a number of seconds.
+    # Returns the policy, with the number converted to a float.
+    if txt in ('block', 'line'):
+        return txt
+    else:
+        return float(txt)
+
+def get_cache_dir():
+    # The directory where nab caches data across runs. The NAB_CACHE
+    # environment variable can override the default location.
+    return (
+        os.environ.get('NAB_CACHE') or
+        os.path.join(
+            os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+            'nab',
+        )
+    )
+
+def compile_cached(src, filename):
+    # Takes Python source code. Returns the compiled code object, caching
+    # it on disk (keyed by the source and the Python version), so that
+    # later runs using the same code can skip compiling it. Each cache file
+    # holds the source too: a hash collision just means a cache miss.
+    # Failures to read or write the cache are ignored. Short code is just
+    # compiled, as that is faster than reading a cache file.
+    data = src.encode('utf-8')
+    if len(data) < CODE_CACHE_MIN:
+        return compile(src, filename, 'exec')
+    import marshal
+    import zlib
+    tag = getattr(getattr(sys, 'implementation', None), 'cache_tag', None)
+    key = '{}-{:08x}-{}'.format(
+        tag or 'py{}{}'.format(*sys.version_info[:2]),
+        zlib.crc32(data) & 0xffffffff,
+        len(data),
+    )
+    path = os.path.join(get_cache_dir(), 'code', key + '.bin')
+    try:
+        with open(path, 'rb') as fh:
+            cached_src, code = marshal.load(fh)
+        if cached_src == src:
+            return code
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        pass
+    code = compile(src, filename, 'exec')
+    try:
+        write_atomic(path, lambda fh: marshal.dump((src, code), fh), 'wb')
+    except (IOError, OSError):
+        pass
+    return code
+
+# The size in bytes of the smallest source code cached by compile_cached().
+CODE_CACHE_MIN = 200
+
+def write_atomic(path, write, mode = 'w'):
+    # Takes a file path and a function that writes to a file handle. Writes
+    # a temp file in the same directory and then renames it, so that other
+    # nab runs never see a partially written file. Creates the directory if
+    # needed. Errors are raised, after removing the temp file.
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    d = os.path.dirname(path)
+    if d and not os.path.isdir(d):
+        os.makedirs(d)
+    try:
+        with open(tmp, mode) as fh:
+            write(fh)
+        replace_file(tmp, path)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def replace_file(src, dst):
+    # Renames a file, replacing any file at the destination. PY2 lacks
+    # os.replace(), but its os.rename() does that on POSIX systems.
+    getattr(os, 'replace', os.rename)(src, dst)
+
+def write_step_error(meta, val):
+    # Prints information to STDERR if a Step raises an exception.
+    msg = STEP_ERROR_FMT.format(
+        getattr(meta.inp, 'path', None),
+        getattr(meta.out, 'path', None),
+        getattr(meta.err, 'path', None),
+        meta.overall_num,
+        meta.line_num,
+        meta.orig,
+        val,
+    )
+    sys.stderr.write(msg)
+
+STEP_ERROR_FMT = '\n'.join((
+    '',
+    'Step error:',
+    '  inp: {}',
+    '  out: {}',
+    '  err: {}',
+    '  overall_num: {}',
+    '  line_num: {}',
+    '  orig: {!r}',
+    '  val: {}',
+    '',
+    '',
+))
+
 class ValIter(object):
 
     def __init__(self, xs):
@@ -51,6 +168,21 @@ class Meta(object):
         # File numbers: current number and overall total.
         self.file_num = 0
         self.n_files = None
+        # Batch mode only (see --batch): the original lines in the current
+        # batch, the line number of the first one, and a list of line numbers
+        # aligned with the vals passed to a step's process_batch() method.
+        self.batch_lines = []
+        self.batch_start = 1
+        self.batch_nums = None
+        # Early termination (see Step.done): the sids of the steps able to
+        # stop the reading of input, along with flags telling the engine to
+        # stop reading the current file or all remaining files.
+        self.stoppers = set()
+        self.stop = False
+        self.stop_run = False
+        # Whether a worker process is handling a portion of the input
+        # other than its end (see --jobs).
+        self.partial = False
 
     def _set_n_files(self, n):
         self.n_files = n
@@ -62,6 +194,9 @@ class Meta(object):
         self.orig = None
         self.line_num = 0
         self.file_num += 1
+        self.batch_lines = []
+        self.batch_start = 1
+        self.stop = self.stop_run
 
     def _unset_path(self):
         self.inp = None
@@ -75,7 +210,40 @@ class Meta(object):
         self.line_num += 1
         self.overall_num += 1
 
+    def _set_steps(self, steps):
+        # A step can stop the reading of input only if
+        # all of the steps upstream of it are stateless.
+        for s in steps:
+            self.stoppers.add(s.sid)
+            if not s.STATELESS:
+                break
+
+    def _set_done(self, step, run):
+        if step.sid in self.stoppers:
+            self.stop = True
+            self.stop_run = self.stop_run or run
+
+    def _set_batch(self, lines):
+        self.batch_lines = lines
+        self.batch_start = self.line_num + 1
+        self._seek_batch()
+
+    def _seek_batch(self, num = None):
+        # Point the line-level attributes at a line in the current
+        # batch: by default, the last one.
+        if num is None:
+            num = self.batch_start + len(self.batch_lines) - 1
+        if num != self.line_num:
+            self.overall_num += num - self.line_num
+            self.line_num = num
+            self.orig = self.batch_lines[num - self.batch_start]
+
+    @property
+    def batch_range(self):
+        # The line numbers of the current batch.
+        return range(self.batch_start, self.batch_start + len(self.batch_lines))
+
     @property
     def is_last_file(self):
-        return self.n_files == self.file_num
+        return self.n_files == self.file_num and not self.partial
 
@@ -1,8 +1,11 @@
 from __future__ import absolute_import, unicode_literals, print_function
 
 import pytest
+import io
 import json
 import os
+import shlex
+import sys
 
 @pytest.fixture
 def tr():
@@ -42,3 +45,24 @@ class TestResource(object):
         with open(p) as fh:
             return fh.read()
 
+    def nab(self, args, inp = ''):
+        # Runs nab in-process, with the given text (or bytes) as STDIN,
+        # and returns what it wrote to STDOUT as text.
+        return self.nab_bytes(args, inp).decode(self.UTF8)
+
+    def nab_bytes(self, args, inp = ''):
+        # Like nab(), but returns bytes.
+        from nab.cli import main
+        if not isinstance(inp, bytes):
+            inp = inp.encode(self.UTF8)
+        buf = io.BufferedReader(io.BytesIO(inp))
+        stdin = io.TextIOWrapper(buf, encoding = self.UTF8)
+        stdout = io.TextIOWrapper(io.BytesIO(), encoding = self.UTF8)
+        orig = (sys.stdin, sys.stdout)
+        sys.stdin, sys.stdout = stdin, stdout
+        try:
+            main(shlex.split(args))
+            stdout.flush()
+        finally:
+            sys.stdin, sys.stdout = orig
+        return stdout.buffer.getvalue()
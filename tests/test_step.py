@@ -1,7 +1,10 @@
 from __future__ import absolute_import, unicode_literals, print_function
 
+import os
 import subprocess
 
+import pytest
+
 from nab import Step, getitem, iff
 from nab.cli import main
 
@@ -45,3 +48,908 @@ def test_tail(tr):
     out = subprocess.check_output(cmd, shell = True).decode(tr.UTF8)
     assert out == exp
 
+
+def test_batch(tr):
+    uniq = tr.get_file_path('data-uniq.txt')
+    paras = tr.get_file_path('data-paras.txt')
+    tests = [
+        ('-s strip -s uniq -s int -s pr -s sum', [uniq, uniq]),
+        ('-s chomp -s grep "[13579]" -s head 8 -s run "return meta.line_num" -s pr', [uniq]),
+        ('-s para -s tail 2 -s pr', [paras, paras]),
+        ('-s chomp -s skip 3 -s freq', [uniq, paras]),
+    ]
+    for pipeline, paths in tests:
+        outs = set()
+        for opt in ('', '--batch 1', '--batch 4', '--batch 1000'):
+            args = '{} {} -- {}'.format(opt, pipeline, ' '.join(paths))
+            outs.add(tr.nab(args))
+        assert len(outs) == 1
+
+def test_batch_effects(tr, capsys):
+    # Several steps with side effects: not batched, so their order is kept.
+    tests = [
+        ('-s chomp -s pr -s grep b -s pr', 'a\nb\nc\n', 'a\nb\nb\nc\n'),
+        ('-s chomp -s run "print(\'R\', val); return val" -s pr', 'a\nb\n', 'R a\na\nR b\nb\n'),
+    ]
+    for pipeline, inp, exp in tests:
+        assert tr.nab('--batch 10 ' + pipeline, inp) == exp
+        assert 'not batching' in capsys.readouterr().err
+    # Just one: batched.
+    assert tr.nab('--batch 10 -s chomp -s grep b -s pr', 'a\nb\n') == 'b\n'
+    assert capsys.readouterr().err == ''
+
+def test_fuse(tr):
+    uniq = tr.get_file_path('data-uniq.txt')
+    ls = tr.get_file_path('data-ls-output.txt')
+    paras = tr.get_file_path('data-paras.txt')
+    tests = [
+        ('-s chomp -s split -s index 7 -s prefix "<" -s pr', [ls]),
+        ('-s chomp -s search "(\\d+)\\s+(\\w+)" -a -s pr', [ls]),
+        ('-s chomp -s grep -v -i rw -s skip 2 -s pr', [ls, ls]),
+        ('-s chomp -s run "return ValIter([val, None, val])" -s nl -s wr', [uniq]),
+        ('-s para -s tail 2 -s pr -s run "return ValIter(val)"', [paras, paras]),
+        ('-s chomp -s freq --flip', [uniq, paras]),
+    ]
+    for pipeline, paths in tests:
+        outs = [
+            tr.nab('{} {} -- {}'.format(opt, pipeline, ' '.join(paths)))
+            for opt in ('--no-fuse', '')
+        ]
+        assert outs[0] == outs[1]
+
+def test_fuse_none_vals(tr):
+    # Vals that become None, such as an optional group that did not take
+    # part in the match, are filtered out by every engine.
+    tests = [
+        ("-s search 'a?(x)?b' -g 1 -s pr", 'x\n'),
+        ("-s search -a 'a?(x)?b' -s index 0 -s pr", 'x\n'),
+        ("-s search -a 'a?(x)?b' -s index 0 --strict -s pr", 'x\n'),
+    ]
+    for pipeline, exp in tests:
+        for opt in ('--no-fuse', '', '--batch 2'):
+            assert tr.nab('{} {}'.format(opt, pipeline), 'ab\nb\nxb\n') == exp
+
+def test_early_termination(tr):
+    # These commands would never finish if nab kept reading input.
+    tests = [
+        ('-s head 3 -s pr', 'a\n\nb\n\nc\n\n'),
+        ('-s chomp -s search "y" --first -s pr', 'y\n'),
+        ('-s chomp -s flipflop ^a ^c --once -s pr', 'a\nb\n'),
+    ]
+    for pipeline, exp in tests:
+        for opt in ('--no-fuse', '--batch 4', ''):
+            cmd = '(printf "a\\nb\\nc\\n"; yes) | nab {} {}'.format(opt, pipeline)
+            out = subprocess.check_output(cmd, shell = True, timeout = 10)
+            assert out.decode(tr.UTF8) == exp
+
+def test_jobs(tr):
+    paths = ' '.join([
+        tr.get_file_path('data-uniq.txt'),
+        tr.get_file_path('data-ls-output.txt'),
+        tr.get_file_path('data-paras.txt'),
+        tr.get_file_path('data-uniq.txt'),
+    ])
+    pipelines = [
+        '-s chomp -s uniq -s pr',
+        '-s chomp -s tail 4 -s pr',
+        '-s chomp -s head 2 -s pr -s freq',
+        '-s chomp -s uniq -s freq',
+    ]
+    opts = ('', '--jobs 3', '--jobs 2 --batch 3', '--jobs 3 --split 100')
+    for p in pipelines:
+        outs = set(tr.nab('{} {} -- {}'.format(opt, p, paths)) for opt in opts)
+        assert len(outs) == 1
+
+def test_bytes(tr):
+    paths = ' '.join([
+        tr.get_file_path('data-ls-output.txt'),
+        tr.get_file_path('data-uniq.txt'),
+    ])
+    pipelines = [
+        '-s grep -v rw -s wr',
+        '-s chomp -s sub "[a-z]+" X -s uniq -s pr',
+        '-s chomp -s split -s index 1 -s freq',
+        '-s chomp -s findall "\\d+" -s pr',
+        '-s chomp -s index 0 -s freq',
+        '-s chomp -s rindex 1 -s pr',
+        '-s chomp -s range 0 3 -s pr',
+    ]
+    opts = ('', '--bytes', '--bytes --no-fuse', '--bytes --batch 3')
+    for p in pipelines:
+        outs = set(tr.nab('{} {} -- {}'.format(opt, p, paths)) for opt in opts)
+        assert len(outs) == 1
+
+def test_flush(tr):
+    path = tr.get_file_path('data-ls-output.txt')
+    opts = ('', '--flush line', '--flush 0.5', '--no-fuse --flush block')
+    outs = set(tr.nab('{} -s chomp -s pr -s freq -- {}'.format(opt, path)) for opt in opts)
+    assert len(outs) == 1
+
+def test_flush_on_error(tr):
+    # Output buffered before an error is still written, and nab fails.
+    path = tr.get_file_path('data-ls-output.txt')
+    cmd = 'nab -s chomp -s pr -s int -- {} 2>/dev/null'.format(path)
+    p = subprocess.run(cmd, shell = True, stdout = subprocess.PIPE)
+    assert p.returncode != 0
+    assert p.stdout.decode(tr.UTF8) == 'total 16\n'
+
+def test_flush_timed():
+    # With a timed policy, pending output is flushed without further writes.
+    import io
+    import time
+    from nab.cli import Writer
+    handle = io.StringIO()
+    w = Writer(handle, '0.05')
+    w.write('a\n')
+    assert handle.getvalue() == ''
+    for _ in range(100):
+        time.sleep(0.01)
+        if handle.getvalue():
+            break
+    assert handle.getvalue() == 'a\n'
+    w.write('b\n')
+    w.close()
+    assert handle.getvalue() == 'a\nb\n'
+    assert not w.thread
+
+def test_print_order(tr):
+    # Output from print() in user code stays in order with step output.
+    exp = 'R a\na\nR b\nb\nR c\nc\n'
+    for opt in ('', '--no-fuse', '--flush line'):
+        args = '{} -s chomp -s run "print(\'R\', val); return val" -s pr'
+        assert tr.nab(args.format(opt), 'a\nb\nc\n') == exp
+
+def test_write_atomic(tmp_path):
+    from nab.utils import write_atomic
+    path = str(tmp_path / 'd' / 'x.txt')
+    write_atomic(path, lambda fh: fh.write('a'))
+    def fail(fh):
+        fh.write('b')
+        raise IOError('fail')
+    with pytest.raises(IOError):
+        write_atomic(path, fail)
+    assert open(path).read() == 'a'
+    assert os.listdir(str(tmp_path / 'd')) == ['x.txt']
+
+def test_step_registry(tr, tmp_path):
+    from nab.cli import StepRegistry, core_steps
+    mods = [tmp_path / 'mod1.py', tmp_path / 'mod2.py']
+    paths = [str(m) for m in mods]
+    cache = str(tmp_path / 'cache.json')
+    mods[0].write_text('from nab import Step\nclass Foo(Step): pass\n')
+    mods[1].write_text('from nab import Step\nclass Bar(Step): pass\n')
+
+    # With a cold cache, the user modules are imported to learn their steps.
+    reg = StepRegistry(paths, cache)
+    assert 'foo' in reg and 'pr' in reg and 'fubb' not in reg
+
+    # With a warm cache, only the module defining a needed step is imported.
+    st = os.stat(paths[1])
+    mods[1].write_text('raise Exception("Should not be imported")\n')
+    os.utime(paths[1], (st.st_atime, st.st_mtime))
+    reg = StepRegistry(paths, cache)
+    assert reg['pr'] is core_steps.Pr
+    assert reg['foo'].__name__ == 'Foo'
+
+def test_compressed(tr, tmp_path):
+    # Compressed input is detected by extension or by its first bytes.
+    import bz2, gzip, lzma
+    path = tr.get_file_path('data-ls-output.txt')
+    with open(path, 'rb') as fh:
+        data = fh.read()
+    fmt = '{} -s chomp -s split -s index 8 -s pr -- {}'
+    exp = tr.nab(fmt.format('', path))
+    for name, mod in (('x.gz', gzip), ('x.bz2', bz2), ('x.xz', lzma), ('x', gzip)):
+        p = tmp_path / name
+        p.write_bytes(mod.compress(data))
+        for opt in ('', '--bytes'):
+            assert tr.nab(fmt.format(opt, p)) == exp
+
+def test_compressed_output(tr):
+    path = tr.get_file_path('data-ls-output.txt')
+    fmt = '{} -s chomp -s split -s index 8 -s pr -- {}'
+    exp = tr.nab_bytes(fmt.format('', path))
+    for c in ('gz', 'bz2', 'xz'):
+        out = tr.nab_bytes(fmt.format('--compress ' + c, path))
+        assert get_codec(c).decompress(out) == exp
+
+def test_compressed_end_phase(tr):
+    # Output written by steps in the end phase is part of the same
+    # compressed stream as the rest, also with --jobs.
+    import gzip
+    path = tr.get_file_path('data-ls-output.txt')
+    fmt = '{} {} {} -- {} {}'
+    for opt in ('', '--no-fuse', '--jobs 2'):
+        for p in ('-s chomp -s pr -s freq', '-s chomp -s split -s index 4 -s int -s sum'):
+            exp = tr.nab_bytes(fmt.format(opt, '', p, path, path))
+            out = tr.nab_bytes(fmt.format(opt, '--compress gz', p, path, path))
+            assert exp and gzip.decompress(out) == exp
+
+def test_compressed_stdin(tr):
+    # Compressed STDIN is detected by its first bytes.
+    data = 'a\nb\na\n'.encode('utf-8')
+    for c in ('gz', 'bz2', 'xz'):
+        for opt in ('', '--bytes'):
+            inp = get_codec(c).compress(data)
+            assert tr.nab(opt + ' -s chomp -s freq', inp) == '2 : a\n1 : b\n'
+    assert tr.nab('-s chomp -s pr', data) == 'a\nb\na\n'
+
+def test_profile(tr, tmp_path):
+    import json
+    path = tr.get_file_path('data-uniq.txt')
+    jpath = str(tmp_path / 'profile.json')
+    fmt = '{} --profile --profile-json {} -s chomp -s grep 1 -s uniq -s pr -- {}'
+    for opt in ('', '--no-fuse', '--batch 4'):
+        tr.nab(fmt.format(opt, jpath, path))
+        with open(jpath) as fh:
+            steps = json.load(fh)['steps']
+        got = [(d['name'], d['vals_in'], d['vals_out']) for d in steps]
+        assert got == [
+            ('chomp', 17, 17),
+            ('grep', 17, 4),
+            ('uniq', 4, 2),
+            ('pr', 2, 2),
+        ]
+
+def test_freq_top(tr):
+    path = tr.get_file_path('data-ls-output.txt')
+    fmt = '-s split -s index 2 -s freq {} -- {}'
+    for opt in ('', '--reverse', '--flip --rng 1 3'):
+        full = tr.nab(fmt.format(opt, path))
+        top = tr.nab(fmt.format(opt + ' --top 2', path))
+        assert top.splitlines() == full.splitlines()[:2]
+
+def test_space_saving(tr):
+    import collections
+    import random
+    from nab.sketches import SpaceSaving
+    rnd = random.Random(1)
+    xs = [int(rnd.paretovariate(1.2)) for _ in range(5000)]
+    exact = collections.Counter(xs)
+
+    def check(ss):
+        assert ss.total == len(xs)
+        assert len(ss) == 20
+        for x, n in ss.items():
+            assert exact[x] <= n <= exact[x] + ss.error(x) <= n + ss.max_error
+        for x, n in exact.items():
+            assert n <= ss.max_error or x in ss.counts
+
+    # A single summary, and one merged from two halves (see --jobs).
+    ss = SpaceSaving(20)
+    ss.update(xs)
+    check(ss)
+    ss, other = SpaceSaving(20), SpaceSaving(20)
+    ss.update(xs[::2])
+    other.update(xs[1::2])
+    ss.merge(other)
+    check(ss)
+
+def test_uniq_modes(tr):
+    paths = ' '.join([
+        tr.get_file_path('data-ls-output.txt'),
+        tr.get_file_path('data-paras.txt'),
+        tr.get_file_path('data-ls-output.txt'),
+    ])
+    fmt = '{} -s split -s index 3 -s uniq {} -s pr -- {}'
+    opts = (
+        '',
+        '--stream',
+        '--hash',
+        '--bloom 0.0001',
+        '--spill 100',
+        '--spill 1M',
+    )
+    outs = set()
+    for opt in opts:
+        for engine in ('', '--no-fuse', '--batch 7', '--jobs 2'):
+            outs.add(tr.nab(fmt.format(engine, opt, paths)))
+    assert len(outs) == 1
+
+def test_external_sorter():
+    import random
+    from nab.spill import ExternalSorter
+    rnd = random.Random(1)
+    xs = [(rnd.randint(0, 99), str(i)) for i in range(2000)]
+    s = ExternalSorter(1000, key = lambda r: r[0])
+    for x in xs:
+        s.add(x)
+    assert s.spilled
+    assert list(s) == sorted(xs, key = lambda r: r[0])
+    assert not s.dirs
+
+def test_sorted(tr, tmp_path):
+    path = str(tmp_path / 'sorted.txt')
+    src = tr.get_file_path('data-ls-output.txt')
+    with open(src) as fh:
+        words = sorted(w for line in fh for w in line.split())
+    with open(path, 'w') as fh:
+        fh.write('\n'.join(words) + '\n')
+
+    def run(args):
+        return tr.nab('{} -- {}'.format(args, path))
+
+    for engine in ('', '--no-fuse', '--batch 7', '--jobs 2'):
+        # Same vals, in input order rather than by count.
+        exp = run('-s chomp -s freq')
+        got = run(engine + ' -s chomp -s freq --sorted')
+        assert sorted(got.splitlines()) == sorted(exp.splitlines())
+        for opt in ('--top 3', '--top 3 --reverse --flip', '--rng 2 4'):
+            exp = run('-s chomp -s freq ' + opt)
+            got = run(engine + ' -s chomp -s freq --sorted ' + opt)
+            assert sorted(got.splitlines()) == sorted(exp.splitlines())
+            if '--top' in opt:
+                assert got == exp
+        exp = run('-s chomp -s uniq -s pr')
+        assert run(engine + ' -s chomp -s uniq --sorted -s pr') == exp
+
+def test_sorted_unsorted_input(tr):
+    src = tr.get_file_path('data-ls-output.txt')
+    with pytest.raises(ValueError, match = 'input is not sorted'):
+        tr.nab('-s chomp -s uniq --sorted -s pr -- {}'.format(src))
+
+def sort_lines(tr):
+    # The paths used by the sort tests, and their lines.
+    paths = [
+        tr.get_file_path('data-ls-output.txt'),
+        tr.get_file_path('data-paras.txt'),
+    ]
+    lines = []
+    for p in paths:
+        with open(p) as fh:
+            lines.extend(line.rstrip('\n') for line in fh)
+    return (paths, lines)
+
+def test_sort(tr):
+    paths, lines = sort_lines(tr)
+
+    def field(line, i):
+        xs = line.split()
+        return xs[i] if len(xs) > i else ''
+
+    def num(x):
+        try:
+            return float(x)
+        except ValueError:
+            return 0.0
+
+    tests = [
+        ('', sorted(lines)),
+        ('-r', sorted(lines, reverse = True)),
+        ('-f 2', sorted(lines, key = lambda x: field(x, 2))),
+        ('-f 4 -n -r', sorted(lines, key = lambda x: num(field(x, 4)), reverse = True)),
+        ('--key "len(val)"', sorted(lines, key = len)),
+    ]
+    fmt = '{} -s chomp -s sort {} {} -s pr -- {}'
+    for opt, exp in tests:
+        exp = ''.join(x + '\n' for x in exp)
+        for engine in ('', '--no-fuse', '--batch 7', '--jobs 2 --split 500', '--bytes'):
+            for buf in ('', '--buffer 1K'):
+                assert tr.nab(fmt.format(engine, opt, buf, ' '.join(paths))) == exp
+
+def test_sort_per_file(tr):
+    paths, lines = sort_lines(tr)
+    out = tr.nab('-s chomp -s sort --per-file -s pr -- {}'.format(' '.join(paths + paths[:1])))
+    n = len(lines) - len(open(paths[1]).read().splitlines())
+    exp = sorted(lines[:n]) + sorted(lines[n:]) + sorted(lines[:n])
+    assert out.splitlines() == exp
+
+def tail_paths(tr, tmp_path):
+    # The paths used by the tail tests, including a file whose last line
+    # lacks a newline.
+    paths = [
+        tr.get_file_path('data-ls-output.txt'),
+        tr.get_file_path('data-paras.txt'),
+        str(tmp_path / 'no-newline.txt'),
+    ]
+    with open(paths[-1], 'w') as fh:
+        fh.write('x\n\ny\nz')
+    return paths
+
+def test_tail_seek(tr, tmp_path):
+    paths = tail_paths(tr, tmp_path)
+    fmt = '{} -s chomp -s tail {} -s pr -- {}'
+    for ps in (paths, paths[:1], paths[1:]):
+        lines = []
+        for p in ps:
+            with open(p) as fh:
+                lines.extend(fh.read().splitlines())
+        for n in (0, 1, 4, 100):
+            exp = ''.join(x + '\n' for x in lines[len(lines) - n:])
+            for opt in ('', '--no-fuse', '--batch 3', '--bytes', '--jobs 2'):
+                assert tr.nab(fmt.format(opt, n, ' '.join(ps))) == exp
+
+def test_tail_seek_reads_last_lines(tr, tmp_path):
+    # Only the last lines of each file are read.
+    import json
+    paths = tail_paths(tr, tmp_path)
+    jpath = str(tmp_path / 'profile.json')
+    args = '--profile --profile-json {} -s chomp -s tail 2 -s pr -- {}'
+    tr.nab(args.format(jpath, ' '.join(paths)))
+    with open(jpath) as fh:
+        steps = json.load(fh)['steps']
+    assert steps[0]['vals_in'] == 6
+
+def test_grep_patterns_file(tr, tmp_path):
+    path = tr.get_file_path('data-ls-output.txt')
+    with open(path) as fh:
+        lines = fh.read().splitlines()
+    literal = ['Feb', 'root', 'STAFF', 'x-x', '.']
+    regex = ['F[a-z]b', r'ro+t\b']
+    tests = [
+        (literal, '-F', lambda x: any(p in x for p in literal)),
+        (literal, '-F -i', lambda x: any(p.lower() in x.lower() for p in literal)),
+        (literal, '-F -v', lambda x: not any(p in x for p in literal)),
+        (regex, '', lambda x: 'Feb' in x or 'root' in x),
+    ]
+    ppath = str(tmp_path / 'patterns.txt')
+    fmt = '{} -s chomp -s grep -f {} {} -s pr -- {}'
+    for pats, opt, pred in tests:
+        with open(ppath, 'w') as fh:
+            fh.write('\n'.join(pats) + '\n\n')
+        exp = ''.join(x + '\n' for x in lines if pred(x))
+        for engine in ('', '--no-fuse', '--batch 7', '--bytes'):
+            assert tr.nab(fmt.format(engine, ppath, opt, path)) == exp
+
+def test_search_patterns_file(tr, tmp_path):
+    # The search variant reports the pattern that matched.
+    path = tr.get_file_path('data-ls-output.txt')
+    with open(path) as fh:
+        lines = fh.read().splitlines()
+    ppath = tmp_path / 'patterns.txt'
+    ppath.write_text('Feb\nFe\nroot\n')
+    out = tr.nab('-s chomp -s search -f {} -s freq -- {}'.format(ppath, path))
+    exp = sorted(
+        [(sum('root' in x for x in lines), 'root'), (sum('Feb' in x for x in lines), 'Feb')],
+        reverse = True,
+    )
+    assert out == ''.join('{} : {}\n'.format(*t) for t in exp if t[0])
+
+def test_pattern_set():
+    from nab.patterns import PatternSet, trie_regex
+    assert trie_regex(['ab', 'abc', 'b']) == '(?:ab(?:c)?|b)'
+    for literal in (None, False):
+        pats = ['abc', 'ab', 'b'] if literal is None else ['abc', 'ab', 'b.']
+        ps = PatternSet(pats, literal = literal)
+        assert ps.literal is (literal is None)
+        assert ps.search('xxabcd') == ('abc', 'abc')
+        assert ps.search('qqbab')[0] in ('b', 'b.')
+        assert ps.search('zz') is None
+    ps = PatternSet([b'AB', b'c'], ignore_case = True)
+    assert ps.search(b'xxabc') == (b'AB', b'ab')
+
+def test_pattern_set_case_folding():
+    # Vals whose length changes when lowercased.
+    from nab.patterns import PatternSet
+    ps = PatternSet(['abc', 'x'], ignore_case = True)
+    assert ps.search('İİ ABC') == ('abc', 'ABC')
+    assert ps.test('İİ xy')
+    assert not ps.test('İİ')
+
+def test_pattern_set_backrefs():
+    # Backreferences keep their meaning.
+    from nab.patterns import PatternSet
+    ps = PatternSet([r'(a)\1', r'(b)c\1'])
+    assert ps.search('xab bcb aa') == (r'(b)c\1', 'bcb')
+    assert ps.search('ab ba') is None
+    assert not ps.test('abc')
+
+def test_required_literal():
+    import re
+    from nab.patterns import required_literal
+    tests = [
+        (r'ERROR.*timeout=(\d+)', 'timeout='),
+        (r'^\s*foo\s', 'foo'),
+        (r'(?:xyz)+q', 'xyz'),
+        (r'(ab)?c', 'c'),
+        (r'a|bc', None),
+        (r'(?i)abc', None),
+    ]
+    for rgx, exp in tests:
+        assert required_literal(re.compile(rgx)) == exp
+    assert required_literal(re.compile(br'\d+ GET /')) == b' GET /'
+
+def test_prefilter(tr):
+    # Same output with and without the prefilter.
+    path = tr.get_file_path('data-ls-output.txt')
+    pipelines = [
+        r'-s chomp -s grep "\d+ Feb" -s pr',
+        r'-s chomp -s grep -v "\d+ Feb" -s pr',
+        r'-s chomp -s search "(\d+) Feb" -g 1 -s pr',
+        r'-s chomp -s sub "s(t+)aff" "S\1" -s pr',
+        r'-s chomp -s findall "\d+ Feb" -s pr',
+        r'-s chomp -s flipflop "total" "root" -s pr',
+    ]
+    for p in pipelines:
+        outs = set()
+        for opt in ('', '--no-fuse', '--batch 3', '--bytes', '--no-prefilter'):
+            outs.add(tr.nab('{} {} -- {}'.format(opt, p, path)))
+        assert len(outs) == 1
+
+def test_prefilter_profile(tr, tmp_path):
+    # The profile reports the vals rejected.
+    import json
+    path = tr.get_file_path('data-ls-output.txt')
+    jpath = str(tmp_path / 'profile.json')
+    tr.nab('--profile --profile-json {} -s grep "\\d+ Feb" -- {}'.format(jpath, path))
+    with open(jpath) as fh:
+        d = json.load(fh)['steps'][0]
+    assert d['prefilters'] == [' Feb']
+    assert d['prefiltered'] == d['vals_in'] - sum(' Feb' in x for x in open(path))
+
+def test_run_blocks(tr, tmp_path, monkeypatch):
+    # The blocks share a namespace.
+    monkeypatch.setenv('NAB_CACHE', str(tmp_path))
+    path = tr.get_file_path('data-ls-output.txt')
+    n = len(open(path).read().splitlines())
+    p = (
+        '-s chomp -s run --init "n = 0" "global n; n += 1" '
+        '--final "return str(n)" --end "self.out(\'end\', n)"'
+    )
+    out = tr.nab('{} -s pr -- {} {}'.format(p, path, path))
+    assert out == '{}\n{}\nend {}\n'.format(n, 2 * n, 2 * n)
+
+def test_run_vals(tr, tmp_path, monkeypatch):
+    # The batch form, with every engine.
+    monkeypatch.setenv('NAB_CACHE', str(tmp_path))
+    path = tr.get_file_path('data-ls-output.txt')
+    lines = open(path).read().splitlines()
+    p = '-s chomp -s run --vals "return [v[:3] if i % 2 else None for i, v in enumerate(vals)]"'
+    for opt in ('', '--no-fuse', '--batch 2', '--batch 1'):
+        out = tr.nab('{} {} -s pr -- {}'.format(opt, p, path))
+        if opt == '--batch 2':
+            exp = [x[:3] for x in lines[1::2]]
+        else:
+            exp = []
+        assert out.splitlines() == exp
+
+def test_run_code_cache(tr, tmp_path, monkeypatch):
+    # Longer code is cached after it is compiled.
+    monkeypatch.setenv('NAB_CACHE', str(tmp_path))
+    path = tr.get_file_path('data-ls-output.txt')
+    lines = open(path).read().splitlines()
+    code = '-s run "x = [v for v in val]; {}; return val"'.format('; '.join(['x = x[::-1]'] * 20))
+    for _ in range(2):
+        out = tr.nab('-s chomp {} -s pr -- {}'.format(code, path))
+        assert out.splitlines() == lines
+    assert len(os.listdir(str(tmp_path / 'code'))) == 1
+
+def test_jsonl_parse_path():
+    from nab.jsonl import parse_path
+    assert parse_path('a.b[0].c') == ('a', 'b', 0, 'c')
+    assert parse_path('[-1]') == (-1,)
+    for p in ('', 'a..b', 'a[0]b', 'a[x]'):
+        with pytest.raises(ValueError):
+            parse_path(p)
+
+def jsonl_texts():
+    # JSON documents for the jsonl tests, with keys that are nested,
+    # escaped, or quoted inside strings.
+    import json
+    docs = [
+        {'a': {'b': [{'c': 1}, {'c': 2}]}, 's': 'x', 'n': 3},
+        {'m': '"s": 9, "n": 9', 's': 'y', 'n': 4.5, 'a': None},
+        {'a': {'s': 'nested', 'n': 8}, 'n': 5},
+        {'q': [1, {'s': 'deep'}], 's': 'w'},
+        {'a/b': 1, 's': 'é'},
+        {'x': {'n': 1}, 'n': 0},
+    ]
+    texts = [json.dumps(d) for d in docs]
+    texts.append('{"a\\/b": 2, "s\\u0020": 3, "s" : "spaced"}')
+    return texts
+
+def test_jsonl_scan():
+    # The scan gets the same values as a full parse.
+    from nab.jsonl import MISSING, Projection
+    texts = jsonl_texts()
+    paths = ['s', 'n', 'a.b[1].c', 'a.s', 'a/b', 'q[-1].s', 'x.n']
+    for p in paths:
+        exp = [Projection([p], scan = False).get(t) for t in texts]
+        assert [Projection([p]).get(t) for t in texts] == exp
+    assert Projection(['a/b']).get(texts[-1]) == [2]
+    assert Projection(['n']).get(texts[3]) == [MISSING]
+
+def test_jsonl(tr):
+    inp = '\n'.join(jsonl_texts()) + '\n'
+    tests = [
+        ('-s jsonl s -s pr', 'x y w é spaced'),
+        ('-s jsonl n -s sum', '12.5'),
+        ('-s jsonl "a.b[1].c" n --json -s pr', '[2,3] [null,4.5] [null,5] [null,null] [null,null] [null,0] [null,null]'),
+        ('-s jsonl a.s --default 0 -s pr', '0 0 nested 0 0 0 0'),
+        ('-s jsonl s -s grep e -s pr', 'spaced'),
+        ('-s jsonl n --str -s grep 5 -s pr', '4.5 5'),
+        ('-s jsonl n s --str -s pr', "('3', 'x') ('4.5', 'y') ('5', '') ('', 'w') ('', 'é') ('0', '') ('', 'spaced')"),
+        ('-s jsonl a/b x.n --default 0 -s freq', '4 : (0, 0) 1 : (2, 0) 1 : (1, 0) 1 : (0, 1)'),
+    ]
+    for p, exp in tests:
+        for opt in ('', '--no-fuse', '--batch 2'):
+            assert tr.nab('{} {}'.format(opt, p), inp).split() == exp.split()
+
+def csv_path(tmp_path):
+    path = tmp_path / 'data.csv'
+    path.write_text(
+        'id,name,city,n\n'
+        '1,"Smith, J",NYC,3\n'
+        '2,"multi\nline",LA,4\n'
+        '3,plain,SF\n'
+        '4,"x""y",,5\n'
+    )
+    return path
+
+def test_csv(tr, tmp_path):
+    path = csv_path(tmp_path)
+    tests = [
+        ('-s csv 1 -s pr', ['name', 'Smith, J', 'multi', 'line', 'plain', 'x"y']),
+        ('-s csv --header 0 -s int -s sum', ['10']),
+        ('-s csv name n --header -s pr', [
+            "['Smith, J', '3']",
+            "['multi\\nline', '4']",
+            "['plain', None]",
+            "['x\"y', '5']",
+        ]),
+        ('-s csv --no-quote 1 -s pr', ['name', '"Smith', '"multi', 'LA', 'plain', '"x""y"']),
+    ]
+    for p, exp in tests:
+        for opt in ('', '--no-fuse', '--batch 2'):
+            assert tr.nab('{} {} -- {}'.format(opt, p, path)).splitlines() == exp
+
+def test_csv_unknown_column(tr, tmp_path):
+    path = csv_path(tmp_path)
+    for opt in ('', '--no-fuse', '--batch 2'):
+        with pytest.raises(ValueError, match = 'no column named'):
+            tr.nab('{} -s csv nope -s pr -- {}'.format(opt, path))
+
+def test_csv_header_per_file(tr, tmp_path):
+    # The header is read for each file.
+    path = csv_path(tmp_path)
+    out = tr.nab('-s csv name -s pr -- {} {}'.format(path, path))
+    assert out.count('Smith') == 2 and 'name' not in out
+
+def test_tsv(tr, tmp_path):
+    path = tmp_path / 'data.tsv'
+    path.write_text('a\tb\tc\nd\te\tf\n')
+    assert tr.nab('-s tsv 2 0 -s join - -s pr -- {}'.format(path)) == 'c-a\nf-d\n'
+
+def field_path(tmp_path):
+    path = tmp_path / 'data.txt'
+    path.write_text('a b  c d\n  e f\ng\n\nh,i,,j\n')
+    return path
+
+def test_field(tr, tmp_path):
+    # The field step matches split+index, with or without the rewrite.
+    path = field_path(tmp_path)
+    pipelines = [
+        '-s split -s index 1',
+        '-s split -s index -1',
+        '-s split -s rindex 2',
+        '-s split -s index 3',
+        '-s split " " -s index 1',
+        '-s split "\\s+" -s index 2',
+        '-s split , -s index -2',
+        '-s split "(,)" -s index 2',
+    ]
+    for p in pipelines:
+        outs = set()
+        for opt in ('--no-rewrite', '', '--no-fuse', '--batch 2', '--bytes'):
+            outs.add(tr.nab('{} -s chomp {} -s pr -- {}'.format(opt, p, path)))
+        assert len(outs) == 1
+
+def test_field_rewrite():
+    from nab.cli import parse_args
+    names = lambda args: [s.name for s in parse_args(args.split()).steps]
+    assert names('-s split -s index 1 -s pr') == ['field', 'pr']
+    assert names('-s split -s index 1 --strict') == ['split', 'index']
+    assert names('--no-rewrite -s split -s rindex 1') == ['split', 'rindex']
+
+def test_field_several(tr, tmp_path):
+    path = field_path(tmp_path)
+    tests = [
+        ('-s field 0,-1', "('a', 'd')|('e', 'f')|('g', 'g')|('h,i,,j', 'h,i,,j')"),
+        ('-s field -2 -1', "('c', 'd')|('e', 'f')"),
+        ('-s field 3 0 -d ,', "('j', 'h')"),
+    ]
+    for p, exp in tests:
+        for opt in ('', '--no-fuse', '--batch 2'):
+            out = tr.nab('{} -s chomp {} -s pr -- {}'.format(opt, p, path))
+            assert out.splitlines() == exp.split('|')
+
+def stats_xs():
+    import random
+    rnd = random.Random(1)
+    xs = [rnd.randint(-1000, 1000) for _ in range(50000)]
+    xs += [rnd.gauss(0, 100) for _ in range(50000)]
+    xs.append(2 ** 70)
+    return xs
+
+def test_number_stats():
+    # Exact and approximate stats, with and without NumPy.
+    from nab.stats import NumberStats, get_numpy
+    xs = stats_xs()
+    qs = [0, 0.25, 0.5, 0.99, 1]
+    backends = [None, get_numpy()] if get_numpy() else [None]
+    results = []
+    for np in backends:
+        for approx in (False, True):
+            st = NumberStats(approx = approx, np = np)
+            st.extend(xs[:1000])
+            for x in xs[1000:]:
+                st.add(x)
+            results.append(st.results(qs))
+    s = sorted(xs)
+    for d in results:
+        assert d['count'] == len(xs)
+        assert d['min'] == s[0] and d['max'] == s[-1]
+        assert abs(d['sum'] - sum(xs)) < 1e-6 * 2 ** 70
+        assert d['p0'] == s[0] and d['p100'] == s[-1]
+        assert abs(d['p50'] - s[len(s) // 2]) < 2
+    for d in results[::2]:
+        assert d['p25'] == s[(len(s) - 1) // 4]
+
+def test_tdigest():
+    # The digest keeps rank errors small, also after merging.
+    from nab.sketches import TDigest
+    xs = stats_xs()
+    a = TDigest()
+    b = TDigest()
+    a.update(xs[:30000])
+    b.update(xs[30000:-1])
+    a.merge(b)
+    s = sorted(xs[:-1])
+    for q in (0.001, 0.1, 0.5, 0.9, 0.999):
+        rank = sum(x < a.quantile(q) for x in s) / float(len(s))
+        assert abs(rank - q) < 0.001
+
+def test_stats(tr):
+    # The step, with every engine.
+    import json
+    inp = ''.join('{}\n'.format(x) for x in range(1, 101))
+    for opt in ('', '--no-fuse', '--batch 7'):
+        for sopt in ('', '--approx', '--no-numpy'):
+            d = json.loads(tr.nab('{} -s int -s stats -q 0.5 --json {}'.format(opt, sopt), inp))
+            assert d['count'] == 100 and d['sum'] == 5050 and d['mean'] == 50.5
+            assert d['min'] == 1 and d['max'] == 100 and d['p50'] == 50.5
+
+def test_stats_per_file(tr, tmp_path):
+    path = tmp_path / 'nums.txt'
+    path.write_text(''.join('{}\n'.format(x) for x in range(1, 101)))
+    out = tr.nab('-s stats --per-file -- {} {}'.format(path, path))
+    assert out.count('count 100\n') == 2
+
+def test_int_exact(tr):
+    # Int is exact for large integers.
+    assert tr.nab('-s int -s pr', '9007199254740993\n2.9\n') == '9007199254740993\n2\n'
+
+def groupby_rows(tmp_path):
+    # Returns the path of a file with random (KEY, VALUE, LETTER) rows, and
+    # a function returning the expected aggregates for a key, computed
+    # directly: [KEY, COUNT, SUM, MIN, MAX, DISTINCT].
+    import random
+    rnd = random.Random(3)
+    rows = [
+        ('k{}'.format(rnd.randint(0, 200)), rnd.randint(-50, 1000), rnd.choice('abcdef'))
+        for _ in range(5000)
+    ]
+    path = tmp_path / 'rows.txt'
+    path.write_text(''.join('{} {} {}\n'.format(*r) for r in rows))
+    exp = {}
+    for k, x, c in rows:
+        exp.setdefault(k, []).append(x)
+    def expected(k):
+        xs = exp[k]
+        return [k, len(xs), sum(xs), min(xs), max(xs), len(set(xs))]
+    return (path, rows, sorted(exp), expected)
+
+def test_groupby(tr, tmp_path):
+    # Key order, with every engine, and spilling to temp files.
+    path, rows, keys, expected = groupby_rows(tmp_path)
+    aggs = '-a count sum min max distinct'
+    want = ''.join('\t'.join(map(str, expected(k))) + '\n' for k in keys)
+    for opt in ('', '--no-fuse', '--batch 7', '--jobs 2'):
+        for gopt in ('', '--buffer 4K'):
+            args = '{} -s groupby -f 0 -v 1 {} {} -- {}'.format(opt, aggs, gopt, path)
+            assert tr.nab(args) == want
+    args = '-s groupby -f 0 -v 1 {} -r --buffer 4K -- {}'.format(aggs, path)
+    assert tr.nab(args).splitlines(True) == want.splitlines(True)[::-1]
+
+def test_groupby_top(tr, tmp_path):
+    # Top keys by an aggregate.
+    import json
+    path, rows, keys, expected = groupby_rows(tmp_path)
+    top = sorted(keys, key = lambda k: (-expected(k)[2], k))[:5]
+    for gopt in ('--top 5', '--top 5 --buffer 4K', '--buffer 4K'):
+        out = tr.nab('-s groupby -f 0 -v 1 -a mean sum --by sum --json {} -- {}'.format(gopt, path))
+        ds = [json.loads(line) for line in out.splitlines()]
+        assert [d['key'] for d in ds[:5]] == top
+        for d in ds:
+            assert d['sum'] == expected(d['key'])[2]
+            assert d['mean'] == d['sum'] / float(expected(d['key'])[1])
+
+def test_groupby_extractors(tr, tmp_path):
+    import collections
+    path, rows, keys, expected = groupby_rows(tmp_path)
+    out = tr.nab(r'-s groupby --rgx " (\w)$" -g 1 --val "len(val)" -a count max -- {}'.format(path))
+    counts = collections.Counter(c for k, x, c in rows)
+    assert [line.split('\t')[:2] for line in out.splitlines()] == [
+        [c, str(n)] for c, n in sorted(counts.items())
+    ]
+
+def test_groupby_skipped(tr, capsys):
+    # Vals with a missing or non-numeric value are skipped and counted.
+    for opt in ('', '--no-fuse', '--batch 2'):
+        out = tr.nab('{} -s groupby -f 0 -v 1 -a count sum'.format(opt), 'a 1\nb\na x\nb 2\n')
+        assert out == 'a\t1\t1\nb\t1\t2\n'
+        assert capsys.readouterr().err == 'groupby: skipped 2 vals without a number\n'
+
+def test_groupby_mixed_keys(tr):
+    # Numbers and text as keys, with and without spilling to sorted runs.
+    inp = '3\nb\n1\na\n3\nb\n10\n'
+    p = '-s chomp -s groupby --key "int(val) if val.isdigit() else val" {}'
+    exp = ['1\t1', '3\t2', '10\t1', 'a\t1', 'b\t2']
+    for opt in ('', '--buffer 1', '--buffer 1 -r'):
+        got = tr.nab(p.format(opt), inp).splitlines()
+        assert got == (exp[::-1] if '-r' in opt else exp)
+
+OLD_MTIME = 1000000000
+
+def in_place_files(tmp_path, *texts):
+    # Writes the texts to files with an old mtime. Returns their paths.
+    paths = []
+    for i, text in enumerate(texts):
+        p = tmp_path / '{}.txt'.format('abc'[i])
+        p.write_text(text)
+        os.utime(str(p), (OLD_MTIME, OLD_MTIME))
+        paths.append(p)
+    return paths
+
+def test_in_place(tr, tmp_path):
+    # The output replaces each input, keeping its mode. Through a symlink,
+    # the file it points to is replaced.
+    import stat
+    a, b = in_place_files(tmp_path, 'foo\nbar\n', 'bar\n')
+    a.chmod(0o640)
+    link = tmp_path / 'link'
+    link.symlink_to(a)
+    for opt in ('', '--fsync', '--jobs 2'):
+        tr.nab('--in-place {} -s sub foo FOO -s wr -- {} {}'.format(opt, link, b))
+        assert a.read_text() == 'FOO\nbar\n' and b.read_text() == 'bar\n'
+    assert link.is_symlink()
+    assert stat.S_IMODE(a.stat().st_mode) == 0o640
+    assert sorted(os.listdir(str(tmp_path))) == ['a.txt', 'b.txt', 'link']
+
+def test_in_place_skip_unchanged(tr, tmp_path):
+    # Unchanged files can be left untouched.
+    a, b = in_place_files(tmp_path, 'FOO\nbar\n', 'bar\n')
+    args = '--in-place --skip-unchanged -s sub bar BAR -s wr -- {} {}'.format(a, b)
+    tr.nab(args)
+    assert a.read_text() == 'FOO\nBAR\n' and b.read_text() == 'BAR\n'
+    for p in (a, b):
+        os.utime(str(p), (OLD_MTIME, OLD_MTIME))
+    tr.nab(args)
+    assert a.stat().st_mtime == OLD_MTIME and b.stat().st_mtime == OLD_MTIME
+    assert sorted(os.listdir(str(tmp_path))) == ['a.txt', 'b.txt']
+
+def test_in_place_skip_unchanged_gz(tr, tmp_path):
+    # Compressed files are compared by their uncompressed bytes, which
+    # differ if the output is shorter.
+    import gzip
+    gz = tmp_path / 'c.gz'
+    gz.write_bytes(gzip.compress(b'foo\nbar\n'))
+    os.utime(str(gz), (OLD_MTIME, OLD_MTIME))
+    tr.nab('--in-place --skip-unchanged -s sub zzz Z -s wr -- {}'.format(gz))
+    assert gz.stat().st_mtime == OLD_MTIME
+    tr.nab('--in-place --skip-unchanged -s head 1 -s wr -- {}'.format(gz))
+    assert gzip.decompress(gz.read_bytes()) == b'foo\n'
+    assert os.listdir(str(tmp_path)) == ['c.gz']
+
+def test_in_place_error(tr, tmp_path):
+    # After an error, the input stays as it was.
+    a, = in_place_files(tmp_path, 'BAR\n')
+    with pytest.raises(ZeroDivisionError):
+        tr.nab('--in-place -s run "1 / 0" -- {}'.format(a))
+    assert a.read_text() == 'BAR\n'
+    assert os.listdir(str(tmp_path)) == ['a.txt']
+
+def get_codec(fmt):
+    # The module for a compression format.
+    import bz2, gzip, lzma
+    return dict(gz = gzip, bz2 = bz2, xz = lzma)[fmt]